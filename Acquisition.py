@@ -0,0 +1,132 @@
+from threading import Thread
+from multiprocessing import Pipe
+from queue import SimpleQueue, Empty
+from Telemetry import get_telemetry
+import logging
+import time
+
+
+class AcquisitionThread(Thread):
+    """Thread which reads out a camera.
+
+    While active() is true, capture() is called repeatedly to read out one frame at a time. Everything else which
+    accesses the camera is submitted as a control (a callable) with call() and applied between two frames, so the
+    camera is only used from this thread and a control takes effect within one frame time. While no frames are
+    captured, the thread sleeps until a control arrives or idle_timeout() has passed and then calls idle().
+
+    The SDK releases the GIL while it waits for a frame, so the thread of the event loop keeps receiving commands.
+    """
+
+    def __init__(self, capture, active, idle=None, idle_timeout=None, name: str = None):
+        """Constructor.
+
+        # Arguments
+        * capture::callable - Capture a single frame.
+        * active::callable - Return whether frames should be captured.
+        * idle::callable - Called after waking up while no frames are captured.
+        * idle_timeout::callable - Return the maximum time (in s) to sleep while no frames are captured (None to only
+                                   wake up for controls).
+        * name::str - Name of the thread.
+        """
+
+        super(AcquisitionThread, self).__init__(name=name, daemon=True)
+
+        self._capture = capture
+        self._active = active
+        self._idle = idle if idle is not None else lambda: None
+        self._idle_timeout = idle_timeout if idle_timeout is not None else lambda: None
+
+        # Controls waiting to be applied and the number of controls submitted so far
+        self._controls = SimpleQueue()
+        self._submitted = 0
+        self._running = False
+
+        # Becomes readable when the thread has stopped (e.g., for multiprocessing.connection.wait)
+        self.sentinel, self._sentinel_writer = Pipe(duplex=False)
+        # Exception which stopped the thread
+        self.error = None
+
+        # Number of frames captured, controls applied and time the last control waited for being applied (in s)
+        self.frames = 0
+        self.controls_applied = 0
+        self.control_latency = 0
+
+    def call(self, function, *args):
+        """Apply function(*args) on the acquisition thread before the next frame. """
+
+        self._submitted += 1
+        self._controls.put((time.perf_counter(), function, args))
+
+    @property
+    def pending(self) -> int:
+        """Number of controls which were submitted by call() but are not completely applied yet. """
+
+        return self._submitted - self.controls_applied
+
+    def stop(self, timeout: float = None):
+        """Stop the thread after the current frame and wait for it. """
+
+        self.call(self._request_stop)
+        self.join(timeout)
+
+    def _request_stop(self):
+        # Not _stop, which is used by threading.Thread itself
+        self._running = False
+
+    def _apply_controls(self, timeout: float = 0) -> int:
+        """Apply all pending controls, waiting at most timeout (forever for None) for the first one.
+
+        # Returns
+        * n::int - Number of controls which were applied.
+        """
+
+        n = 0
+        while self._running:
+            try:
+                if n == 0 and timeout != 0:
+                    t_submit, function, args = self._controls.get(timeout=timeout)
+                else:
+                    t_submit, function, args = self._controls.get_nowait()
+            except Empty:
+                break
+
+            self.control_latency = time.perf_counter() - t_submit
+            telemetry = get_telemetry()
+            telemetry.latency('control_latency', self.control_latency)
+            with telemetry.stage('control'):
+                function(*args)
+            n += 1
+
+            self.controls_applied += 1
+
+        return n
+
+    def run(self):
+        """Capture frames and apply controls until the thread is stopped. """
+
+        logging.info(f'Starting {self}')
+        self._running = True
+
+        try:
+            while self._running:
+                if self._active():
+                    self._apply_controls()
+                    if self._running and self._active():
+                        self._capture()
+                        self.frames += 1
+                else:
+                    self._apply_controls(self._idle_timeout())
+                    if self._running:
+                        self._idle()
+        except Exception as e:
+            logging.exception(f'{self} stopped due to an exception')
+            self.error = e
+        finally:
+            self._running = False
+            # Wake up everyone waiting for the thread
+            self._sentinel_writer.send(None)
+
+        logging.info(f'Stopped {self}')
+
+    def __repr__(self) -> str:
+        return f'AcquisitionThread({self.name})'
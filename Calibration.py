@@ -0,0 +1,505 @@
+from collections import namedtuple, OrderedDict
+from astropy.io import fits
+from ImageData import load_fits, FitsStreamWriter, FitsCompressedWriter
+import numpy as np
+import hashlib
+import logging
+import os
+
+
+# Kinds of master frames. Darks include the bias, the hot pixel map is derived from the dark
+MASTER_KINDS = ('bias', 'dark', 'flat', 'hot')
+
+# Methods for combining a stack of frames into a master frame
+COMBINE_METHODS = ('median', 'clipped_mean')
+
+# Size of the bands of rows of a stack which are combined at once (in bytes of float32 pixels)
+MASTER_BAND_BYTES = 2**27
+
+# Pixels of a dark more than HOT_PIXEL_THRESHOLD standard deviations (estimated from the MAD) above its median are hot
+HOT_PIXEL_THRESHOLD = 6.0
+
+# Sensor temperatures are matched in steps of TEMP_STEP (in °C)
+TEMP_STEP = 1.0
+
+# Size of the float32 buffer used for calibrating stacks of frames (in bytes)
+WORK_BYTES = 2**24
+
+# Conditions under which frames were taken. The origin is the top left corner of the frames in unbinned sensor pixels,
+# the shape is the one of the (binned) frames and the bit depth is the one of the frame data type (8 or 16)
+CalibrationKey = namedtuple('CalibrationKey', ['exp_time', 'temperature', 'origin', 'shape', 'binning', 'bit_depth'])
+
+# Fields of the key a master frame depends on (the others are None)
+KIND_FIELDS = {
+    'bias': ('temperature', 'origin', 'shape', 'binning', 'bit_depth'),
+    'dark': CalibrationKey._fields,
+    'hot': CalibrationKey._fields,
+    'flat': ('origin', 'shape', 'binning', 'bit_depth'),
+}
+
+# Header entries of the key in master files and recordings
+_KEY_CARDS = (('exp_time', 'exp_time'), ('temperature', 'CCD-TEMP'), ('binning', 'XBINNING'), ('bit_depth', 'FRMBITS'))
+
+
+def clipped_mean(stack: np.ndarray, sigma: float = 3.0, iterations: int = 5) -> np.ndarray:
+    """Mean over the first axis of a stack, rejecting values more than sigma standard deviations from the mean.
+
+    The first iteration clips around the median (with the standard deviation estimated from the MAD), so outliers like
+    cosmic rays do not shift the first estimate. Iterating stops once no more values are rejected.
+    """
+
+    center = np.median(stack, axis=0)
+    deviation = np.abs(stack - center)
+    spread = 1.4826 * np.median(deviation, axis=0)
+    count = None
+    for _ in range(iterations):
+        keep = deviation <= sigma * spread
+        new_count = keep.sum(axis=0)
+        # Never reject all values of a pixel (e.g., if all frames are equal)
+        empty = new_count == 0
+        if np.any(empty):
+            keep[:, empty] = True
+            new_count[empty] = len(stack)
+        if count is not None and np.array_equal(new_count, count):
+            break
+        count = new_count
+        mean = np.sum(stack, axis=0, where=keep, dtype=np.float64) / count
+        np.subtract(stack, mean.astype(stack.dtype), out=deviation)
+        spread = np.sqrt(np.sum(np.square(deviation), axis=0, where=keep, dtype=np.float64) / np.maximum(count - 1, 1))
+        np.abs(deviation, out=deviation)
+
+    return mean
+
+
+def combine_frames(frames, method: str = 'median', sigma: float = 3.0, max_bytes: int = MASTER_BAND_BYTES) -> np.ndarray:
+    """Combine a stack of frames into a master frame.
+
+    The stack is combined in bands of rows, so only max_bytes of it have to be in memory at once. Every pixel depends
+    only on its own values, so the result is the same as combining the whole stack.
+
+    # Arguments
+    * frames - Stack of frames (n, height, width) supporting frames[:, r0:r1], e.g., an array or a FitsRecording.
+    * method::str - 'median' or 'clipped_mean' (see clipped_mean).
+    * sigma::float - Clipping threshold of 'clipped_mean' in standard deviations.
+    * max_bytes::int - Size of the bands (in bytes of float32 pixels).
+
+    # Returns
+    * master::np.ndarray - Master frame (height, width) as float32.
+    """
+
+    if method not in COMBINE_METHODS:
+        raise ValueError(f'Method {method} not known.')
+
+    n, h, w = frames.shape
+    if n == 0:
+        raise ValueError('No frames to combine.')
+
+    rows = max(1, int(max_bytes // (n * w * 4)))
+    master = np.empty((h, w), dtype=np.float32)
+    for r0 in range(0, h, rows):
+        band = np.asarray(frames[:, r0:r0 + rows], dtype=np.float32)
+        if method == 'median':
+            master[r0:r0 + rows] = np.median(band, axis=0)
+        else:
+            master[r0:r0 + rows] = clipped_mean(band, sigma)
+
+    return master
+
+
+def hot_pixel_map(dark: np.ndarray, threshold: float = HOT_PIXEL_THRESHOLD) -> np.ndarray:
+    """Find the pixels of a master dark more than threshold standard deviations above its median. """
+
+    level = np.median(dark)
+    sigma = 1.4826 * np.median(np.abs(dark - level)) or np.std(dark)
+
+    return dark > level + threshold * sigma
+
+
+class Calibration:
+    """Dark (or bias) subtraction, flat field division and hot pixel replacement as a single vectorized step.
+
+    The frames are converted to float32 once, then out = frames * gain + offset with the gain (1 / flat) and the offset
+    (-dark * gain) precomputed, hot pixels are replaced by the mean of their left and right neighbours and integer
+    frames are rounded and clipped to the range of their data type.
+    """
+
+    def __init__(self, dark: np.ndarray = None, flat: np.ndarray = None, hot: np.ndarray = None, sources: dict = None):
+        """Constructor.
+
+        # Arguments
+        * dark::np.ndarray - Master dark or bias (None to not subtract anything).
+        * flat::np.ndarray - Master flat normalized to 1 (None to not correct the flat field).
+        * hot::np.ndarray - Boolean map of the hot pixels (None to not replace pixels).
+        * sources::dict - File names of the master frames by kind (for logging).
+        """
+
+        masters = [master for master in (dark, flat, hot) if master is not None]
+        if not masters:
+            raise ValueError('No master frames given.')
+        self.shape = masters[0].shape
+        if any(master.shape != self.shape for master in masters):
+            raise ValueError(f'Master frames have different shapes {[master.shape for master in masters]}.')
+        self.sources = sources or {}
+
+        offset = np.zeros(self.shape, dtype=np.float32) if dark is None else -np.asarray(dark, dtype=np.float32)
+        if flat is None:
+            self.gain = None
+        else:
+            flat = np.asarray(flat, dtype=np.float32)
+            # Pixels without signal in the flat are left as they are
+            self.gain = np.where(flat > 0, 1 / np.where(flat > 0, flat, 1), 1).astype(np.float32)
+            offset *= self.gain
+        # Integer frames are rounded by adding 0.5 before truncating
+        self._offsets = {False: offset, True: offset + np.float32(0.5)}
+
+        # Flat indices of the hot pixels and of their neighbours in the same row
+        self.hot = np.flatnonzero(hot) if hot is not None and self.shape[1] > 1 else np.empty(0, dtype=np.intp)
+        x = self.hot % self.shape[1]
+        self._left = np.where(x > 0, self.hot - 1, self.hot + 1)
+        self._right = np.where(x < self.shape[1] - 1, self.hot + 1, self.hot - 1)
+
+        self._work = None
+
+    def __call__(self, frames: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Calibrate a frame (height, width) or a stack of frames (n, height, width).
+
+        # Arguments
+        * frames::np.ndarray - Frames to calibrate.
+        * out::np.ndarray - Array of the same shape receiving the result (may be frames itself, None to allocate it
+                            with the data type of frames).
+        """
+
+        frames = np.asarray(frames)
+        if frames.shape[-2:] != self.shape:
+            raise ValueError(f'Frames of shape {frames.shape} do not match the master frames {self.shape}.')
+        if out is None:
+            out = np.empty_like(frames)
+
+        if frames.ndim == 2:
+            self._apply(frames, out)
+        else:
+            # Calibrate several frames at once, as many as fit into the work buffer
+            step = max(1, WORK_BYTES // (frames[0].size * 4))
+            for i in range(0, len(frames), step):
+                self._apply(frames[i:i + step], out[i:i + step])
+
+        return out
+
+    def _apply(self, frames: np.ndarray, out: np.ndarray):
+        """Calibrate frames into out. """
+
+        size = frames.size
+        if self._work is None or self._work.size < size:
+            self._work = np.empty(size, dtype=np.float32)
+        work = self._work[:size].reshape(frames.shape)
+
+        integer = out.dtype.kind in 'ui'
+        offset = self._offsets[integer]
+        if self.gain is None:
+            np.add(frames, offset, out=work, dtype=np.float32)
+        else:
+            np.multiply(frames, self.gain, out=work, dtype=np.float32)
+            np.add(work, offset, out=work)
+
+        if len(self.hot):
+            pixels = work.reshape(-1, self.shape[0] * self.shape[1])
+            pixels[:, self.hot] = 0.5 * (pixels[:, self._left] + pixels[:, self._right])
+
+        if integer:
+            info = np.iinfo(out.dtype)
+            np.clip(work, info.min, info.max, out=work)
+        np.copyto(out, work, casting='unsafe')
+
+    def __repr__(self) -> str:
+        kinds = ', '.join(self.sources) or 'no masters'
+        return f'Calibration({kinds}, {len(self.hot)} hot pixels)'
+
+
+class CalibrationLibrary:
+    """Master frames cached on disk and in memory, looked up by the conditions under which frames were taken.
+
+    Every master is a FITS file in directory named after its kind and key (see KIND_FIELDS). A master taken with a
+    larger ROI (at the same binning) is cropped to smaller ROIs, so masters of the full sensor apply to every ROI.
+    """
+
+    def __init__(self, directory: str, temp_step: float = TEMP_STEP, max_cached: int = 8):
+        """Constructor.
+
+        # Arguments
+        * directory::str - Directory of the master files.
+        * temp_step::float - Temperatures are rounded to multiples of temp_step for matching masters (in °C).
+        * max_cached::int - Number of master frames and calibrations kept in memory.
+        """
+
+        self.directory = directory
+        self.temp_step = temp_step
+        self.max_cached = max_cached
+
+        # Master files by kind and key, master frames by file name and calibrations by key
+        self._index = {kind: {} for kind in MASTER_KINDS}
+        self._masters = OrderedDict()
+        self._calibrations = OrderedDict()
+
+        # Number of masters which were built and which were already on disk
+        self.built = 0
+        self.reused = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def make_key(self, exp_time: float = None, temperature: float = None, origin: tuple = (0, 0), shape: tuple = None,
+                 binning: int = 1, bit_depth: int = None) -> CalibrationKey:
+        """Create a key with the exposure time rounded to µs and the temperature rounded to temp_step. """
+
+        if exp_time is not None:
+            exp_time = round(float(exp_time), 6)
+        if temperature is not None:
+            temperature = round(round(float(temperature) / self.temp_step) * self.temp_step, 3)
+
+        return CalibrationKey(exp_time, temperature, tuple(int(v) for v in origin), tuple(int(v) for v in shape), int(binning or 1), bit_depth and int(bit_depth))
+
+    def key_from_header(self, header, shape: tuple, dtype) -> CalibrationKey:
+        """Get the key of frames of the given shape and data type from a FITS header. """
+
+        return self.make_key(
+            exp_time=header.get('exp_time'),
+            temperature=header.get('CCD-TEMP'),
+            origin=(header.get('XORGSUBF', 0), header.get('YORGSUBF', 0)),
+            shape=shape[-2:],
+            binning=header.get('XBINNING', 1),
+            bit_depth=8 * np.dtype(dtype).itemsize,
+        )
+
+    @staticmethod
+    def kind_key(kind: str, key: CalibrationKey) -> CalibrationKey:
+        """Get the part of a key a master of kind depends on. """
+
+        return CalibrationKey(*(value if field in KIND_FIELDS[kind] else None for field, value in zip(CalibrationKey._fields, key)))
+
+    def path(self, kind: str, key: CalibrationKey) -> str:
+        """File name of a master. """
+
+        digest = hashlib.sha1(repr(self.kind_key(kind, key)).encode()).hexdigest()[:12]
+        return os.path.join(self.directory, f'{kind}_{digest}.fits')
+
+    def scan(self):
+        """Index the master files in the directory. """
+
+        for kind in MASTER_KINDS:
+            self._index[kind] = {}
+
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.fits'):
+                continue
+            file_name = os.path.join(self.directory, name)
+            try:
+                header = fits.getheader(file_name)
+            except OSError:
+                continue
+            kind = header.get('CALKIND')
+            if kind in self._index:
+                key = self.key_from_header(header, (header['NAXIS2'], header['NAXIS1']), np.dtype(f"u{header['FRMBITS'] // 8}"))
+                self._index[kind][self.kind_key(kind, key)] = file_name
+
+    def find(self, kind: str, key: CalibrationKey):
+        """Find a master for frames with the given key.
+
+        # Returns
+        * file_name::str - File name of the master or None if there is none.
+        * crop::tuple - Slices of the master which cover the frames.
+        """
+
+        key = self.kind_key(kind, key)
+        if key in self._index[kind]:
+            return self._index[kind][key], (slice(None), slice(None))
+
+        # Look for a master with a larger ROI containing the frames
+        (x, y), (h, w), binning = key.origin, key.shape, key.binning
+        for master_key, file_name in self._index[kind].items():
+            if master_key._replace(origin=None, shape=None) != key._replace(origin=None, shape=None):
+                continue
+            (mx, my), (mh, mw) = master_key.origin, master_key.shape
+            dx, rx = divmod(x - mx, binning)
+            dy, ry = divmod(y - my, binning)
+            if rx == 0 and ry == 0 and 0 <= dx and dx + w <= mw and 0 <= dy and dy + h <= mh:
+                return file_name, (slice(dy, dy + h), slice(dx, dx + w))
+
+        return None, None
+
+    def master(self, kind: str, key: CalibrationKey) -> np.ndarray:
+        """Get a master for frames with the given key from memory or disk (None if there is none). """
+
+        file_name, crop = self.find(kind, key)
+        if file_name is None:
+            return None
+
+        if file_name not in self._masters:
+            self._masters[file_name] = fits.getdata(file_name)
+            while len(self._masters) > self.max_cached:
+                self._masters.popitem(last=False)
+        self._masters.move_to_end(file_name)
+
+        return self._masters[file_name][crop]
+
+    def save(self, kind: str, key: CalibrationKey, data: np.ndarray, n_frames: int = None, method: str = None) -> str:
+        """Save a master to disk and add it to the index. """
+
+        key = self.kind_key(kind, key)
+        if key.bit_depth is None:
+            raise ValueError(f'{kind} master needs the bit depth of the frames.')
+
+        header = fits.Header([('CALKIND', kind, 'Kind of master frame'), ('NCOMBINE', n_frames, 'Number of frames combined'),
+                              ('COMBINE', method, 'Method of combining the frames')])
+        for field, card in _KEY_CARDS:
+            value = getattr(key, field)
+            if value is not None:
+                header[card] = value
+        if key.origin is not None:
+            header['XORGSUBF'], header['YORGSUBF'] = key.origin
+
+        file_name = self.path(kind, key)
+        fits.PrimaryHDU(data, header=header).writeto(file_name, overwrite=True)
+        self._index[kind][key] = file_name
+        self._masters.pop(file_name, None)
+        # Calibrations built from the previous masters are outdated
+        self._calibrations.clear()
+
+        logging.info(f'{self} saved {kind} master {file_name}.')
+        return file_name
+
+    def build(self, kind: str, frames, key: CalibrationKey = None, method: str = 'median', sigma: float = 3.0,
+              rebuild: bool = False, max_bytes: int = MASTER_BAND_BYTES) -> str:
+        """Build a master from a stack of frames and save it, unless a master for the key is already on disk.
+
+        Darks also produce a hot pixel map. Flats are corrected by the dark (or bias) for their key and normalized to
+        a median of 1.
+
+        # Arguments
+        * kind::str - 'bias', 'dark' or 'flat'.
+        * frames - Stack of frames (n, height, width), e.g., an array or a FitsRecording (combined in bands, see
+                   combine_frames).
+        * key::CalibrationKey - Conditions of the frames (None to take them from the header of a FitsRecording).
+        * method::str - 'median' or 'clipped_mean'.
+        * sigma::float - Clipping threshold of 'clipped_mean'.
+        * rebuild::bool - Build the master even if it is on disk.
+        * max_bytes::int - Size of the bands of frames combined at once.
+
+        # Returns
+        * file_name::str - File name of the master.
+        """
+
+        if kind not in ('bias', 'dark', 'flat'):
+            raise ValueError(f'Cannot build {kind} masters from frames.')
+        if key is None:
+            key = self.key_from_header(frames.header, frames.shape, frames.dtype)
+
+        file_name = self.path(kind, key)
+        if not rebuild and self.kind_key(kind, key) in self._index[kind]:
+            self.reused += 1
+            logging.info(f'{self} reuses {kind} master {file_name}.')
+            return file_name
+
+        master = combine_frames(frames, method, sigma, max_bytes)
+        if kind == 'flat':
+            dark = self.master('dark', key)
+            if dark is None:
+                dark = self.master('bias', key)
+            if dark is None:
+                logging.warning(f'{self} has no dark or bias for the flat {key}.')
+            else:
+                master -= dark
+            master /= np.median(master)
+        file_name = self.save(kind, key, master, len(frames), method)
+        if kind == 'dark':
+            self.save('hot', key, hot_pixel_map(master).astype(np.uint8), len(frames), method)
+        self.built += 1
+
+        return file_name
+
+    def calibration(self, key: CalibrationKey) -> Calibration:
+        """Get the calibration of frames with the given key (None if there are no masters for it). """
+
+        if key in self._calibrations:
+            self._calibrations.move_to_end(key)
+            return self._calibrations[key]
+
+        masters, sources = {}, {}
+        for kind in MASTER_KINDS:
+            masters[kind] = self.master(kind, key)
+            if masters[kind] is not None:
+                sources[kind] = os.path.basename(self.find(kind, key)[0])
+        # The dark includes the bias
+        if masters['dark'] is not None:
+            sources.pop('bias', None)
+        dark = masters['dark'] if masters['dark'] is not None else masters['bias']
+
+        if dark is None and masters['flat'] is None and masters['hot'] is None:
+            calibration = None
+        else:
+            calibration = Calibration(dark, masters['flat'], masters['hot'], sources)
+
+        self._calibrations[key] = calibration
+        while len(self._calibrations) > self.max_cached:
+            self._calibrations.popitem(last=False)
+
+        return calibration
+
+    def __repr__(self) -> str:
+        return f'CalibrationLibrary({self.directory})'
+
+
+def calibrate_recording(file_name: str, library: CalibrationLibrary, out_file: str, compression: dict = None, chunk_frames: int = 100):
+    """Calibrate a recording with the masters of a library and write it to a new file.
+
+    # Arguments
+    * file_name::str - FITS file of the recording.
+    * library::CalibrationLibrary - Library with masters for the recording.
+    * out_file::str - FITS file of the calibrated recording.
+    * compression::dict - Arguments of FitsCompressedWriter (None for an uncompressed file).
+    * chunk_frames::int - Number of frames calibrated at once.
+    """
+
+    with load_fits(file_name) as rec:
+        if rec.header.get('CALIBRAT'):
+            raise ValueError(f'{file_name} is already calibrated.')
+
+        calibration = library.calibration(library.key_from_header(rec.header, rec.shape, rec.dtype))
+        if calibration is None:
+            raise ValueError(f'{library} has no masters for {file_name}.')
+
+        # Keep the header entries of the recording which are not about the data layout
+        structural = ('SIMPLE', 'BITPIX', 'EXTEND', 'BZERO', 'BSCALE', 'DATAMIN', 'DATAMAX', 'NFRAMES')
+        header = {key: value for key, value in rec.header.items() if key not in structural and not key.startswith('NAXIS')}
+        header['CALIBRAT'] = True
+
+        meta = rec.metadata
+        if compression is None:
+            writer = FitsStreamWriter(out_file, header)
+        else:
+            writer = FitsCompressedWriter(out_file, header, **compression)
+        with writer:
+            for i in range(0, len(rec), chunk_frames):
+                frames = rec[i:i + chunk_frames]
+                chunk_meta = {} if meta is None else {name: meta[name][i:i + chunk_frames] for name in meta.dtype.names}
+                writer.append(calibration(frames, out=frames), **chunk_meta)
+
+    logging.info(f'Calibrated {file_name} with {calibration} into {out_file}.')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build master frames from recordings.')
+    parser.add_argument('directory', help='Directory of the master frames')
+    parser.add_argument('kind', choices=('bias', 'dark', 'flat'))
+    parser.add_argument('files', nargs='+', help='FITS files of the recordings')
+    parser.add_argument('--method', choices=COMBINE_METHODS, default='median')
+    parser.add_argument('--sigma', type=float, default=3.0)
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild masters which are already on disk')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    library = CalibrationLibrary(args.directory)
+    for file_name in args.files:
+        with load_fits(file_name) as rec:
+            library.build(args.kind, rec, method=args.method, sigma=args.sigma, rebuild=args.rebuild)
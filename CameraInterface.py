@@ -0,0 +1,598 @@
+"""Qt interface to a camera subprocess (see SubprocessZwoMini.CameraSubprocess).
+
+Kept apart from the subprocess, so the camera subprocess and headless tools (see capture_daemon.py) do not load Qt.
+"""
+from ZwoCamera import ASI_IMG_RAW8, IMAGE_TYPE_DTYPES
+from CameraModels import CAMERA_MODELS, readout_frame_time
+from Subprocess import Interface
+from SubprocessHeader import *
+from SubprocessZwoMini import CameraSubprocess, CAMERA_UIDS, DEFAULT_IMAGE_TYPES, IMAGE_TYPE_NAMES
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import QTimer
+import time
+from RoiWarningDialog import RoiWarningDialog
+from FrameBuffer import FrameRingReader
+from Preview import PreviewRenderer
+from Telemetry import get_telemetry, export_json, export_csv
+import numpy as np
+
+
+# Time the GUI waits for further changes before applying a configuration (in ms)
+CONFIG_DEBOUNCE_MS = 300
+
+
+class CameraInterface(Interface):
+    def __init__(self, camera_type, image_label, settings_window, streaming_button, rec_button, settings_button, fps_display, image_interface=None):
+        """Constructor. camera_type: ZWO ASI120MM Mini or ZWO ASI174MM-Cool. Recordings are passed on to
+        image_interface (an ImageInterface) for processing and discarded if it is None.
+        """
+
+        if camera_type not in CAMERA_UIDS:
+            raise NotImplementedError(f'{camera_type} not known.')
+
+        super().__init__(CAMERA_UIDS[camera_type])
+
+        # Initialize GUI elements for controling the camera
+
+        # Initialize the GUI element for displaying the camera image
+        self.image_label = image_label
+        self.streaming_button = streaming_button
+        self.recording_button = rec_button
+        self.settings_button = settings_button
+        self.fps_display = fps_display
+
+        # Settings window
+        self.settings_window = settings_window
+        self.settings_window.connect_signals(self.schedule_config, self.schedule_config, self.set_temperature, self.set_stretch, self.schedule_config, self.schedule_config)
+
+        # Changes in the settings window are collected and applied together once the user stopped editing
+        self._config_timer = QTimer()
+        self._config_timer.setSingleShot(True)
+        self._config_timer.setInterval(CONFIG_DEBOUNCE_MS)
+        self._config_timer.timeout.connect(self.apply_config)
+
+        # Signals
+        self.streaming_button.clicked.connect(self.toggle_streaming_mode)
+        self.recording_button.clicked.connect(self.toggle_recording_mode)     
+        self.settings_button.clicked.connect(self.toggle_settings) 
+
+        # Camera time
+        self._camera_type = camera_type
+
+        # Camera state
+        self._camera_state = None
+
+        # Show warning for large ROIs
+        self._warn_large_roi = True
+
+        # Image type and bit depth of the camera (updated by the subprocess)
+        self._image_type = DEFAULT_IMAGE_TYPES.get(camera_type, ASI_IMG_RAW8)
+        self._bit_depth = None
+        self.settings_window.set_image_type(IMAGE_TYPE_NAMES[self._image_type])
+
+        # Access to the frames in the shared memory ring of the subprocess
+        self.frame_reader = FrameRingReader()
+
+        # Processes the recordings (recordings are only released if there is none)
+        self.image_interface = image_interface
+        self.rec_reader = FrameRingReader()
+
+        # Frame timing report of the last capture session
+        self.timing_report = None
+
+        # Last telemetry snapshot (see get_stats)
+        self.stats = None
+
+        # Last batch of star centroids (see set_centroiding)
+        self.centroids = None
+
+        # Master frames the subprocess calibrates with (see set_calibration)
+        self.calibration = None
+
+        # File of the last stack saved by the subprocess (see save_stack)
+        self.stack_file = None
+
+        # Renders the frames into previews of the size of the image label
+        self.preview = PreviewRenderer(self.image_label.width(), self.image_label.height(), self.settings_window.get_stretch())
+        self._preview_image = None
+
+    def toggle_controls(self, state: bool):
+        """Enable or disable the controls. """
+
+        self.streaming_button.setEnabled(state)
+        self.recording_button.setEnabled(state)
+        self.settings_button.setEnabled(state)
+        self.fps_display.setEnabled(state)
+
+    def toggle_streaming_mode(self):
+        if self._camera_state == CMD_CAMERA_MODE_STOP or self._camera_state == CMD_CAMERA_REC_MODE:
+            self.set_continuous_mode()
+        else:
+            self.stop_recording()
+
+    def toggle_recording_mode(self):
+        if self._camera_state == CMD_CAMERA_MODE_STOP or self._camera_state == CMD_CAMERA_CONTINOUS_MODE:
+            self.set_rec_mode()
+        else:
+            self.stop_recording()
+
+    def toggle_settings(self):
+        if not self.settings_window.isVisible():
+            self.settings_window.show()
+
+    def load_camera_settings(self):
+        self.get_config()
+
+    def init_subprocess(self):
+        """Overwrite the parent function for initializing the subprocess. """
+
+        return CameraSubprocess(self.uid, self._camera_type, self.com_queue, self.res_queue, image_type=self._image_type)
+
+    def crash_cleanup(self):
+        """Handle a crashed subprocess. """
+
+        logging.info(f'subprocess {self.subprocess} crashed. {self} resetting GUI.')
+        # Cleanly stop the subprocess
+        self.subprocess.join()
+        self.subprocess = None
+
+        # Detach from the frame ring
+        self.frame_reader.close()
+        self.rec_reader.close()
+
+        # Disable the GUI elements
+        self.toggle_controls(False)
+
+    def stop_subprocess(self, timeout=0.05):
+        """Extend stopping the subprocess by detaching from its frame ring. """
+
+        super().stop_subprocess(timeout)
+        self.frame_reader.close()
+        self.rec_reader.close()
+
+    def handle_data(self, data):
+        """Handle data sent back from the camera subprocess. """
+
+        cmd = data[0]
+
+        if cmd == CMD_DISPLAY_IMAGE:
+            self.display_frame(data[1])
+        elif cmd == CMD_CAMERA_GET_EXP:
+            self.display_exp_time(data[1])
+        elif cmd == CMD_CAMERA_GET_ROI:
+            self.update_roi(*data[1])
+        elif cmd == CMD_CAMERA_GET_TEMP:
+            self.update_temperature(data[1])
+        elif cmd == CMD_CAMERA_GET_FPS:
+            self.update_fps_dispaly(data[1])
+        elif cmd == CMD_CAMERA_OVERRUN:
+            self.update_overruns(data[1])
+        elif cmd == CMD_CAMERA_DISPLAY_SKIPPED:
+            self.update_display_skipped(*data[1])
+        elif cmd == CMD_CAMERA_GET_IMAGE_TYPE:
+            self.update_image_type(*data[1])
+        elif cmd == CMD_CAMERA_GET_TIMING:
+            self.update_timing(data[1])
+        elif cmd == CMD_CAMERA_GET_CONFIG:
+            self.update_config(data[1])
+        elif cmd == CMD_CAMERA_CENTROIDS:
+            self.update_centroids(data[1])
+        elif cmd == CMD_CAMERA_SET_CALIBRATION:
+            self.update_calibration(data[1])
+        elif cmd == CMD_CAMERA_SAVE_STACK:
+            self.update_stack_file(data[1])
+        elif cmd == CMD_CAMERA_GET_CAPTURE_STATS:
+            logging.info(f'{self} capture stats of {self.subprocess}: {data[1]}')
+        elif cmd == CMD_RETURN_REC:
+            self.receive_recording(*data[1:])
+        elif cmd == CMD_GET_STATS:
+            self.update_stats(data[1])
+        elif cmd == CMD_STOP_SUBPROCESS:
+            self.crash_cleanup()
+        else:
+            raise NotImplementedError(f'{cmd}')
+
+    def display_frame(self, ref):
+        """Display a frame from the shared memory ring and hand its slot back to the subprocess. """
+
+        image_data = self.frame_reader.get(ref)
+        if image_data is None:
+            return
+
+        telemetry = get_telemetry()
+        try:
+            with telemetry.stage('display'):
+                self.display_image(image_data)
+        finally:
+            # Drop the view before giving the slot back
+            del image_data
+            self.frame_reader.release(ref)
+
+        if ref.info is not None:
+            # Both processes use the same monotonic clock
+            telemetry.latency(f'capture_to_display {self.uid:#x}', (time.perf_counter_ns() - ref.info.t_ns) * 1e-9)
+
+    def display_image(self, image_data):
+        """Display an image. """
+
+        # Downsample and stretch into an 8 bit preview which keeps the aspect ratio
+        self.preview.set_output_size(self.image_label.width(), self.image_label.height())
+        preview = self.preview.render(image_data)
+        h, w = preview.shape
+
+        # Generate QImage object directly from the preview buffer (the QImage must not outlive it)
+        qimage = QImage(preview.data, w, h, preview.strides[0], QImage.Format_Grayscale8)
+        # Transform it to QPixmap object (copies the data)
+        qpixmap = QPixmap.fromImage(qimage)
+        # Display the image
+        self.image_label.setPixmap(qpixmap)
+
+    def set_stretch(self, stretch: str):
+        """Set the stretch applied to the displayed images. """
+
+        logging.debug(f'{self} set display stretch to {stretch}.')
+        self.preview.stretch = stretch
+
+    def get_preview_cost(self) -> float:
+        """Get the average time for rendering a preview (in s). """
+
+        return self.preview.mean_cost
+
+    def display_exp_time(self, val):
+        """Display the exposure time in the GUI. """
+
+        logging.debug(f'{self} received exposure {val * 1e6} us from {self.subprocess}.')
+        self.settings_window.set_exp_time(val)
+
+    def update_roi(self, offset_x, roi_width, offset_y, roi_height, sensor_w, sensor_h):
+        """Update the GUI with current ROI values.
+        
+        # Arguments
+        * offset_x::int - Offset from the sensor center in x.
+        * roi_width::int -  Width of the ROI.
+        * offset_y::int - Offset from the sensor center in y.
+        * roi_height::int - Height of the ROI.
+        * sensor_w::int - Width of the camera sensor.
+        * sensor_h::int - Height of the camera sensor.
+        """
+        
+        # Log values
+        logging.debug(f'{self} updates ROI to {offset_x}, {roi_width}, {offset_y}, {roi_height}.')
+
+
+        # Update GUI
+        self.settings_window.set_roi_values(offset_x, roi_width, offset_y, roi_height, sensor_w, sensor_h)
+
+    def set_temperature(self):
+        """Set the temperature of the camera. """
+
+        try:
+            temperature = self.settings_window.get_temperature()
+            logging.debug(f'{self} setting temperature to {temperature}.')
+            self.com_queue.put((CMD_CAMERA_SET_TEMP, temperature))
+        except ValueError as e:
+            logging.info(f'{e}')
+
+    def update_temperature(self, val):
+
+        logging.debug(f'{self} updates camera temperature display to {val}.')
+
+        self.settings_window.update_temperature(val)
+        
+
+    def get_exp_time(self):
+        """Query the exposure time from the subprocess. """
+
+        logging.debug(f'{self} querying exposure time.')
+        self.com_queue.put((CMD_CAMERA_GET_EXP, ))
+
+    def set_exp_time(self):
+        """Set the exposure time of the camera. """
+
+        try:
+            exp_time = self.settings_window.get_exp_time()
+            logging.debug(f'{self} setting exposure time to {exp_time * 1e6} us.')
+            self.com_queue.put((CMD_CAMERA_SET_EXP, exp_time))
+        except ValueError as e:
+            logging.info(f'{e}')
+
+    def update_fps_dispaly(self, fps):
+        self.fps_display.setText(f'{fps:.0f} FPS')
+
+    def update_overruns(self, overruns):
+        """Show the number of frames dropped because the GUI could not keep up. """
+
+        logging.info(f'{self} is falling behind, {overruns} frames dropped by {self.subprocess}.')
+        self.fps_display.setToolTip(f'{overruns} frames dropped')
+
+    def update_display_skipped(self, shown, skipped):
+        """Show how many frames were captured but not displayed. """
+
+        logging.debug(f'{self} displayed {shown} frames, skipped {skipped} frames, rendering took {self.preview.mean_cost * 1e3:.2f} ms per frame.')
+        self.fps_display.setToolTip(f'{shown} frames displayed, {skipped} frames skipped, {self.preview.mean_cost * 1e3:.1f} ms per frame')
+
+    def set_preview_rate(self, rate: float):
+        """Set the maximum number of frames per second displayed (None for no limit). """
+
+        self.com_queue.put((CMD_CAMERA_SET_PREVIEW_RATE, rate))
+    
+    def set_roi(self):
+        """Set the ROI. 
+
+        # Arguments
+        * offset_x::int - Offset from the sensor center in x.
+        * roi_width::int -  Width of the ROI.
+        * offset_y::int - Offset from the sensor center in y.
+        * roi_height::int - Height of the ROI.
+        """
+        try:
+            roi = self.settings_window.get_roi_values()
+            #print(roi)
+
+            self.com_queue.put((CMD_CAMERA_SET_ROI, roi))
+        except AssertionError as e:
+            print(e)
+
+        self.get_roi()
+
+    def get_roi(self):
+        """Get the ROI. """
+
+        logging.debug(f'{self} getting ROI')
+        self.com_queue.put((CMD_CAMERA_GET_ROI, ))
+
+    def set_image_type(self, name: str):
+        """Set the image type selected in the settings window ('RAW8' or 'RAW16'). """
+
+        image_type = {v: k for k, v in IMAGE_TYPE_NAMES.items()}[name]
+        if image_type != self._image_type:
+            self.com_queue.put((CMD_CAMERA_SET_IMAGE_TYPE, image_type))
+
+    def schedule_config(self, *args):
+        """Apply the settings after the user stopped editing for CONFIG_DEBOUNCE_MS. """
+
+        self._config_timer.start()
+
+    def apply_config(self):
+        """Send all settings of the settings window to the subprocess at once. Settings with invalid values are not
+        sent.
+        """
+
+        config = {'image_type': {v: k for k, v in IMAGE_TYPE_NAMES.items()}[self.settings_window.get_image_type()]}
+
+        # Bin either in the camera or in the subprocess
+        factor, mode = self.settings_window.get_binning()
+        if mode == 'camera':
+            config.update(bins=factor, soft_bins=1)
+        else:
+            config.update(bins=1, soft_bins=factor, soft_bin_method=mode)
+        try:
+            config['exp_time'] = self.settings_window.get_exp_time()
+        except ValueError as e:
+            logging.info(f'{e}')
+        try:
+            config['roi'] = self.settings_window.get_roi_values()
+        except AssertionError as e:
+            logging.info(f'{e}')
+
+        logging.debug(f'{self} applying configuration {config}.')
+        self.com_queue.put((CMD_CAMERA_APPLY_CONFIG, config))
+
+    def get_config(self):
+        """Query all settings from the subprocess. """
+
+        self.com_queue.put((CMD_CAMERA_GET_CONFIG, ))
+
+    def update_config(self, config: dict):
+        """Update the GUI with the settings used by the camera. """
+
+        self.display_exp_time(config['exp_time'])
+        self.update_roi(*config['roi'], config['sensor_w'], config['sensor_h'])
+        self.update_image_type(config['image_type'], config['bit_depth'])
+
+        if config['soft_bins'] > 1:
+            self.settings_window.set_binning(config['soft_bins'], config['soft_bin_method'], config['supported_bins'])
+        else:
+            self.settings_window.set_binning(config['bins'], 'camera', config['supported_bins'])
+        # Summed frames may have more than 16 bits
+        self.preview.value_bits = config['frame_bits']
+
+    def update_image_type(self, image_type: int, bit_depth: int):
+        """Update the GUI with the image type used by the camera. """
+
+        logging.debug(f'{self} received image type {IMAGE_TYPE_NAMES[image_type]} ({bit_depth} bit) from {self.subprocess}.')
+        self._image_type = image_type
+        self._bit_depth = bit_depth
+        self.settings_window.set_image_type(IMAGE_TYPE_NAMES[image_type])
+
+    def estimate_frame_rate(self, width: int, height: int) -> tuple:
+        """Estimate the frame rate and the data rate (in bytes per second) of a ROI with the current image type from the
+        approximate readout model of the camera (see CameraModels).
+        """
+
+        frame_time = readout_frame_time(CAMERA_MODELS[self._camera_type], width, height, self._image_type)
+        frame_bytes = width * height * IMAGE_TYPE_DTYPES[self._image_type].itemsize
+        return 1 / frame_time, frame_bytes / frame_time
+
+    def set_centroiding(self, options: dict = None):
+        """Let the subprocess send star centroids of every frame instead of frames (options of Centroider, None to
+        stop).
+        """
+
+        self.com_queue.put((CMD_CAMERA_SET_CENTROIDING, options))
+
+    def update_centroids(self, records: np.ndarray):
+        """Store a batch of star centroids (see Centroiding.CENTROID_DTYPE). """
+
+        self.centroids = records
+        telemetry = get_telemetry()
+        telemetry.latency(f'capture_to_centroid {self.uid:#x}', (time.perf_counter_ns() - records['t_ns'][-1]) * 1e-9)
+        for t_ns in records['t_ns']:
+            telemetry.count(f'centroids {self.uid:#x}', int(t_ns))
+
+    def set_calibration(self, directory: str = None):
+        """Let the subprocess calibrate every frame with the master frames in directory (None to stop). """
+
+        self.com_queue.put((CMD_CAMERA_SET_CALIBRATION, directory))
+
+    def update_calibration(self, sources: dict):
+        """Store the master frames the subprocess calibrates with (file names by kind, None if not calibrating). """
+
+        self.calibration = sources
+        logging.info(f'{self} calibrates with {sources}.')
+
+    def set_stacking(self, options: dict = None):
+        """Let the subprocess stack the frames in continuous mode and display the stack (options of LiveStacker, None
+        to stop).
+        """
+
+        self.com_queue.put((CMD_CAMERA_SET_STACKING, options))
+
+    def save_stack(self, file_name: str = ''):
+        """Let the subprocess save the current stack ('' for a generated file name). """
+
+        self.com_queue.put((CMD_CAMERA_SAVE_STACK, file_name))
+
+    def update_stack_file(self, file_name: str):
+        """Store the file of the stack saved by the subprocess (None if it could not be saved). """
+
+        self.stack_file = file_name
+        if file_name is not None:
+            logging.info(f'{self} stack saved to {file_name}.')
+
+    def get_capture_stats(self):
+        """Query the capture and buffer allocation counters from the subprocess. """
+
+        self.com_queue.put((CMD_CAMERA_GET_CAPTURE_STATS, ))
+
+    def receive_recording(self, ref, header: dict, meta: dict):
+        """Pass a recording in the shared memory of the subprocess on to the image processing.
+
+        # Arguments
+        * ref::FrameRef - Reference to the recording (n, height, width).
+        * header::dict - Arguments of ImageData for the header.
+        * meta::dict - Per-frame metadata.
+        """
+
+        # Time from reading out the frames until they arrived in the main process
+        get_telemetry().latency(f'capture_to_main {self.uid:#x}', (time.perf_counter_ns() - meta['T_NS']) * 1e-9)
+
+        if self.image_interface is not None and self.image_interface.subprocess:
+            self.image_interface.process_recording(self.uid, ref, header, meta)
+        else:
+            logging.warning(f'{self} discards a recording since no image processing is running.')
+            self.rec_reader.release(ref)
+
+    def get_stats(self):
+        """Query the telemetry snapshot from the subprocess. The reply is stored in stats together with the
+        telemetry of the main process.
+        """
+
+        self.com_queue.put((CMD_GET_STATS, ))
+
+    def update_stats(self, snapshot: dict):
+        """Store the telemetry of the subprocess and of the main process. """
+
+        self.stats = {
+            'subprocess': snapshot,
+            'main': get_telemetry().snapshot(),
+        }
+        logging.debug(f'{self} received telemetry of {self.subprocess}.')
+
+    def export_stats(self, file_name: str):
+        """Save the last telemetry snapshot as JSON or CSV (depending on the file extension). """
+
+        if self.stats is None:
+            raise ValueError('No telemetry received yet.')
+
+        if file_name.endswith('.csv'):
+            export_csv(self.stats, file_name)
+        else:
+            export_json(self.stats, file_name)
+
+    def get_timing(self):
+        """Query the frame timing report of the current capture session from the subprocess. """
+
+        self.com_queue.put((CMD_CAMERA_GET_TIMING, ))
+
+    def update_timing(self, report: dict):
+        """Store the frame timing report of a capture session. """
+
+        logging.info(f'{self} frame timing of {self.subprocess}: {report}')
+        self.timing_report = report
+
+    def stop_recording(self):
+        logging.info('Stopping all recording')
+
+        # Stop camera
+        self._camera_state = CMD_CAMERA_MODE_STOP
+        self._update_state()
+
+        # Reset buttons
+        self.streaming_button.setText('Start Stream')
+        self.recording_button.setText('Start Recording')
+
+        # Reset FPS dispaly
+        self.update_fps_dispaly(0)
+        
+    def set_continuous_mode(self):
+
+        logging.info('Starting continuous video streaming')
+
+        # Start streaming
+        self._camera_state = CMD_CAMERA_CONTINOUS_MODE
+        self._update_state()
+
+        # Set buttons
+        self.streaming_button.setText('Stop Stream')
+        self.recording_button.setText('Start Recording')
+
+    def set_rec_mode(self):
+
+        logging.info('Starting recording')
+
+        # Get the size of the ROI
+        roi_w = self.settings_window.width_input.value()
+        roi_h = self.settings_window.height_input.value()
+        # Show a warning when it is too large (RAW16 frames need twice the bandwidth)
+        bytes_per_pixel = IMAGE_TYPE_DTYPES[self._image_type].itemsize
+        if roi_h * bytes_per_pixel > 128 and self._warn_large_roi:
+            logging.info('Large ROI height. Showing warning dialog')
+            dialog_window = RoiWarningDialog(roi_h, self.estimate_frame_rate(roi_w, roi_h))
+            answer = dialog_window.exec()
+            dismiss = dialog_window.dismiss_state()
+            self._warn_large_roi = not dismiss
+            logging.debug(f'Dialog window continue: {answer}. Checkbox state {dismiss}.')
+            
+            if not answer:
+                logging.info('Aborting recording')
+                
+                return
+
+            logging.info('Continuing')
+
+        # Start recording
+        self._camera_state = CMD_CAMERA_REC_MODE
+        self._update_state()
+
+        # Set buttons
+        self.streaming_button.setText('Start Stream')
+        self.recording_button.setText('Stop Recording')
+
+    def set_sync_rec_mode(self, start_ns: int, sync_id: str):
+        """Start recording together with other cameras (see SyncCapture). The first frame recorded is the first one
+        read out after start_ns (time.perf_counter_ns) and the recordings are tagged with sync_id.
+        """
+
+        logging.info(f'Starting synchronized recording {sync_id}')
+
+        self._camera_state = CMD_CAMERA_REC_MODE
+        self.com_queue.put((CMD_CAMERA_REC_MODE, start_ns, sync_id))
+
+        # Set buttons
+        self.streaming_button.setText('Start Stream')
+        self.recording_button.setText('Stop Recording')
+
+
+    def _update_state(self):
+        self.com_queue.put((self._camera_state, ))
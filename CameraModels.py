@@ -0,0 +1,61 @@
+"""Sensor and readout models of the supported cameras. """
+from ZwoCamera import ASI_IMG_RAW16
+
+
+# Sensors and approximate readout models of the cameras, used by the simulated cameras and for estimating the frame rate
+# of a ROI
+# * row_time_us - Readout time of one (binned) row in normal and in highspeed mode
+# * bandwidth - Sustained USB transfer rate in bytes per second
+CAMERA_MODELS = {
+    'ZWO ASI120MM Mini': {
+        'MaxWidth': 1280,
+        'MaxHeight': 960,
+        'BitDepth': 12,
+        'PixelSize': 3.75,
+        'ElecPerADU': 4.0,
+        'IsCoolerCam': False,
+        'IsUSB3Camera': False,
+        'SupportedBins': [1, 2, 3, 4],
+        'row_time_us': (40.0, 20.0),
+        'bandwidth': 40e6,
+    },
+    'ZWO ASI174MM-Cool': {
+        'MaxWidth': 1936,
+        'MaxHeight': 1216,
+        'BitDepth': 12,
+        'PixelSize': 5.86,
+        'ElecPerADU': 8.0,
+        'IsCoolerCam': True,
+        'IsUSB3Camera': True,
+        'SupportedBins': [1, 2, 3, 4],
+        'row_time_us': (12.0, 6.4),
+        'bandwidth': 350e6,
+    },
+}
+
+# Fixed time per frame for starting the readout and the transfer (in us)
+FRAME_OVERHEAD_US = 200
+
+
+def readout_frame_time(model: dict, width: int, height: int, image_type: int, highspeed: bool = True, exp_time: float = 0) -> float:
+    """Time between two frames (in s) for a ROI according to the nominal readout model of a camera. The actual frame
+    time of a camera also depends on the USB host and the load of the computer.
+
+    # Arguments
+    * model::dict - Camera model (see CAMERA_MODELS).
+    * width::int, height::int - Size of the ROI.
+    * image_type::int - ASI_IMG_RAW8 or ASI_IMG_RAW16 (RAW16 doubles the data which has to be transferred).
+    * highspeed::bool - Whether highspeed mode is enabled.
+    * exp_time::float - Exposure time (in s).
+    """
+
+    row_time = model['row_time_us'][1 if highspeed else 0] * 1e-6
+
+    # Readout of the rows of the ROI
+    readout = height * row_time + FRAME_OVERHEAD_US * 1e-6
+
+    # Transfer over USB
+    bytes_per_pixel = 2 if image_type == ASI_IMG_RAW16 else 1
+    transfer = width * height * bytes_per_pixel / model['bandwidth']
+
+    return max(exp_time, readout, transfer)
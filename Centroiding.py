@@ -0,0 +1,264 @@
+import numpy as np
+
+
+# Record of a star in a frame: sequence number and timestamp (time.perf_counter_ns) of the frame, position and FWHM (in
+# pixels) and flux above the background (in ADU)
+CENTROID_DTYPE = np.dtype([
+    ('seq', np.int64),
+    ('t_ns', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('flux', np.float64),
+    ('fwhm', np.float64),
+])
+
+# Methods for measuring the position of a star
+CENTROID_METHODS = ('com', 'gauss')
+
+# FWHM of a Gaussian in units of its standard deviation
+_SIGMA_TO_FWHM = 2 * np.sqrt(2 * np.log(2))
+
+
+def max_blocks(frame: np.ndarray, block: int) -> np.ndarray:
+    """Maximum of each block x block block of a frame (only the part of the frame divisible by block is used). """
+
+    h, w = frame.shape[0] // block, frame.shape[1] // block
+    frame = frame[:h * block, :w * block]
+
+    rows = frame[0::block].copy()
+    for i in range(1, block):
+        np.maximum(rows, frame[i::block], out=rows)
+    out = rows[:, 0::block].copy()
+    for j in range(1, block):
+        np.maximum(out, rows[:, j::block], out=out)
+
+    return out
+
+
+class Centroider:
+    """Find stars in frames and measure their position, flux and FWHM.
+
+    All steps are vectorized over the pixels and the stars:
+
+    1. The background level and noise are estimated from the median and the MAD of a subsample of the frame.
+    2. Stars are the brightest peaks more than threshold standard deviations above the background, found from the
+       maxima of window-sized blocks. Once stars were found, only the windows around their last positions are searched
+       as long as the stars stay in them.
+    3. In a window around each star the local background (median of the window border) is subtracted, and the position
+       and FWHM are measured by the center of mass and the second moments ('com') or by a Gaussian fit of the marginal
+       distributions ('gauss').
+    """
+
+    def __init__(self, window: int = 9, threshold: float = 5.0, max_stars: int = 1, method: str = 'com', n_samples: int = 4096):
+        """Constructor.
+
+        # Arguments
+        * window::int - Size of the window around a star (in pixels, made odd).
+        * threshold::float - Detection threshold (in standard deviations of the background).
+        * max_stars::int - Maximum number of stars measured per frame (the brightest ones).
+        * method::str - 'com' (fastest) or 'gauss' (more accurate for well sampled stars).
+        * n_samples::int - Approximate number of pixels used for estimating the background.
+        """
+
+        if method not in CENTROID_METHODS:
+            raise ValueError(f'Centroiding method {method} not known.')
+
+        self.radius = max(int(window) // 2, 1)
+        self.threshold = threshold
+        self.max_stars = int(max_stars)
+        self.method = method
+        self.n_samples = n_samples
+
+        # Pixel indices within a window
+        self._index = np.arange(self.window)
+
+        # Peak positions (y, x) of the stars in the last frame (None if the stars have to be searched)
+        self._peaks = None
+
+    @property
+    def window(self) -> int:
+        return 2 * self.radius + 1
+
+    def reset(self):
+        """Search the whole frame for stars again (e.g., after the ROI changed). """
+
+        self._peaks = None
+
+    def background(self, frame: np.ndarray) -> tuple:
+        """Estimate the background level and its standard deviation from a subsample of the frame. """
+
+        step = max(int(np.sqrt(frame.size / self.n_samples)), 1)
+        sample = frame[::step, ::step].astype(np.float32)
+        level = np.median(sample)
+        sigma = 1.4826 * np.median(np.abs(sample - level))
+
+        return float(level), max(float(sigma), 1.0)
+
+    def detect(self, frame: np.ndarray, limit: float) -> np.ndarray:
+        """Find the peaks of the brightest stars above limit.
+
+        # Returns
+        * peaks::np.ndarray - (n, 2) array of the peak positions (y, x), brightest first.
+        """
+
+        block = self.window
+        if frame.shape[0] < block or frame.shape[1] < block:
+            return np.empty((0, 2), dtype=np.intp)
+
+        maxima = max_blocks(frame, block)
+        candidates = np.flatnonzero(maxima > limit)
+        if len(candidates) == 0:
+            return np.empty((0, 2), dtype=np.intp)
+
+        # Brightest blocks first (a star on the border of two blocks can appear in both)
+        candidates = candidates[np.argsort(maxima.ravel()[candidates])[::-1][:4 * self.max_stars]]
+
+        peaks = []
+        for c in candidates:
+            by, bx = divmod(int(c), maxima.shape[1])
+            sub = frame[by * block:(by + 1) * block, bx * block:(bx + 1) * block]
+            py, px = divmod(int(np.argmax(sub)), block)
+            peak = (by * block + py, bx * block + px)
+            # Skip peaks of stars which were already found
+            if all(max(abs(peak[0] - p[0]), abs(peak[1] - p[1])) > self.radius for p in peaks):
+                peaks.append(peak)
+                if len(peaks) == self.max_stars:
+                    break
+
+        return np.array(peaks, dtype=np.intp).reshape(-1, 2)
+
+    def _track(self, frame: np.ndarray, limit: float) -> np.ndarray:
+        """Find the peaks in the windows around the last positions. Returns None if a star was lost. """
+
+        windows, y0, x0 = self._windows(frame, self._peaks)
+        flat = windows.reshape(len(windows), -1)
+        index = np.argmax(flat, axis=1)
+        if np.any(flat[np.arange(len(flat)), index] <= limit):
+            return None
+
+        py, px = np.divmod(index, self.window)
+        return np.stack((y0 + py, x0 + px), axis=1)
+
+    def _windows(self, frame: np.ndarray, peaks: np.ndarray) -> tuple:
+        """Cut out the windows around peaks (moved inside the frame).
+
+        # Returns
+        * windows::np.ndarray - (n, window, window) array.
+        * y0::np.ndarray, x0::np.ndarray - Position of the first pixel of each window.
+        """
+
+        h, w = frame.shape
+        y0 = np.clip(peaks[:, 0] - self.radius, 0, h - self.window)
+        x0 = np.clip(peaks[:, 1] - self.radius, 0, w - self.window)
+        rows = (y0[:, None] + self._index)[:, :, None]
+        cols = (x0[:, None] + self._index)[:, None, :]
+
+        return frame[rows, cols], y0, x0
+
+    def measure(self, frame: np.ndarray) -> tuple:
+        """Find the stars in a frame and measure them.
+
+        # Returns
+        * x::np.ndarray, y::np.ndarray - Positions (in pixels of the frame).
+        * flux::np.ndarray - Flux above the local background (in ADU).
+        * fwhm::np.ndarray - FWHM (in pixels).
+        """
+
+        level, sigma = self.background(frame)
+        limit = level + self.threshold * sigma
+
+        peaks = self._track(frame, limit) if self._peaks is not None and len(self._peaks) else None
+        if peaks is None:
+            peaks = self.detect(frame, limit)
+        self._peaks = peaks if len(peaks) else None
+
+        if len(peaks) == 0:
+            empty = np.empty(0)
+            return empty, empty, empty, empty
+
+        windows, y0, x0 = self._windows(frame, peaks)
+        windows = windows.astype(np.float32)
+
+        # Subtract the local background (median of the window border)
+        border = np.concatenate((windows[:, 0, :], windows[:, -1, :], windows[:, 1:-1, 0], windows[:, 1:-1, -1]), axis=1)
+        signal = windows - np.median(border, axis=1)[:, None, None]
+        flux = signal.sum(axis=(1, 2))
+        weights = np.clip(signal, 0, None)
+
+        # Marginal distributions
+        mx = weights.sum(axis=1)
+        my = weights.sum(axis=2)
+
+        x, var_x = self._moments(mx)
+        y, var_y = self._moments(my)
+        if self.method == 'gauss':
+            x, var_x = self._gauss_fit(mx, x, var_x)
+            y, var_y = self._gauss_fit(my, y, var_y)
+
+        fwhm = _SIGMA_TO_FWHM * np.sqrt((var_x + var_y) / 2)
+
+        return x0 + x, y0 + y, flux.astype(np.float64), fwhm
+
+    def _moments(self, marginal: np.ndarray) -> tuple:
+        """Center of mass and variance of marginal distributions (n, window). """
+
+        d = np.arange(self.window, dtype=np.float32)
+        total = np.maximum(marginal.sum(axis=1), 1e-9)
+        center = (marginal * d).sum(axis=1) / total
+        var = (marginal * (d - center[:, None]) ** 2).sum(axis=1) / total
+
+        return center.astype(np.float64), var.astype(np.float64)
+
+    def _gauss_fit(self, marginal: np.ndarray, center: np.ndarray, var: np.ndarray) -> tuple:
+        """Fit Gaussians to marginal distributions (n, window) by a weighted least squares fit of a parabola to their
+        logarithm. Falls back to center and var where the fit fails.
+        """
+
+        d = np.arange(self.window, dtype=np.float64)
+        m = marginal.astype(np.float64)
+        valid = m > 0
+        log_m = np.log(np.where(valid, m, 1))
+        # Weighting by the squared values suppresses the noisy wings
+        w = np.where(valid, m * m, 0)
+
+        powers = d[None, :, None] ** np.arange(5)[None, None, :]
+        s = (w[:, :, None] * powers).sum(axis=1)
+        t = (w[:, :, None] * log_m[:, :, None] * powers[:, :, :3]).sum(axis=1)
+        a = np.stack((s[:, 0:3], s[:, 1:4], s[:, 2:5]), axis=1)
+
+        try:
+            coefficients = np.linalg.solve(a, t[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            return center, var
+
+        b, c = coefficients[:, 1], coefficients[:, 2]
+        ok = c < 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fit_center = np.where(ok, -b / (2 * c), center)
+            fit_var = np.where(ok, -1 / (2 * c), var)
+
+        # Reject fits outside the window
+        ok &= (fit_center >= 0) & (fit_center <= self.window - 1)
+        return np.where(ok, fit_center, center), np.where(ok, fit_var, var)
+
+    def __call__(self, frame: np.ndarray, seq: int = 0, t_ns: int = 0) -> np.ndarray:
+        """Measure the stars in a frame.
+
+        # Returns
+        * records::np.ndarray - One record (CENTROID_DTYPE) per star.
+        """
+
+        x, y, flux, fwhm = self.measure(frame)
+
+        records = np.empty(len(x), dtype=CENTROID_DTYPE)
+        records['seq'] = seq
+        records['t_ns'] = t_ns
+        records['x'] = x
+        records['y'] = y
+        records['flux'] = flux
+        records['fwhm'] = fwhm
+
+        return records
+
+    def __repr__(self) -> str:
+        return f'Centroider({self.window}x{self.window}, {self.method}, {self.max_stars} stars)'
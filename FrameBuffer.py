@@ -0,0 +1,360 @@
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from collections import namedtuple
+import numpy as np
+import logging
+import time
+import os
+
+
+# Reference to a frame in a shared memory ring. This is the only thing that is sent over the result queue. info is
+# the FrameInfo (capture sequence number, timestamp and dropped frames) of the frame if it is known.
+FrameRef = namedtuple('FrameRef', ['name', 'slot', 'seq', 'shape', 'dtype', 'info'], defaults=(None, ))
+
+# Layout of the control block at the beginning of the shared memory
+_HEADER_WORDS = 4
+_DATA_ALIGN = 64
+
+
+def _data_offset(n_slots: int) -> int:
+    """Get the offset of the first frame slot in bytes (aligned to a cache line). """
+
+    header_bytes = 8 * (_HEADER_WORDS + n_slots)
+    return int(np.ceil(header_bytes / _DATA_ALIGN)) * _DATA_ALIGN
+
+
+class FrameRingBuffer:
+    """Ring of pre-sized frame slots in shared memory (writer side).
+
+    Frames are written into free slots and published as a small FrameRef. The reader marks a slot as free again by
+    releasing it. If all slots are still held by the reader, the frame is dropped and counted as overrun.
+    """
+
+    def __init__(self, uid: int, shape: tuple, dtype=np.uint8, n_slots: int = 8, prefix: str = 'zwo'):
+        """Constructor.
+
+        # Arguments
+        * uid::int - UID of the subprocess owning the ring (used for naming the shared memory).
+        * shape::tuple - Shape of a single slot, e.g., a frame (height, width) or a recording (n, height, width).
+        * dtype::np.dtype - Data type of the frame pixels.
+        * n_slots::int - Number of frame slots in the ring.
+        * prefix::str - Prefix of the shared memory name (to tell several rings of a subprocess apart).
+        """
+
+        self.uid = uid
+        self.n_slots = n_slots
+        self.prefix = prefix
+
+        # Number of frames which could not be written because the reader fell behind
+        self.overruns = 0
+
+        self._generation = 0
+        self._layout = 0
+        self._seq = 0
+        self._next_slot = 0
+
+        self._shm = None
+        self._held = None
+        self._data = None
+
+        self._allocate(shape, dtype)
+
+    def _allocate(self, shape: tuple, dtype):
+        """Allocate a new block of shared memory which can hold n_slots frames of the given shape. """
+
+        # Release the previous block
+        self._free()
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._layout += 1
+        self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        # Create the shared memory (the name changes with every reallocation so readers notice it)
+        self._generation += 1
+        name = f'{self.prefix}_{self.uid:x}_{os.getpid()}_{self._generation}'
+        offset = _data_offset(self.n_slots)
+        self._shm = SharedMemory(name=name, create=True, size=offset + self.n_slots * self.slot_bytes)
+
+        # Write the layout to the control block
+        header = np.ndarray((_HEADER_WORDS, ), dtype=np.int64, buffer=self._shm.buf)
+        header[:] = (self.n_slots, self.slot_bytes, offset, 0)
+
+        # Per slot: sequence number of the published frame while it is held by the reader, 0 if the slot is free
+        self._held = np.ndarray((self.n_slots, ), dtype=np.int64, buffer=self._shm.buf, offset=8 * _HEADER_WORDS)
+        self._held[:] = 0
+
+        self._data = np.ndarray((self.n_slots * self.slot_bytes, ), dtype=np.uint8, buffer=self._shm.buf, offset=offset)
+        self._next_slot = 0
+
+        logging.debug(f'{self} allocated {self.n_slots} slots of {self.slot_bytes} bytes in {name}')
+
+    def _free(self):
+        """Close and unlink the shared memory. """
+
+        if self._shm is not None:
+            # Drop all views before closing the shared memory
+            self._held = None
+            self._data = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    @property
+    def generation(self) -> int:
+        """Number of times the shared memory was allocated. """
+
+        return self._generation
+
+    @property
+    def layout(self) -> int:
+        """Counter which changes whenever the frame shape or data type of the slots changes. """
+
+        return self._layout
+
+    @property
+    def name(self) -> str:
+        """Name of the shared memory block. """
+
+        return self._shm.name
+
+    def resize(self, shape: tuple, dtype=None):
+        """Change the frame shape (e.g., after changing the ROI). The shared memory is only reallocated if the frames
+        no longer fit into the slots.
+        """
+
+        if dtype is None:
+            dtype = self.dtype
+        dtype = np.dtype(dtype)
+        shape = tuple(shape)
+
+        if shape == self.shape and dtype == self.dtype:
+            return
+
+        if int(np.prod(shape)) * dtype.itemsize <= self.slot_bytes:
+            # Reuse the existing slots
+            logging.debug(f'{self} resizing slots to {shape} {dtype}')
+            self.shape = shape
+            self.dtype = dtype
+            self._layout += 1
+        else:
+            # Make the slots larger
+            self._allocate(shape, dtype)
+
+    def slot_view(self, slot: int) -> np.ndarray:
+        """Get a writable view of a slot with the current frame shape. """
+
+        start = slot * self.slot_bytes
+        n_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        return self._data[start:start + n_bytes].view(self.dtype).reshape(self.shape)
+
+    def acquire(self):
+        """Get the next free slot for writing a frame.
+
+        # Returns
+        * slot::int - Index of the slot or None if all slots are held by the reader (overrun).
+        * view::np.ndarray - Writable view of the slot or None.
+        """
+
+        for i in range(self.n_slots):
+            slot = (self._next_slot + i) % self.n_slots
+            if self._held[slot] == 0:
+                self._next_slot = (slot + 1) % self.n_slots
+                return slot, self.slot_view(slot)
+
+        # The reader fell behind
+        self.overruns += 1
+        return None, None
+
+    def publish(self, slot: int, info=None) -> FrameRef:
+        """Mark a slot as held by the reader and get the reference which is sent to it (info is passed on). """
+
+        self._seq += 1
+        self._held[slot] = self._seq
+        return FrameRef(self.name, slot, self._seq, self.shape, self.dtype.str, info)
+
+    def write(self, frame: np.ndarray, info=None) -> FrameRef:
+        """Copy a frame into the ring and publish it. Returns None if the frame was dropped due to an overrun. """
+
+        self.resize(frame.shape, frame.dtype)
+
+        slot, view = self.acquire()
+        if slot is None:
+            return None
+
+        view[...] = frame
+        return self.publish(slot, info)
+
+    @property
+    def occupancy(self) -> int:
+        """Number of slots currently held by the reader. """
+
+        return int(np.count_nonzero(self._held))
+
+    def close(self):
+        """Free the shared memory. """
+
+        self._free()
+
+    def __repr__(self) -> str:
+        return f'FrameRingBuffer({self.uid:#x})'
+
+
+class DisplayMailbox:
+    """Latest-frame-wins channel for preview frames on top of a FrameRingBuffer.
+
+    Every captured frame is offered to the mailbox, but a frame is only published if the reader has released the
+    previous preview frame and the maximum preview rate is not exceeded. Otherwise it replaces the pending frame, so
+    the reader always gets the newest frame and at most one preview frame is in flight.
+    """
+
+    def __init__(self, frame_buffer: FrameRingBuffer, max_rate: float = 30):
+        """Constructor.
+
+        # Arguments
+        * frame_buffer::FrameRingBuffer - Ring holding the frames.
+        * max_rate::float - Maximum number of preview frames per second (None for no limit).
+        """
+
+        self.frame_buffer = frame_buffer
+        self.max_rate = max_rate
+
+        # Number of frames which were published and which were replaced by a newer frame before being published
+        self.shown = 0
+        self.skipped = 0
+
+        self._pending = None
+        self._next_publish_t = 0
+
+    @property
+    def pending(self) -> bool:
+        """Whether a frame is waiting to be published. """
+
+        return self._pending is not None
+
+    def _due(self) -> bool:
+        """Check whether a preview frame can be published now. """
+
+        if self.frame_buffer.occupancy:
+            # The reader has not released the last preview frame yet
+            return False
+
+        return not self.max_rate or time.perf_counter() >= self._next_publish_t
+
+    def offer(self, slot: int, info=None) -> FrameRef:
+        """Offer a newly written slot (info is passed on with the reference). Returns a reference if the frame was
+        published, None otherwise.
+        """
+
+        if self._pending is not None:
+            # The pending frame is replaced without being shown
+            self.skipped += 1
+        self._pending = (slot, self.frame_buffer.layout, info)
+
+        return self.poll()
+
+    def poll(self) -> FrameRef:
+        """Publish the pending frame if possible. Returns a reference if the frame was published, None otherwise. """
+
+        if self._pending is None or not self._due():
+            return None
+
+        slot, layout, info = self._pending
+        self._pending = None
+
+        if layout != self.frame_buffer.layout:
+            # The slots were resized since the frame was written
+            self.skipped += 1
+            return None
+
+        self.shown += 1
+        if self.max_rate:
+            # Schedule the next frame one period after this one was due (not after it was published), so the average
+            # rate matches max_rate even if the capture rate is only slightly higher. Frames are at least half a period
+            # apart, so skipped periods are not made up in a burst
+            period = 1 / self.max_rate
+            self._next_publish_t = max(self._next_publish_t + period, time.perf_counter() + period / 2)
+        return self.frame_buffer.publish(slot, info)
+
+
+class FrameRingReader:
+    """Reader side of a FrameRingBuffer. Gives zero-copy access to the frames of the ring. """
+
+    def __init__(self):
+        """Constructor. """
+
+        # Attached shared memory blocks by name
+        self._attached = {}
+        # Blocks which could not be closed yet because views of them are still in use
+        self._stale = []
+
+        # Number of frames which could not be read since the ring was already reallocated
+        self.lost = 0
+
+    def _attach(self, name: str):
+        """Attach to the shared memory block of a ring. """
+
+        if name not in self._attached:
+            # The writer reallocated the ring, the old blocks are no longer needed
+            self._detach_all()
+
+            shm = SharedMemory(name=name)
+            # The writer owns the block, do not let the resource tracker of this process unlink it on exit
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            header = np.ndarray((_HEADER_WORDS, ), dtype=np.int64, buffer=shm.buf)
+            n_slots, slot_bytes, offset, _ = (int(x) for x in header)
+            held = np.ndarray((n_slots, ), dtype=np.int64, buffer=shm.buf, offset=8 * _HEADER_WORDS)
+            self._attached[name] = (shm, held, slot_bytes, offset)
+
+            logging.debug(f'{self} attached to {name}')
+
+        return self._attached[name]
+
+    def _detach_all(self):
+        """Detach from all blocks. Blocks are closed once they are no longer referenced. """
+
+        self._stale += [shm for shm, _, _, _ in self._attached.values()]
+        self._attached = {}
+
+        remaining = []
+        for shm in self._stale:
+            try:
+                shm.close()
+            except BufferError:
+                # A view of the block is still in use
+                remaining.append(shm)
+        self._stale = remaining
+
+    def get(self, ref: FrameRef) -> np.ndarray:
+        """Get a read-only view of a frame in the ring. Returns None if the frame is no longer available. """
+
+        try:
+            shm, _, slot_bytes, offset = self._attach(ref.name)
+        except FileNotFoundError:
+            # The ring was reallocated before the frame was read
+            self.lost += 1
+            return None
+
+        view = np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=shm.buf, offset=offset + ref.slot * slot_bytes)
+        view.flags.writeable = False
+        return view
+
+    def release(self, ref: FrameRef):
+        """Give a slot back to the writer (also if the frame was never read). """
+
+        try:
+            held = self._attach(ref.name)[1]
+        except FileNotFoundError:
+            # The ring was already freed by the writer
+            return
+
+        if held[ref.slot] == ref.seq:
+            held[ref.slot] = 0
+
+    def close(self):
+        """Detach from all rings. """
+
+        self._detach_all()
+
+    def __repr__(self) -> str:
+        return 'FrameRingReader()'
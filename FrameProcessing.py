@@ -0,0 +1,149 @@
+import numpy as np
+import logging
+
+
+# Methods for combining the pixels of a bin
+BINNING_METHODS = ('sum', 'mean')
+
+
+def sum_blocks(frame: np.ndarray, factor: int, rows: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Sum factor x factor blocks of a frame.
+
+    Summing strided slices keeps the inner loops contiguous, which is much faster than reducing a 4D view over two
+    axes. Only the part of the frame divisible by factor is used.
+
+    # Arguments
+    * frame::np.ndarray - 2D frame.
+    * factor::int - Size of the blocks (at least 2).
+    * rows::np.ndarray - Buffer of shape (h // factor, w // factor * factor) for the sums over the rows of each block.
+    * out::np.ndarray - Buffer of shape (h // factor, w // factor) for the block sums. rows and out have to be wide
+                        enough to hold the sums.
+
+    # Returns
+    * out::np.ndarray - The block sums.
+    """
+
+    h, w = out.shape
+    frame = frame[:h * factor, :w * factor]
+    np.add(frame[0::factor], frame[1::factor], out=rows, dtype=rows.dtype)
+    for i in range(2, factor):
+        np.add(rows, frame[i::factor], out=rows)
+    np.add(rows[:, 0::factor], rows[:, 1::factor], out=out, dtype=out.dtype)
+    for j in range(2, factor):
+        np.add(out, rows[:, j::factor], out=out)
+
+    return out
+
+
+def sum_dtype(dtype: np.dtype, n: int) -> np.dtype:
+    """Smallest unsigned integer type which holds the sum of n pixels of type dtype without overflowing. """
+
+    dtype = np.dtype(dtype)
+    max_sum = int(np.iinfo(dtype).max) * n
+    for candidate in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if np.iinfo(candidate).max >= max_sum:
+            return np.dtype(candidate)
+
+    raise ValueError(f'Sum of {n} pixels of type {dtype} does not fit into an integer.')
+
+
+class SoftwareBinning:
+    """Bin frames by an integer factor on the CPU.
+
+    Summed bins are stored in the smallest unsigned type which cannot overflow (e.g., uint16 for 2x2 bins of RAW8
+    frames and uint32 for RAW16 frames), averaged bins are rounded to the type of the frames. Rows and columns which do
+    not fill a complete bin are dropped. All buffers are allocated once per frame format.
+    """
+
+    def __init__(self, factor: int, method: str = 'sum'):
+        """Constructor.
+
+        # Arguments
+        * factor::int - Number of pixels combined in x and y.
+        * method::str - 'sum' or 'mean'.
+        """
+
+        if factor < 1:
+            raise ValueError(f'Binning factor {factor} must be positive.')
+        if method not in BINNING_METHODS:
+            raise ValueError(f'Binning method {method} not known.')
+
+        self.factor = int(factor)
+        self.method = method
+
+        self._format = None
+
+    def output_format(self, shape: tuple, dtype: np.dtype) -> tuple:
+        """Get the shape and data type of the binned frames.
+
+        # Arguments
+        * shape::tuple - Shape of the frames.
+        * dtype::np.dtype - Data type of the frames.
+
+        # Returns
+        * shape::tuple - Shape of the binned frames.
+        * dtype::np.dtype - Data type of the binned frames.
+        """
+
+        dtype = np.dtype(dtype)
+        shape = (shape[0] // self.factor, shape[1] // self.factor)
+        if self.factor == 1 or self.method == 'mean':
+            return shape, dtype
+
+        return shape, sum_dtype(dtype, self.factor ** 2)
+
+    def bit_depth(self, bit_depth: int) -> int:
+        """Number of significant bits of the binned frames for frames with bit_depth bits. """
+
+        if self.method == 'mean':
+            return bit_depth
+        return bit_depth + int(np.ceil(np.log2(self.factor ** 2)))
+
+    def _setup(self, shape: tuple, dtype: np.dtype):
+        """Allocate the buffers for a frame format. """
+
+        out_shape, out_dtype = self.output_format(shape, dtype)
+        # Leave room for rounding the mean
+        acc_dtype = sum_dtype(dtype, self.factor ** 2 + 1)
+
+        rows = np.empty((out_shape[0], out_shape[1] * self.factor), dtype=acc_dtype)
+        acc = np.empty(out_shape, dtype=acc_dtype)
+
+        self._format = (shape, dtype, out_shape, out_dtype, rows, acc)
+        logging.debug(f'{self} bins {shape} {dtype} frames to {out_shape} {out_dtype}')
+
+    def __call__(self, frame: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Bin a frame.
+
+        # Arguments
+        * frame::np.ndarray - 2D frame of unsigned integers.
+        * out::np.ndarray - Array with the shape and type of output_format() to write into (allocated if None).
+
+        # Returns
+        * out::np.ndarray - The binned frame.
+        """
+
+        if self._format is None or self._format[:2] != (frame.shape, frame.dtype):
+            self._setup(frame.shape, frame.dtype)
+        _, _, out_shape, out_dtype, rows, acc = self._format
+
+        if out is None:
+            out = np.empty(out_shape, dtype=out_dtype)
+        elif out.shape != out_shape or out.dtype != out_dtype:
+            raise ValueError(f'Output of shape {out.shape} ({out.dtype}) does not match {out_shape} ({out_dtype}).')
+
+        if self.factor == 1:
+            np.copyto(out, frame)
+        elif self.method == 'sum':
+            sum_blocks(frame, self.factor, rows, out)
+        else:
+            # Round to the nearest integer
+            n = self.factor ** 2
+            sum_blocks(frame, self.factor, rows, acc)
+            np.add(acc, n // 2, out=acc)
+            np.floor_divide(acc, n, out=out, casting='unsafe')
+
+        return out
+
+    def __repr__(self) -> str:
+        return f'SoftwareBinning({self.factor}x{self.factor}, {self.method})'
@@ -0,0 +1,164 @@
+import numpy as np
+
+
+# Sharpness metrics of a frame. For 'fwhm' smaller values are better, for the others larger ones
+SELECTION_METRICS = ('laplacian', 'peak', 'fwhm')
+
+# Size of the chunks of frames which are scored at once (in bytes of float32 pixels)
+SCORE_CHUNK_BYTES = 2**25
+
+# FWHM of a Gaussian in units of its standard deviation
+_SIGMA_TO_FWHM = 2 * np.sqrt(2 * np.log(2))
+
+
+class FrameSelector:
+    """Score the frames of a burst by their sharpness and keep the best ones (lucky imaging).
+
+    The background and noise of every frame are estimated from the median and the MAD of a subsample. The scores are
+    computed for chunks of frames at once:
+
+    * 'laplacian' - Variance of the discrete Laplacian of the frame (fine detail, e.g., of extended objects).
+    * 'peak' - Brightest pixel above the background divided by the flux above the detection threshold (concentration
+      of the light of a star).
+    * 'fwhm' - FWHM from the second moments of the pixels above the detection threshold (size of a star, in pixels).
+
+    The brightness weighted center of the pixels above the detection threshold is used for aligning the selected frames
+    when they are shift-and-added.
+    """
+
+    def __init__(self, metric: str = 'laplacian', keep: float = 0.1, stack: bool = False, threshold: float = 5.0,
+                 n_samples: int = 4096):
+        """Constructor.
+
+        # Arguments
+        * metric::str - One of SELECTION_METRICS.
+        * keep::float - Fraction of the frames which is kept (at least one frame is kept).
+        * stack::bool - Whether the kept frames are also shift-and-added (see shift_and_add).
+        * threshold::float - Detection threshold of the pixels of a star (in standard deviations of the background).
+        * n_samples::int - Approximate number of pixels per frame used for estimating the background.
+        """
+
+        if metric not in SELECTION_METRICS:
+            raise ValueError(f'Selection metric {metric} not known.')
+        if not 0 < keep <= 1:
+            raise ValueError(f'Fraction {keep} of the frames kept must be in (0, 1].')
+
+        self.metric = metric
+        self.keep = float(keep)
+        self.stack = bool(stack)
+        self.threshold = float(threshold)
+        self.n_samples = int(n_samples)
+
+    def _background(self, frames: np.ndarray) -> tuple:
+        """Background level and noise of every frame of a chunk (n, height, width). """
+
+        step = max(1, int(np.sqrt(frames[0].size / self.n_samples)))
+        samples = frames[:, ::step, ::step].reshape(len(frames), -1).astype(np.float32)
+        level = np.median(samples, axis=1)
+        noise = 1.4826 * np.median(np.abs(samples - level[:, np.newaxis]), axis=1)
+
+        return level, np.maximum(noise, 1e-6)
+
+    def measure(self, frames: np.ndarray) -> tuple:
+        """Score every frame of a burst and find the centers of their stars.
+
+        # Arguments
+        * frames::np.ndarray - Burst of frames (n, height, width).
+
+        # Returns
+        * scores::np.ndarray - Score of every frame (NaN if no star was found for 'peak' and 'fwhm').
+        * centers::np.ndarray - (x, y) of the brightness weighted center of every frame (NaN if no star was found).
+        """
+
+        n, h, w = frames.shape
+        scores = np.empty(n, dtype=np.float64)
+        centers = np.empty((n, 2), dtype=np.float64)
+        xs = np.arange(w, dtype=np.float64)
+        ys = np.arange(h, dtype=np.float64)
+
+        step = max(1, SCORE_CHUNK_BYTES // (h * w * 4))
+        for i in range(0, n, step):
+            chunk = frames[i:i + step].astype(np.float32)
+            level, noise = self._background(chunk)
+            chunk -= level[:, np.newaxis, np.newaxis]
+
+            # Pixels above the detection threshold weighted by their brightness
+            weights = np.where(chunk > self.threshold * noise[:, np.newaxis, np.newaxis], chunk, 0)
+            cols = weights.sum(axis=1, dtype=np.float64)
+            rows = weights.sum(axis=2, dtype=np.float64)
+            flux = cols.sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cx = cols @ xs / flux
+                cy = rows @ ys / flux
+                centers[i:i + step] = np.stack((cx, cy), axis=1)
+
+                if self.metric == 'laplacian':
+                    laplacian = 4 * chunk[:, 1:-1, 1:-1]
+                    laplacian -= chunk[:, :-2, 1:-1]
+                    laplacian -= chunk[:, 2:, 1:-1]
+                    laplacian -= chunk[:, 1:-1, :-2]
+                    laplacian -= chunk[:, 1:-1, 2:]
+                    # The Laplacian has a mean close to 0, so its variance follows from the sum of squares without
+                    # losing precision
+                    laplacian = laplacian.reshape(len(chunk), -1)
+                    mean = laplacian.mean(axis=1, dtype=np.float64)
+                    scores[i:i + step] = np.einsum('ij,ij->i', laplacian, laplacian) / laplacian.shape[1] - mean**2
+                elif self.metric == 'peak':
+                    scores[i:i + step] = chunk.reshape(len(chunk), -1).max(axis=1) / flux
+                else:
+                    var_x = cols @ xs**2 / flux - cx**2
+                    var_y = rows @ ys**2 / flux - cy**2
+                    scores[i:i + step] = _SIGMA_TO_FWHM * np.sqrt(np.maximum((var_x + var_y) / 2, 0))
+
+        if self.metric != 'laplacian':
+            # Frames without a star get no score
+            scores[~np.all(np.isfinite(centers), axis=1)] = np.nan
+
+        return scores, centers
+
+    def select(self, scores: np.ndarray) -> np.ndarray:
+        """Get the indices of the best frames (in the order of the burst). Frames without a score come last. """
+
+        n_keep = min(len(scores), max(1, int(round(self.keep * len(scores)))))
+        if self.metric == 'fwhm':
+            order = np.argsort(np.where(np.isnan(scores), np.inf, scores), kind='stable')
+        else:
+            order = np.argsort(np.where(np.isnan(scores), -np.inf, -scores), kind='stable')
+
+        return np.sort(order[:n_keep])
+
+    def shift_and_add(self, frames: np.ndarray, index: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        """Mean of the selected frames, shifted by whole pixels so their centers match the median center.
+
+        Pixels shifted in from outside a frame are not counted, so the border of the stack averages fewer frames.
+
+        # Arguments
+        * frames::np.ndarray - Burst of frames (n, height, width).
+        * index::np.ndarray - Indices of the selected frames.
+        * centers::np.ndarray - Centers of all frames of the burst (see measure). Frames without a center are not
+                                shifted.
+
+        # Returns
+        * stack::np.ndarray - Stacked frame (float32).
+        """
+
+        h, w = frames.shape[1:]
+        selected = centers[index]
+        reference = np.nanmedian(selected, axis=0) if np.any(np.isfinite(selected)) else np.zeros(2)
+        shifts = np.rint(np.nan_to_num(reference - selected)).astype(int)
+
+        total = np.zeros((h, w), dtype=np.float64)
+        count = np.zeros((h, w), dtype=np.int32)
+        for i, (dx, dy) in zip(index, shifts):
+            # Overlap of the shifted frame with the stack
+            dx, dy = np.clip(dx, -w, w), np.clip(dy, -h, h)
+            target = (slice(max(dy, 0), h + min(dy, 0)), slice(max(dx, 0), w + min(dx, 0)))
+            source = (slice(max(-dy, 0), h - max(dy, 0)), slice(max(-dx, 0), w - max(dx, 0)))
+            total[target] += frames[i][source]
+            count[target] += 1
+
+        return (total / np.maximum(count, 1)).astype(np.float32)
+
+    def __repr__(self) -> str:
+        return f'FrameSelector({self.metric}, keep={self.keep:g}{", stack" if self.stack else ""})'
+
@@ -0,0 +1,143 @@
+import logging
+
+
+class FrameTiming:
+    """Timing statistics of a capture session.
+
+    Frames are added with their FrameInfo (sequence number, timestamp in ns and dropped frames counter of the SDK).
+    The statistics are updated incrementally, so sessions of any length need constant memory:
+
+    * Intervals between consecutive frames (mean, standard deviation, minimum and maximum).
+    * A least squares fit of the timestamps against the sequence number. Its slope is the sustained frame period and
+      the RMS of the residuals the jitter. The drift is the deviation of the last frame from the fit.
+    * Frames missing in the sequence numbers and frames dropped by the SDK.
+    """
+
+    def __init__(self):
+        """Constructor. """
+
+        self.reset()
+
+    def reset(self):
+        """Start a new session. """
+
+        self.frames = 0
+        self.missed = 0
+
+        self._first = None
+        self._last = None
+        self._dropped_start = None
+        self._dropped = 0
+
+        # Intervals between consecutive frames (in ns)
+        self._dt_sum = 0
+        self._dt_sum_sq = 0
+        self._dt_min = None
+        self._dt_max = None
+
+        # Sums for fitting the timestamps against the sequence numbers (relative to the first frame)
+        self._sx = 0
+        self._sy = 0
+        self._sxx = 0
+        self._sxy = 0
+        self._syy = 0
+
+    def add(self, info):
+        """Add a frame.
+
+        # Arguments
+        * info::FrameInfo - Sequence number, timestamp (in ns) and dropped frames counter of the frame.
+        """
+
+        seq, t_ns, dropped = info
+
+        if self._first is None:
+            self._first = (seq, t_ns)
+            self._dropped_start = dropped
+        else:
+            last_seq, last_t_ns = self._last
+            # Frames which were captured but not added (e.g., not offered for timing)
+            self.missed += max(seq - last_seq - 1, 0)
+
+            dt = t_ns - last_t_ns
+            self._dt_sum += dt
+            self._dt_sum_sq += dt * dt
+            self._dt_min = dt if self._dt_min is None else min(self._dt_min, dt)
+            self._dt_max = dt if self._dt_max is None else max(self._dt_max, dt)
+
+        self._last = (seq, t_ns)
+        self._dropped = dropped - self._dropped_start
+        self.frames += 1
+
+        # Python integers keep the sums exact
+        x = seq - self._first[0]
+        y = t_ns - self._first[1]
+        self._sx += x
+        self._sy += y
+        self._sxx += x * x
+        self._sxy += x * y
+        self._syy += y * y
+
+    def report(self) -> dict:
+        """Get the statistics of the session (times in s, rates in frames per second). """
+
+        report = {
+            'frames': self.frames,
+            'missed': self.missed,
+            'dropped': self._dropped,
+        }
+        if self.frames < 3:
+            return report
+
+        n = self.frames
+        duration = (self._last[1] - self._first[1]) * 1e-9
+        n_dt = n - 1
+        dt_mean = self._dt_sum / n_dt
+        dt_var = max(self._dt_sum_sq / n_dt - dt_mean ** 2, 0)
+
+        # Least squares fit t = t_0 + period * seq
+        sxx = self._sxx - self._sx ** 2 / n
+        sxy = self._sxy - self._sx * self._sy / n
+        syy = self._syy - self._sy ** 2 / n
+        period = sxy / sxx if sxx else 0
+        residual_var = max(syy - period * sxy, 0) / max(n - 2, 1)
+
+        report.update({
+            'duration': duration,
+            'rate': n_dt / duration if duration else 0,
+            'sustained_rate': 1e9 / period if period else 0,
+            'interval_mean': dt_mean * 1e-9,
+            'interval_std': dt_var ** 0.5 * 1e-9,
+            'interval_min': self._dt_min * 1e-9,
+            'interval_max': self._dt_max * 1e-9,
+            'jitter_rms': residual_var ** 0.5 * 1e-9,
+            'drift': self._drift(period) * 1e-9,
+        })
+
+        return report
+
+    def _drift(self, period: float) -> float:
+        """Deviation of the last frame from the fit (in ns). Positive if the frames fall behind. """
+
+        n = self.frames
+        intercept = (self._sy - period * self._sx) / n
+        x = self._last[0] - self._first[0]
+        y = self._last[1] - self._first[1]
+        return y - (intercept + period * x)
+
+    def log(self, prefix: str = ''):
+        """Log the report. """
+
+        report = self.report()
+        if 'rate' in report:
+            logging.info(f"{prefix}{report['frames']} frames in {report['duration']:.2f} s: {report['rate']:.2f} FPS "
+                         f"(sustained {report['sustained_rate']:.2f} FPS), interval {report['interval_mean'] * 1e3:.3f} "
+                         f"+- {report['interval_std'] * 1e3:.3f} ms (max {report['interval_max'] * 1e3:.3f} ms), "
+                         f"jitter {report['jitter_rms'] * 1e6:.1f} us, missed {report['missed']}, dropped {report['dropped']}")
+        else:
+            logging.info(f"{prefix}{report['frames']} frames")
+
+        return report
+
+    def __repr__(self) -> str:
+        return f'FrameTiming({self.frames} frames)'
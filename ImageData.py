@@ -2,6 +2,30 @@ from astropy.io.fits.hdu.image import ImageHDU
 import numpy as np
 from astropy.io import fits
 from datetime import date, datetime
+from Telemetry import get_telemetry
+from collections import deque
+import logging
+import time
+import io
+
+
+# BITPIX and BZERO for storing a numpy data type in a FITS file
+_FITS_FORMATS = {
+    np.dtype(np.uint8): (8, None, '>u1'),
+    np.dtype(np.int16): (16, None, '>i2'),
+    np.dtype(np.uint16): (16, 2**15, '>i2'),
+    np.dtype(np.int32): (32, None, '>i4'),
+    np.dtype(np.uint32): (32, 2**31, '>i4'),
+    np.dtype(np.float32): (-32, None, '>f4'),
+    np.dtype(np.float64): (-64, None, '>f8'),
+}
+
+# FITS files are written in blocks of 2880 bytes
+_FITS_BLOCK = 2880
+
+# Lossless tile compression algorithms for integer frames (see FitsCompressedWriter). astropy always compresses GZIP_1
+# and GZIP_2 tiles with the slowest zlib level 9, RICE_1 is much faster
+COMPRESSION_TYPES = ('RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1', 'PLIO_1')
 
 
 def _format_date(date: datetime) -> str:
@@ -18,60 +42,824 @@ def _format_time(time: datetime) -> str:
     else:
         return None
 
+# Data type of the raw data for each BITPIX
+_FITS_RAW_DTYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+def _physical_dtype(header: fits.Header) -> np.dtype:
+    """Data type of the frames of an image HDU after applying BZERO and BSCALE. """
+
+    bzero = header.get('BZERO', 0)
+    bscale = header.get('BSCALE', 1)
+    raw_dtype = np.dtype(_FITS_RAW_DTYPES[header['BITPIX']])
+
+    if bscale != 1 or bzero not in (0, 2**15, 2**31):
+        return np.dtype(np.float64)
+    elif bzero == 2**15 and raw_dtype == np.dtype('>i2'):
+        return np.dtype(np.uint16)
+    elif bzero == 2**31 and raw_dtype == np.dtype('>i4'):
+        return np.dtype(np.uint32)
+    else:
+        return raw_dtype.newbyteorder('=')
+
+
+def _frame_meta(columns: dict, meta: dict, n_written: int, n_frames: int) -> dict:
+    """Check the per-frame metadata of n_frames frames against the columns (column name -> list of arrays) of the
+    n_written frames before and broadcast it to arrays of length n_frames. Raises ValueError if the columns differ or a
+    column does not have n_frames entries.
+    """
+
+    if n_written and set(meta) != set(columns):
+        raise ValueError(f'Metadata {sorted(meta)} does not match the columns {sorted(columns)}.')
+
+    try:
+        return {key: np.broadcast_to(np.asarray(value), (n_frames, )).copy() for key, value in meta.items()}
+    except ValueError:
+        raise ValueError(f'Metadata does not have {n_frames} entries per column.') from None
+
+
+def _append_frame_table(file_name: str, meta: dict, n_frames: int):
+    """Append the per-frame metadata (column name -> list of arrays) of n_frames frames as binary table FRAMES to a
+    FITS file.
+    """
+
+    columns = [np.concatenate(values) for values in meta.values()]
+    if any(len(column) != n_frames for column in columns):
+        raise ValueError(f'Metadata columns {sorted(meta)} do not cover all {n_frames} frames.')
+
+    table = np.rec.fromarrays(columns, names=list(meta))
+    table_hdu = fits.BinTableHDU(table, name='FRAMES')
+    with fits.open(file_name, mode='append') as hdul:
+        hdul.append(table_hdu)
+
+
+def compress_chunk(frames: np.ndarray, first_frame: int, options: dict) -> bytes:
+    """Compress a stack of frames into a FITS image extension (see FitsCompressedWriter).
+
+    Module level function, so it can run in a process pool.
+
+    # Arguments
+    * frames::np.ndarray - Stack of frames (n, height, width).
+    * first_frame::int - Index of the first frame in the recording (saved as FRAME0).
+    * options::dict - Arguments of CompImageHDU (compression_type, tile_shape, hcomp_scale).
+
+    # Returns
+    * data::bytes - Header and data of the extension.
+    """
+
+    header = fits.Header([('FRAME0', first_frame, 'Index of the first frame of the chunk')])
+    hdu = fits.CompImageHDU(np.ascontiguousarray(frames), header=header, **options)
+
+    # Serialize the extension behind an empty primary HDU and cut the primary HDU off (the tiles are compressed when
+    # writing)
+    primary = fits.PrimaryHDU()
+    buffer = io.BytesIO()
+    fits.HDUList([primary, hdu]).writeto(buffer)
+
+    return buffer.getvalue()[len(primary.header.tostring()):]
+
+
 def load_fits(file_name):
-    pass
+    """Open a recording without reading the pixel data (see FitsRecording). """
+
+    return FitsRecording(file_name)
+
+
+class FitsRecording:
+    """Recording in a FITS file with the data unit mapped into memory.
+
+    Only the headers are read when opening. Frames are read from disk when they are accessed, e.g., rec[100:200] or by
+    iterating over rec.frames(), and are returned as native numpy arrays (uint16 for BZERO=32768).
+
+    Files written by FitsCompressedWriter (no primary data, chunks of frames in compressed image extensions) are read
+    chunk by chunk, keeping the last decompressed chunk.
+    """
+
+    def __init__(self, file_name: str):
+        """Constructor. """
+
+        self.file_name = file_name
+        self._raw = None
+        self._metadata = None
+
+        # Compressed chunks: open file, extension indices, index of the first frame of each chunk and the last chunk
+        self._hdul = None
+        self._chunks = None
+        self._chunk_start = None
+        self._cached = (None, None)
+
+        # Read the primary header and the position of the data unit
+        with fits.open(file_name, lazy_load_hdus=True) as hdul:
+            self.header = hdul[0].header.copy()
+            data_offset = hdul.fileinfo(0)['datLoc']
+
+        naxis = self.header['NAXIS']
+        if naxis == 0:
+            self._open_chunks()
+            return
+        elif naxis == 2:
+            shape = (1, self.header['NAXIS2'], self.header['NAXIS1'])
+        elif naxis == 3:
+            shape = (self.header['NAXIS3'], self.header['NAXIS2'], self.header['NAXIS1'])
+        else:
+            raise ValueError(f'{file_name} does not contain a stack of frames (NAXIS = {naxis}).')
+
+        self._bzero = self.header.get('BZERO', 0)
+        self._bscale = self.header.get('BSCALE', 1)
+        raw_dtype = np.dtype(_FITS_RAW_DTYPES[self.header['BITPIX']])
+
+        # Data type of the returned frames
+        self.dtype = _physical_dtype(self.header)
+
+        # Map the data unit into memory (nothing is read until frames are accessed)
+        self._raw = np.memmap(file_name, dtype=raw_dtype, mode='r', offset=data_offset, shape=shape) if shape[0] else np.empty(shape, dtype=raw_dtype)
+        self._shape = shape
+
+    def _open_chunks(self):
+        """Find the image extensions holding the frames of a file without primary data. """
+
+        self._hdul = fits.open(self.file_name, lazy_load_hdus=True)
+        self._chunks = []
+        counts = []
+        for i, hdu in enumerate(self._hdul[1:], start=1):
+            if isinstance(hdu, (fits.CompImageHDU, fits.ImageHDU)) and hdu.header.get('NAXIS', 0) in (2, 3):
+                self._chunks.append(i)
+                counts.append(hdu.header['NAXIS3'] if hdu.header['NAXIS'] == 3 else 1)
+        if not self._chunks:
+            raise ValueError(f'{self.file_name} does not contain frames.')
+
+        first = self._hdul[self._chunks[0]].header
+        self.dtype = _physical_dtype(first)
+        self._chunk_start = np.concatenate(([0], np.cumsum(counts)))
+        self._shape = (int(self._chunk_start[-1]), first['NAXIS2'], first['NAXIS1'])
+
+    def _read_chunk(self, chunk: int) -> np.ndarray:
+        """Decompress a chunk of frames (n, height, width). """
+
+        if self._cached[0] != chunk:
+            data = self._hdul[self._chunks[chunk]].data
+            self._cached = (chunk, data.reshape((-1, ) + self._shape[1:]).astype(self.dtype, copy=False))
+
+        return self._cached[1]
+
+    def _read_frames(self, index: np.ndarray, key: tuple = ()) -> np.ndarray:
+        """Read frames by index from the compressed chunks, selecting the parts key of the frames chunk by chunk. """
+
+        chunks = np.searchsorted(self._chunk_start, index, side='right') - 1
+        parts = []
+        for chunk in np.unique(chunks):
+            selected = index[chunks == chunk] - self._chunk_start[chunk]
+            parts.append(self._read_chunk(chunk)[(selected, ) + key])
+        frames = np.concatenate(parts)
+
+        if np.any(np.diff(index) < 0):
+            # Restore the requested order
+            frames = frames[np.argsort(np.argsort(chunks, kind='stable'))]
+
+        return frames
+
+    @property
+    def shape(self) -> tuple:
+        """Shape of the recording (n, height, width). """
+
+        return self._shape
+
+    def __len__(self) -> int:
+        return self._shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        """Read frames (or parts of frames) from disk. """
+
+        if self._chunks is None:
+            return self._convert(self._raw[key])
+
+        # Select the frames first and then the parts of the frames
+        key = key if isinstance(key, tuple) else (key, )
+        index = np.arange(len(self))[key[0]]
+        frames = self._read_frames(np.atleast_1d(index), key[1:])
+
+        return frames[0] if np.ndim(index) == 0 else frames
+
+    def _convert(self, raw: np.ndarray) -> np.ndarray:
+        """Convert raw data from the file to physical values. """
+
+        raw = np.asarray(raw)
+        if self.dtype == np.uint16 or self.dtype == np.uint32:
+            # Removing an offset of 2^15 (2^31) from a signed integer is the same as flipping the highest bit
+            unsigned = raw.view(raw.dtype.str.replace('i', 'u'))
+            return np.bitwise_xor(unsigned, self.dtype.type(self._bzero), dtype=self.dtype)
+        elif self._bscale != 1 or self._bzero != 0:
+            return raw * self._bscale + self._bzero
+        else:
+            return raw.astype(self.dtype)
+
+    def frames(self, chunk: int = 1):
+        """Iterate over the frames, reading chunk frames at a time.
+
+        # Arguments
+        * chunk::int - Number of frames read at once. For chunk > 1 stacks of frames are returned.
+        """
+
+        for i in range(0, len(self), chunk):
+            if chunk == 1:
+                yield self[i]
+            else:
+                yield self[i:i + chunk]
+
+    @property
+    def metadata(self) -> np.ndarray:
+        """Per-frame metadata table written by FitsStreamWriter (None if the file has none). """
+
+        if self._metadata is None:
+            with fits.open(self.file_name, lazy_load_hdus=True) as hdul:
+                try:
+                    self._metadata = np.array(hdul['FRAMES'].data)
+                except KeyError:
+                    return None
+
+        return self._metadata
+
+    def to_image_data(self, start: int = 0, stop: int = None) -> 'ImageData':
+        """Load frames into memory as ImageData. """
+
+        return ImageData(self[start:stop])
+
+    def close(self):
+        """Unmap or close the file. """
+
+        self._raw = None
+        self._cached = (None, None)
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f'FitsRecording({self.file_name}, {self.shape}, {self.dtype})'
+
+
+class FitsStreamWriter:
+    """Write frames to a FITS file on disk as they arrive.
+
+    The primary header is written with the first frame and rewritten in place on close with the final number of
+    frames (NAXIS3) and DATAMIN/DATAMAX, so only the frames which are currently written have to be kept in memory.
+    Per-frame metadata passed to append is stored in a binary table extension called FRAMES.
+    """
+
+    def __init__(self, file_name: str, header: dict = None, overwrite=True, chunk_bytes: int = 2**24):
+        """Constructor.
+
+        # Arguments
+        * file_name::str - Name of the FITS file.
+        * header::dict - Additional header entries (entries which are None are not saved).
+        * overwrite::bool - Overwrite the file if it exists.
+        * chunk_bytes::int - Maximum size of the temporary buffer used for converting frames to the FITS format.
+        """
+
+        self.file_name = file_name
+        self.n_frames = 0
+        self.data_min = None
+        self.data_max = None
+
+        self._header_data = {} if header is None else header
+        self._overwrite = overwrite
+        self._chunk_bytes = chunk_bytes
+
+        self._file = None
+        self._header = None
+        self._frame_shape = None
+        self._dtype = None
+        self._fits_dtype = None
+        self._bzero = None
+        self._data_bytes = 0
+
+        # Per-frame metadata (column name -> list of arrays)
+        self._meta = {}
+
+    def _open(self, frame_shape: tuple, dtype: np.dtype):
+        """Open the file and write a preliminary header. """
+
+        if dtype not in _FITS_FORMATS:
+            raise ValueError(f'Data type {dtype} can not be saved as FITS.')
+
+        self._frame_shape = tuple(frame_shape)
+        self._dtype = dtype
+        bitpix, self._bzero, self._fits_dtype = _FITS_FORMATS[dtype]
+
+        # Mandatory keywords (NAXIS3 and DATAMIN/DATAMAX are updated when closing)
+        self._header = fits.Header([
+            ('SIMPLE', True),
+            ('BITPIX', bitpix),
+            ('NAXIS', 3),
+            ('NAXIS1', self._frame_shape[1]),
+            ('NAXIS2', self._frame_shape[0]),
+            ('NAXIS3', 0),
+            ('EXTEND', True),
+        ])
+        if self._bzero is not None:
+            self._header['BZERO'] = self._bzero
+            self._header['BSCALE'] = 1
+        self._header['DATAMIN'] = 0
+        self._header['DATAMAX'] = 0
+
+        # Set all header entries which are not None
+        for key, value in self._header_data.items():
+            if value is not None:
+                self._header[key] = value
+
+        self._file = open(self.file_name, 'wb' if self._overwrite else 'xb')
+        self._file.write(self._header.tostring().encode('ascii'))
+
+    def append(self, frames: np.ndarray, **meta):
+        """Append a single frame or a stack of frames.
+
+        # Arguments
+        * frames::np.ndarray - Frame (height, width) or stack of frames (n, height, width).
+        * meta - Per-frame metadata (scalars for a single frame or arrays of length n). The columns have to be the
+                 same for all frames.
+        """
+
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        if len(frames) == 0:
+            return
+
+        if self._file is not None and frames.shape[1:] != self._frame_shape:
+            raise ValueError(f'Frame shape {frames.shape[1:]} does not match {self._frame_shape}.')
+        # Every column of the metadata has to cover all frames
+        meta = _frame_meta(self._meta, meta, self.n_frames, len(frames))
+        if self._file is None:
+            self._open(frames.shape[1:], frames.dtype)
 
+        # Update the data range
+        frames_min = frames.min()
+        frames_max = frames.max()
+        self.data_min = frames_min if self.data_min is None else min(self.data_min, frames_min)
+        self.data_max = frames_max if self.data_max is None else max(self.data_max, frames_max)
+
+        # Convert and write the frames in chunks to limit the size of temporary buffers
+        frame_bytes = frames[0].size * np.dtype(self._fits_dtype).itemsize
+        chunk = max(1, self._chunk_bytes // frame_bytes)
+        for i in range(0, len(frames), chunk):
+            self._write_data(frames[i:i + chunk])
+
+        # Store the metadata
+        for key, value in meta.items():
+            self._meta.setdefault(key, []).append(value)
+
+        if 'T_NS' in meta:
+            # Time from reading out the frames until they were written
+            get_telemetry().latency('capture_to_disk', (time.perf_counter_ns() - self._meta['T_NS'][-1]) * 1e-9)
+
+        self.n_frames += len(frames)
+
+    def _write_data(self, frames: np.ndarray):
+        """Write frames in the big endian FITS representation. """
+
+        if self._bzero == 2**15:
+            # Storing uint16 as int16 with an offset of 2^15 is the same as flipping the highest bit
+            data = np.empty(frames.shape, dtype='>u2')
+            np.bitwise_xor(frames, np.uint16(0x8000), out=data, casting='unsafe')
+        elif self._bzero == 2**31:
+            data = np.empty(frames.shape, dtype='>u4')
+            np.bitwise_xor(frames, np.uint32(0x80000000), out=data, casting='unsafe')
+        else:
+            data = np.ascontiguousarray(frames, dtype=self._fits_dtype)
+
+        self._file.write(data.data)
+        self._data_bytes += data.nbytes
+
+    def close(self):
+        """Finalize the header and write the metadata table. """
+
+        if self._file is None:
+            return
+
+        # Pad the data to a full FITS block
+        padding = -self._data_bytes % _FITS_BLOCK
+        self._file.write(b'\0' * padding)
+
+        # Rewrite the header with the final values (the size of the header does not change)
+        self._header['NAXIS3'] = self.n_frames
+        self._header['DATAMIN'] = self.data_min.item()
+        self._header['DATAMAX'] = self.data_max.item()
+        self._file.seek(0)
+        self._file.write(self._header.tostring().encode('ascii'))
+        self._file.close()
+        self._file = None
+
+        # Append the per-frame metadata
+        if self._meta:
+            _append_frame_table(self.file_name, self._meta, self.n_frames)
+            self._meta = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f'FitsStreamWriter({self.file_name})'
+
+
+class FitsCompressedWriter:
+    """Write frames to a tile-compressed FITS file as they arrive.
+
+    The frames are collected into chunks of chunk_frames frames and every chunk is stored as a compressed image
+    extension (CompImageHDU, see the FITS tiled image compression convention), so the file can be read by standard
+    FITS tools. The primary HDU has no data and holds the header entries and NFRAMES, DATAMIN and DATAMAX, which are
+    rewritten in place on close. Per-frame metadata is stored in the binary table FRAMES like by FitsStreamWriter.
+
+    Chunks are compressed by the processes of pool (if given) and written in order as they are finished. At most
+    max_pending chunks are compressed at the same time to limit the memory held by the pool.
+    """
+
+    def __init__(self, file_name: str, header: dict = None, overwrite=True, compression_type: str = 'RICE_1',
+                 tile_shape: tuple = None, hcomp_scale: float = 0, chunk_frames: int = 100,
+                 pool=None, max_pending: int = 8):
+        """Constructor.
+
+        # Arguments
+        * file_name::str - Name of the FITS file.
+        * header::dict - Additional header entries (entries which are None are not saved).
+        * overwrite::bool - Overwrite the file if it exists.
+        * compression_type::str - One of COMPRESSION_TYPES.
+        * tile_shape::tuple - Shape of the compression tiles (frames, rows, columns). None compresses every frame as a
+                              single tile.
+        * hcomp_scale::float - Scale of HCOMPRESS_1 (0 for lossless compression).
+        * chunk_frames::int - Number of frames per extension.
+        * pool::concurrent.futures.Executor - Pool compressing the chunks (None to compress in this process).
+        * max_pending::int - Maximum number of chunks compressed at the same time.
+        """
+
+        if compression_type not in COMPRESSION_TYPES:
+            raise ValueError(f'Compression {compression_type} not known.')
+
+        self.file_name = file_name
+        self.n_frames = 0
+        self.data_min = None
+        self.data_max = None
+
+        self._header_data = {} if header is None else header
+        self._overwrite = overwrite
+        self._options = {'compression_type': compression_type, 'tile_shape': tile_shape, 'hcomp_scale': hcomp_scale}
+        self._chunk_frames = int(chunk_frames)
+        self._pool = pool
+        self._max_pending = max_pending
+
+        self._file = None
+        self._header = None
+        self._frame_shape = None
+
+        # Frames of the incomplete chunk, chunks being compressed (futures or compressed bytes) in file order
+        self._partial = []
+        self._n_partial = 0
+        self._n_submitted = 0
+        self._pending = deque()
+
+        # Number of bytes of the uncompressed frames and of the file
+        self.raw_bytes = 0
+        self.file_bytes = 0
+
+        # Per-frame metadata (column name -> list of arrays)
+        self._meta = {}
+
+    def _open(self, frame_shape: tuple, dtype: np.dtype):
+        """Open the file and write a preliminary primary header. """
+
+        if dtype not in _FITS_FORMATS or dtype.kind == 'f':
+            raise ValueError(f'Data type {dtype} can not be compressed losslessly.')
+
+        self._frame_shape = tuple(frame_shape)
+        if self._options['tile_shape'] is None:
+            self._options['tile_shape'] = (1, ) + self._frame_shape
+
+        # NFRAMES and DATAMIN/DATAMAX are updated when closing
+        self._header = fits.Header([
+            ('SIMPLE', True),
+            ('BITPIX', 8),
+            ('NAXIS', 0),
+            ('EXTEND', True),
+            ('NFRAMES', 0, 'Number of frames in the image extensions'),
+            ('DATAMIN', 0),
+            ('DATAMAX', 0),
+        ])
+
+        # Set all header entries which are not None
+        for key, value in self._header_data.items():
+            if value is not None:
+                self._header[key] = value
+
+        self._file = open(self.file_name, 'wb' if self._overwrite else 'xb')
+        self._file.write(self._header.tostring().encode('ascii'))
+
+    def append(self, frames: np.ndarray, **meta):
+        """Append a single frame or a stack of frames.
+
+        # Arguments
+        * frames::np.ndarray - Frame (height, width) or stack of frames (n, height, width).
+        * meta - Per-frame metadata (scalars for a single frame or arrays of length n). The columns have to be the
+                 same for all frames.
+        """
+
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        if len(frames) == 0:
+            return
+
+        if self._file is not None and frames.shape[1:] != self._frame_shape:
+            raise ValueError(f'Frame shape {frames.shape[1:]} does not match {self._frame_shape}.')
+        # Every column of the metadata has to cover all frames
+        meta = _frame_meta(self._meta, meta, self.n_frames, len(frames))
+        if self._file is None:
+            self._open(frames.shape[1:], frames.dtype)
+
+        # Update the data range
+        frames_min = frames.min()
+        frames_max = frames.max()
+        self.data_min = frames_min if self.data_min is None else min(self.data_min, frames_min)
+        self.data_max = frames_max if self.data_max is None else max(self.data_max, frames_max)
+
+        # Complete the partial chunk, then compress full chunks directly from the frames
+        i = 0
+        if self._n_partial:
+            i = min(self._chunk_frames - self._n_partial, len(frames))
+            self._add_partial(frames[:i])
+        while len(frames) - i >= self._chunk_frames:
+            self._submit(frames[i:i + self._chunk_frames])
+            i += self._chunk_frames
+        if i < len(frames):
+            self._add_partial(frames[i:])
+
+        # Store the metadata
+        for key, value in meta.items():
+            self._meta.setdefault(key, []).append(value)
+
+        self.n_frames += len(frames)
+        self.raw_bytes += frames.nbytes
+        self._write_finished()
+
+        if 'T_NS' in meta:
+            # Time from reading out the frames until they were handed to the compression
+            get_telemetry().latency('capture_to_disk', (time.perf_counter_ns() - self._meta['T_NS'][-1]) * 1e-9)
+
+    def _add_partial(self, frames: np.ndarray):
+        """Keep a copy of frames for the incomplete chunk. """
+
+        self._partial.append(np.array(frames))
+        self._n_partial += len(frames)
+        if self._n_partial == self._chunk_frames:
+            self._submit(np.concatenate(self._partial))
+            self._partial = []
+            self._n_partial = 0
+
+    def _submit(self, chunk: np.ndarray):
+        """Compress a chunk in the pool or in this process. """
+
+        if self._pool is None:
+            self._pending.append(compress_chunk(chunk, self._n_submitted, self._options))
+        else:
+            # The pool pickles the arguments in the background, so it gets its own copy of the frames
+            self._pending.append(self._pool.submit(compress_chunk, np.array(chunk), self._n_submitted, self._options))
+        self._n_submitted += len(chunk)
+
+        # Wait for the oldest chunk if too many chunks are compressed at the same time
+        while len(self._pending) > self._max_pending:
+            self._write_chunk(self._pending.popleft())
+
+    def _write_finished(self, wait: bool = False):
+        """Write the compressed chunks in order (waiting for all of them if wait is True). """
+
+        while self._pending and (wait or isinstance(self._pending[0], bytes) or self._pending[0].done()):
+            self._write_chunk(self._pending.popleft())
+
+    def _write_chunk(self, chunk):
+        """Write a compressed chunk (bytes or future). """
+
+        data = chunk if isinstance(chunk, bytes) else chunk.result()
+        self._file.write(data)
+        self.file_bytes += len(data)
+
+    def close(self):
+        """Write the remaining chunks, finalize the header and write the metadata table. """
+
+        if self._file is None:
+            return
+
+        if self._n_partial:
+            self._submit(np.concatenate(self._partial))
+            self._partial = []
+            self._n_partial = 0
+        self._write_finished(wait=True)
+
+        # Rewrite the header with the final values (the size of the header does not change)
+        self._header['NFRAMES'] = self.n_frames
+        self._header['DATAMIN'] = self.data_min.item()
+        self._header['DATAMAX'] = self.data_max.item()
+        self._file.seek(0)
+        self._file.write(self._header.tostring().encode('ascii'))
+        self._file.close()
+        self._file = None
+        self.file_bytes += len(self._header.tostring())
+
+        # Append the per-frame metadata
+        if self._meta:
+            _append_frame_table(self.file_name, self._meta, self.n_frames)
+            self._meta = {}
+
+    @property
+    def ratio(self) -> float:
+        """Compression ratio of the frames written so far. """
+
+        return self.raw_bytes / self.file_bytes if self.file_bytes else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f'FitsCompressedWriter({self.file_name}, {self._options["compression_type"]})'
 
 
 class ImageData:
-    def __init__(self, image_data: list = [], exp_time=None, start_time=None, end_time=None, bit_depth=None):
+    """Stack of frames with header data. The frames are kept in a contiguous numpy cube which grows as needed. """
+
+    def __init__(self, image_data: np.ndarray = None, exp_time=None, start_time=None, end_time=None, bit_depth=None, frame_meta: dict = None, binning: int = None,
+                 temperature: float = None, origin: tuple = None, calibrated: bool = None, n_combined: int = None,
+                 selection: str = None, n_burst: int = None, camera: str = None, sync_id: str = None):
         # Initialize the image data
-        if isinstance(image_data, (np.array)):
-            image_data = image_data.tolist()
-            
-        self._image_data = image_data
+        self._cube = None
+        self._n_frames = 0
+
+        # Per-frame metadata (column name -> list of arrays), saved in the FRAMES table
+        self._meta = {}
+
+        # Data range of all frames
+        self._data_min = None
+        self._data_max = None
 
         # Set the header entries (all entries which are None will not be saved)
         self._header_data = {
             'DATE': _format_date(start_time),
-            'BITPIX': bit_depth,
+            'BITDEPTH': bit_depth,
             'exp_time': exp_time,
             'start_time': _format_time(start_time),
-            'end_time': _format_time(end_time)
+            'end_time': _format_time(end_time),
+            'XBINNING': binning,
+            'YBINNING': binning,
+            # Sensor temperature (°C), top left corner of the ROI in unbinned sensor pixels and whether the frames were
+            # calibrated (see Calibration)
+            'CCD-TEMP': temperature,
+            'XORGSUBF': origin[0] if origin is not None else None,
+            'YORGSUBF': origin[1] if origin is not None else None,
+            'CALIBRAT': calibrated,
+            # Number of frames combined into each frame (e.g., by LiveStacker)
+            'NCOMBINE': n_combined,
+            # Sharpness metric the frames were selected by and the number of frames they were selected from (see
+            # FrameSelector)
+            'SELECT': selection,
+            'NBURST': n_burst,
+            # Camera model and session of a recording synchronized with other cameras (see SyncCapture)
+            'INSTRUME': camera,
+            'SYNCID': sync_id,
         }
 
-    def add_image_data(self, image_data: list):
-        if isinstance(image_data, (np.array)):
-            image_data = image_data.tolist()
-        self._image_data += image_data
+        if image_data is not None:
+            self.add_image_data(image_data, **(frame_meta or {}))
+
+    @property
+    def frame_meta(self) -> dict:
+        """Per-frame metadata (column name -> array with one entry per frame). """
+
+        return {key: np.concatenate(values) for key, values in self._meta.items()}
+
+    @property
+    def image_data(self) -> np.ndarray:
+        """View of all frames (n, height, width). """
+
+        if self._cube is None:
+            return np.empty((0, 0, 0))
+        return self._cube[:self._n_frames]
+
+    def __len__(self) -> int:
+        return self._n_frames
+
+    def _reserve(self, n_frames: int, frame_shape: tuple, dtype: np.dtype):
+        """Make sure the cube can hold n_frames frames. The capacity is doubled to amortize reallocation. """
+
+        if self._cube is None:
+            self._cube = np.empty((n_frames, ) + frame_shape, dtype=dtype)
+            return
+
+        if frame_shape != self._cube.shape[1:]:
+            raise ValueError(f'Frame shape {frame_shape} does not match {self._cube.shape[1:]}.')
+
+        dtype = np.result_type(self._cube.dtype, dtype)
+        if n_frames > len(self._cube) or dtype != self._cube.dtype:
+            capacity = max(n_frames, 2 * len(self._cube)) if n_frames > len(self._cube) else len(self._cube)
+            cube = np.empty((capacity, ) + frame_shape, dtype=dtype)
+            cube[:self._n_frames] = self._cube[:self._n_frames]
+            self._cube = cube
+
+    def add_image_data(self, image_data: np.ndarray, **meta):
+        """Add a single frame (height, width) or a stack of frames (n, height, width).
+
+        Per-frame metadata (e.g., SEQ=seq, T_NS=timestamps) is given as scalars for a single frame or arrays of length
+        n. A column has to be given for all frames added.
+        """
+
+        image_data = np.asarray(image_data)
+        if image_data.ndim == 2:
+            image_data = image_data[np.newaxis]
+        if len(image_data) == 0:
+            return
+
+        meta = _frame_meta(self._meta, meta, self._n_frames, len(image_data))
+        for key, value in meta.items():
+            self._meta.setdefault(key, []).append(value)
+
+        n_frames = self._n_frames + len(image_data)
+        self._reserve(n_frames, image_data.shape[1:], image_data.dtype)
+        self._cube[self._n_frames:n_frames] = image_data
+        self._n_frames = n_frames
+
+        # Update the data range
+        data_min = image_data.min()
+        data_max = image_data.max()
+        self._data_min = data_min if self._data_min is None else min(self._data_min, data_min)
+        self._data_max = data_max if self._data_max is None else max(self._data_max, data_max)
+
+    def calibrate(self, calibration):
+        """Calibrate all frames in place (see Calibration) and mark them as calibrated in the header. """
+
+        if self._header_data['CALIBRAT']:
+            raise ValueError('Frames are already calibrated.')
+        if self._n_frames == 0:
+            return
+
+        frames = self.image_data
+        calibration(frames, out=frames)
+        self._data_min = frames.min()
+        self._data_max = frames.max()
+        self._header_data['CALIBRAT'] = True
+
+    def _generate_file_name(self) -> str:
+        """Generate a file name from the start time of the data. """
+
+        if self._header_data['DATE'] is None or self._header_data['start_time'] is None:
+            # Use the current time if not both DATE and start_time were set
+            now = datetime.utcnow()
+            return f"{_format_date(now)}_{_format_time(now)}.fits"
+        else:
+            # Otherwise use DATE and start_time of the data
+            return f"{self._header_data['DATE']}_{self._header_data['start_time']}.fits"
+
+    def open_stream(self, file_name: str = '', overwrite=True, compression: dict = None, pool=None):
+        """Get a writer for streaming frames with the header of this object directly to disk.
+
+        # Arguments
+        * compression::dict - Arguments of FitsCompressedWriter, e.g., {'compression_type': 'RICE_1'} (None for an
+                              uncompressed file).
+        * pool::concurrent.futures.Executor - Pool compressing the frames (None to compress in this process).
+        """
 
-    def write_fits_to_file(self, file_name: str = '', overwrite=True):
-        # Generate the file name if none was given
         if file_name == '':
-            if self._header_data['DATE'] is None or self._header_data['start_time'] is None:
-                # Use the current time if not both DATE and start_time were set
-                now = datetime.utcnow()
-                file_name = f"{self._format_date(now)}_{self._format_time(now)}.fits"
-            else:
-                # Otherwise use DATE and start_time of the data
-                file_name = f"{self._header_data['DATE']}_{self._header_data['start_time']}.fits"
+            file_name = self._generate_file_name()
+
+        if compression is None:
+            return FitsStreamWriter(file_name, self._header_data, overwrite)
+
+        return FitsCompressedWriter(file_name, self._header_data, overwrite, pool=pool, **compression)
 
-        # Get the Header Data Unit list
-        hdul = self._generate_fits_image_data()
+    def write_fits_to_file(self, file_name: str = '', overwrite=True, compression: dict = None, pool=None):
+        # Make sure that images have been added
+        if self._n_frames == 0:
+            raise ValueError('No image data to save.')
 
         # Save data to file
-        hdul.writeto(file_name, overwrite=overwrite)
+        with self.open_stream(file_name, overwrite, compression, pool) as writer:
+            writer.append(self.image_data, **self.frame_meta)
 
     def _generate_fits_header(self):
         # Initialize the header
         hdr = fits.Header()
 
-        if len(self._image_data):
+        if self._n_frames:
             # Set Fits header data related to the image
-            hdr['DATAMIN'] = np.min(self._image_data)
-            hdr['DATAMAX'] = np.max(self._image_data)
+            hdr['DATAMIN'] = self._data_min.item()
+            hdr['DATAMAX'] = self._data_max.item()
 
-        # Set all values of self._header_data which are not None 
+        # Set all values of self._header_data which are not None
         for key, value in self._header_data.items():
             if value is not None:
                 hdr[key] = value
@@ -80,21 +868,21 @@ class ImageData:
 
     def _generate_fits_image_data(self):
         # Make sure that images have been added
-        if len(self._image_data) == 0:
+        if self._n_frames == 0:
             raise ValueError('No image data to save.')
 
         # Generate the header
         hdr = self._generate_fits_header()
 
         # Generate the primary image HDU and add the header
-        primary_hdu = fits.PrimaryHDU(self._image_data, header=hdr)
+        primary_hdu = fits.PrimaryHDU(self.image_data, header=hdr)
 
         return fits.HDUList(primary_hdu)
 
 
 if __name__ == '__main__':
     data = 255 * np.random.rand(10, 64, 64)
-    data = data.astype(np.int).tolist()
+    data = data.astype(np.uint8)
 
     image_data = ImageData(data)
     image_data.write_fits_to_file('test.fits')
@@ -102,4 +890,4 @@ if __name__ == '__main__':
     #fits_image_filename = '2021-12-31_18:33:29.fits'
 
     hdul = fits.open('test.fits')
-    print(hdul.info())
\ No newline at end of file
+    print(hdul.info())
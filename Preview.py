@@ -0,0 +1,197 @@
+from FrameProcessing import sum_blocks
+import numpy as np
+import logging
+import time
+
+
+# Stretches which can be applied to the preview
+STRETCHES = ('linear', 'sqrt', 'asinh', 'auto')
+
+
+def stretch_lut(stretch: str, n_levels: int, lo: int = 0, hi: int = None, asinh_beta: float = 10) -> np.ndarray:
+    """Generate a lookup table mapping pixel values to 8 bit display values.
+
+    # Arguments
+    * stretch::str - 'linear', 'sqrt' or 'asinh' ('auto' is a linear stretch between percentiles).
+    * n_levels::int - Number of possible pixel values (e.g., 256 for 8 bit frames).
+    * lo::int - Pixel value which is mapped to black.
+    * hi::int - Pixel value which is mapped to white (default: n_levels - 1).
+    * asinh_beta::float - Softening of the asinh stretch.
+
+    # Returns
+    * lut::np.ndarray - Lookup table of n_levels uint8 values.
+    """
+
+    if hi is None:
+        hi = n_levels - 1
+    hi = max(hi, lo + 1)
+
+    # Normalize to [0, 1]
+    x = np.clip((np.arange(n_levels, dtype=np.float64) - lo) / (hi - lo), 0, 1)
+
+    if stretch in ('linear', 'auto'):
+        y = x
+    elif stretch == 'sqrt':
+        y = np.sqrt(x)
+    elif stretch == 'asinh':
+        y = np.arcsinh(asinh_beta * x) / np.arcsinh(asinh_beta)
+    else:
+        raise ValueError(f'Stretch {stretch} not known.')
+
+    return np.round(255 * y).astype(np.uint8)
+
+
+class PreviewRenderer:
+    """Render camera frames into 8 bit preview images.
+
+    The frame is reduced by an integer block mean (or enlarged by an integer factor) to fit into the output size
+    while keeping its aspect ratio, and mapped to display values with a precomputed stretch LUT. All intermediate
+    buffers are allocated once per frame format, and the output is a contiguous uint8 array which can be handed to
+    a QImage directly.
+
+    Frames with more than 16 bits (e.g., summed by software binning) are shifted to the 16 highest of their value_bits
+    significant bits.
+    """
+
+    def __init__(self, max_w: int = 640, max_h: int = 480, stretch: str = 'linear', auto_percentiles: tuple = (0.5, 99.5)):
+        """Constructor.
+
+        # Arguments
+        * max_w::int - Maximum width of the preview.
+        * max_h::int - Maximum height of the preview.
+        * stretch::str - Stretch applied to the preview (see STRETCHES).
+        * auto_percentiles::tuple - Percentiles mapped to black and white by the 'auto' stretch.
+        """
+
+        self.max_w = max_w
+        self.max_h = max_h
+        self.auto_percentiles = auto_percentiles
+        self.stretch = stretch
+
+        # Number of significant bits of frames with more than 16 bits
+        self.value_bits = 32
+
+        # Cost of rendering the last frame and moving average (in s)
+        self.last_cost = 0
+        self.mean_cost = 0
+        self.n_rendered = 0
+
+        self._format = None
+        self._lut = None
+        self._lut_key = None
+
+    @property
+    def stretch(self) -> str:
+        return self._stretch
+
+    @stretch.setter
+    def stretch(self, stretch: str):
+        if stretch not in STRETCHES:
+            raise ValueError(f'Stretch {stretch} not known.')
+        self._stretch = stretch
+
+    def set_output_size(self, max_w: int, max_h: int):
+        """Change the maximum size of the preview (e.g., after the display was resized). """
+
+        if (max_w, max_h) != (self.max_w, self.max_h):
+            self.max_w = max_w
+            self.max_h = max_h
+            self._format = None
+
+    def _setup(self, shape: tuple, dtype: np.dtype):
+        """Compute the scaling and allocate the buffers for a frame format. """
+
+        if dtype.kind != 'u' or dtype.itemsize > 4:
+            raise ValueError(f'Frames of type {dtype} cannot be previewed.')
+
+        h, w = shape
+        # Reduce by the smallest integer factor which makes the frame fit, or enlarge by the largest one which fits
+        block = max(int(np.ceil(h / self.max_h)), int(np.ceil(w / self.max_w)), 1)
+        zoom = max(min(self.max_h // h, self.max_w // w), 1) if block == 1 else 1
+
+        reduced_h, reduced_w = h // block, w // block
+
+        # Sums over the rows of each block, and block sums of up to block**2 pixels (reduced in place to the mean and
+        # shifted to 16 bits for wider frames)
+        acc_dtype = np.uint64 if dtype.itemsize > 2 else np.uint32
+        rows = np.empty((reduced_h, reduced_w * block), dtype=acc_dtype) if block > 1 else None
+        acc = np.empty((reduced_h, reduced_w), dtype=acc_dtype) if block > 1 or dtype.itemsize > 2 else None
+        # Display values of the reduced frame and the (enlarged) output
+        reduced = np.empty((reduced_h, reduced_w), dtype=np.uint8)
+        out = reduced if zoom == 1 else np.empty((reduced_h * zoom, reduced_w * zoom), dtype=np.uint8)
+
+        self._format = (shape, dtype, block, zoom, rows, acc, reduced, out)
+        logging.debug(f'{self} renders {w}x{h} frames to {out.shape[1]}x{out.shape[0]} (block {block}, zoom {zoom})')
+
+    def _levels(self, data: np.ndarray, n_levels: int) -> tuple:
+        """Get the pixel values mapped to black and white. """
+
+        if self.stretch != 'auto':
+            return 0, n_levels - 1
+
+        # Percentiles from the histogram of the reduced frame
+        cdf = np.cumsum(np.bincount(data.ravel(), minlength=n_levels))
+        lo, hi = np.searchsorted(cdf, np.array(self.auto_percentiles) / 100 * cdf[-1])
+        return int(lo), int(hi)
+
+    def _get_lut(self, n_levels: int, lo: int, hi: int) -> np.ndarray:
+        """Get the stretch LUT, only recomputing it if the stretch or the levels changed. """
+
+        key = (self.stretch, n_levels, lo, hi)
+        if key != self._lut_key:
+            self._lut = stretch_lut(self.stretch, n_levels, lo, hi)
+            self._lut_key = key
+
+        return self._lut
+
+    def render(self, frame: np.ndarray) -> np.ndarray:
+        """Render a frame.
+
+        # Arguments
+        * frame::np.ndarray - 2D frame of uint8 or uint16 pixels.
+
+        # Returns
+        * out::np.ndarray - Contiguous uint8 preview. The buffer is reused by the next call.
+        """
+
+        t_s = time.perf_counter()
+
+        if self._format is None or self._format[:2] != (frame.shape, frame.dtype):
+            self._setup(frame.shape, frame.dtype)
+        _, _, block, zoom, rows, acc, reduced, out = self._format
+
+        n_levels = 1 << (8 * min(frame.dtype.itemsize, 2))
+
+        if block > 1:
+            # Block mean over the part of the frame divisible by the block size
+            sum_blocks(frame, block, rows, acc)
+            np.floor_divide(acc, block * block, out=acc)
+            data = acc
+        elif acc is not None:
+            np.copyto(acc, frame)
+            data = acc
+        else:
+            data = frame
+
+        if frame.dtype.itemsize > 2:
+            # Keep the 16 highest significant bits
+            np.right_shift(data, max(self.value_bits - 16, 0), out=data)
+            np.minimum(data, n_levels - 1, out=data)
+
+        lut = self._get_lut(n_levels, *self._levels(data, n_levels))
+        np.take(lut, data, out=reduced)
+
+        if zoom > 1:
+            # Enlarge by writing each pixel into a zoom x zoom block of the output
+            h, w = reduced.shape
+            out.reshape(h, zoom, w, zoom)[...] = reduced[:, None, :, None]
+
+        # Keep track of the cost per frame
+        self.last_cost = time.perf_counter() - t_s
+        self.n_rendered += 1
+        self.mean_cost += (self.last_cost - self.mean_cost) / min(self.n_rendered, 100)
+
+        return out
+
+    def __repr__(self) -> str:
+        return f'PreviewRenderer({self.max_w}x{self.max_h}, {self.stretch})'
@@ -3,7 +3,7 @@ from PyQt5.uic import loadUi
 from PyQt5 import QtCore as qtc
 
 class RoiWarningDialog(QDialog):
-    def __init__(self, roi_h: int):
+    def __init__(self, roi_h: int, estimate: tuple = None):
         # Call constructor of parent object
         super(RoiWarningDialog, self).__init__(flags=qtc.Qt.WindowStaysOnTopHint)
 
@@ -14,7 +14,12 @@ class RoiWarningDialog(QDialog):
         self.setWindowTitle('Warning: Large ROI')
 
         # Set warning text
-        text = f'Recording might be slow due to large ROI height ({roi_h}). \nDo you want to continue?'
+        text = f'Recording might be slow due to large ROI height ({roi_h}). \n'
+        if estimate is not None:
+            # Frame rate and data rate estimated from the readout model of the camera
+            fps, data_rate = estimate
+            text += f'Estimated: {fps:.0f} FPS ({data_rate / 1e6:.0f} MB/s). \n'
+        text += 'Do you want to continue?'
         self.WarningLabel.setText(text)
 
         # Connect signals
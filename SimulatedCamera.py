@@ -0,0 +1,450 @@
+from ZwoCamera import ZwoCameraBase, ZWO_IOError, ASI_ERROR_TIMEOUT
+from ZwoCamera import ASI_GAIN, ASI_EXPOSURE, ASI_BANDWIDTHOVERLOAD, ASI_TEMPERATURE, ASI_HARDWARE_BIN, ASI_HIGH_SPEED_MODE
+from ZwoCamera import ASI_COOLER_POWER_PERC, ASI_TARGET_TEMP, ASI_COOLER_ON, ASI_FAN_ON, ASI_IMG_RAW8, ASI_IMG_RAW16
+from CameraModels import CAMERA_MODELS, readout_frame_time
+import numpy as np
+import logging
+import time
+import os
+
+
+# Number of pre-rendered frames with independent noise
+_FRAME_BANK_SIZE = 4
+
+# Thermal model of the cooler
+_AMBIENT_TEMPERATURE = 20.0
+_MAX_COOLING = 35.0
+_THERMAL_TIME_CONSTANT = 30.0
+
+
+def sim_options_from_env(env: str = 'ZWO_SIM_OPTIONS') -> dict:
+    """Read options of the simulated camera from an environment variable, e.g., 'drop_rate=0.01,n_stars=20'. """
+
+    options = {}
+    for item in os.environ.get(env, '').split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            try:
+                options[key.strip()] = int(value)
+            except ValueError:
+                try:
+                    options[key.strip()] = float(value)
+                except ValueError:
+                    logging.warning(f'Ignoring option {item.strip()} of the simulated camera in {env} (not a number).')
+
+    return options
+
+
+class SimulatedCamera:
+    """Simulation of the zwoasi.Camera interface.
+
+    Renders a static star field with shot and read noise at the rate given by a readout model (exposure time, ROI
+    height, highspeed mode and USB bandwidth). Timeouts and dropped frames can be injected for testing the error handling.
+    """
+
+    def __init__(self, camera_name: str, sensor_w: int = None, sensor_h: int = None, bit_depth: int = None,
+                 row_time_us: tuple = None, bandwidth: float = None, n_stars: int = 30, seeing: float = 1.5,
+                 sky_rate: float = 200.0, bias: float = 100.0, read_noise: float = 3.0, timeout_rate: float = 0.0, drop_rate: float = 0.0,
+                 start_delay: float = 0.15, seed: int = 0):
+        """Constructor.
+
+        # Arguments
+        * camera_name::str - Name of the camera. Known models are listed in CAMERA_MODELS.
+        * sensor_w::int, sensor_h::int, bit_depth::int - Override the sensor of the model.
+        * row_time_us::tuple - Override the row readout time (normal, highspeed) in us.
+        * bandwidth::float - Override the USB bandwidth (in bytes per second).
+        * n_stars::int - Number of stars in the field.
+        * seeing::float - Standard deviation of the stars (in pixels).
+        * sky_rate::float - Sky background (in electrons per pixel and second).
+        * bias::float - Offset of the pixel values (in electrons).
+        * read_noise::float - Read noise (in electrons).
+        * timeout_rate::float - Probability that reading a frame times out.
+        * drop_rate::float - Probability that a frame is dropped.
+        * start_delay::float - Time the camera needs to deliver the first frame after video mode was started (in s).
+        * seed::int - Seed of the random number generator.
+        """
+
+        if camera_name in CAMERA_MODELS:
+            model = dict(CAMERA_MODELS[camera_name])
+        elif sensor_w is not None and sensor_h is not None:
+            model = dict(CAMERA_MODELS['ZWO ASI120MM Mini'])
+        else:
+            raise ValueError(f'Could not find camera model {camera_name}')
+        if not 0 <= timeout_rate <= 1:
+            raise ValueError(f'Timeout rate {timeout_rate} is not a probability.')
+        if not 0 <= drop_rate < 1:
+            # Dropped frames are skipped until a frame is not dropped
+            raise ValueError(f'Drop rate {drop_rate} has to be at least 0 and less than 1.')
+
+        # Apply overrides
+        for key, value in (('MaxWidth', sensor_w), ('MaxHeight', sensor_h), ('BitDepth', bit_depth),
+                           ('row_time_us', row_time_us), ('bandwidth', bandwidth)):
+            if value is not None:
+                model[key] = value
+
+        self.id = 0
+        self.name = camera_name
+        self._model = model
+
+        self._rng = np.random.default_rng(seed)
+        self._n_stars = int(n_stars)
+        self._seeing = seeing
+        self._sky_rate = sky_rate
+        self._bias = bias
+        self._read_noise = read_noise
+        self.timeout_rate = timeout_rate
+        self.drop_rate = drop_rate
+        self.start_delay = start_delay
+
+        # Control values
+        self._controls = {
+            ASI_GAIN: 0,
+            ASI_EXPOSURE: 10000,
+            ASI_BANDWIDTHOVERLOAD: 80,
+            ASI_HARDWARE_BIN: 0,
+            ASI_HIGH_SPEED_MODE: 0,
+            ASI_TARGET_TEMP: 0,
+            ASI_COOLER_ON: 0,
+            ASI_FAN_ON: 0,
+        }
+
+        # ROI format
+        self._bins = 1
+        self._image_type = ASI_IMG_RAW8
+        self._width = model['MaxWidth'] - model['MaxWidth'] % 8
+        self._height = model['MaxHeight'] - model['MaxHeight'] % 2
+        self._start_x = 0
+        self._start_y = 0
+
+        # Video state
+        self._capturing = False
+        self._next_frame_t = 0
+        self._n_frames = 0
+        self._dropped = 0
+
+        # Thermal state
+        self._sensor_temperature = _AMBIENT_TEMPERATURE
+        self._thermal_t = time.perf_counter()
+
+        # Star field (in electrons per second) and the pre-rendered frames of the current settings
+        self._star_field = self._render_star_field()
+        self._frame_bank = None
+
+    def _render_star_field(self) -> np.ndarray:
+        """Render the noise-free photon rate of the full sensor. """
+
+        h, w = self._model['MaxHeight'], self._model['MaxWidth']
+        field = np.full((h, w), self._sky_rate, dtype=np.float32)
+
+        # Place stars with log-uniform rates
+        x = self._rng.uniform(0, w, self._n_stars)
+        y = self._rng.uniform(0, h, self._n_stars)
+        rate = 10 ** self._rng.uniform(4, 7, self._n_stars)
+
+        # Add a Gaussian spot in a small window around each star
+        r = int(np.ceil(4 * self._seeing))
+        offsets = np.arange(-r, r + 1)
+        for x_i, y_i, rate_i in zip(x, y, rate):
+            cols = np.clip(int(x_i) + offsets, 0, w - 1)
+            rows = np.clip(int(y_i) + offsets, 0, h - 1)
+            spot = np.exp(-((cols[np.newaxis, :] - x_i) ** 2 + (rows[:, np.newaxis] - y_i) ** 2) / (2 * self._seeing ** 2))
+            field[np.ix_(rows, cols)] += rate_i * spot / (2 * np.pi * self._seeing ** 2)
+
+        return field
+
+    def _render_frame_bank(self):
+        """Pre-render frames with independent noise of the whole (binned) sensor for the current exposure time,
+        binning and image type. The ROI is cut out when a frame is read, so it can be changed without rendering.
+        """
+
+        bins = self._bins
+        exp_time = self._controls[ASI_EXPOSURE] * 1e-6
+
+        # Bin the star field
+        h, w = self._model['MaxHeight'] // bins, self._model['MaxWidth'] // bins
+        binned = self._star_field[:h * bins, :w * bins].reshape(h, bins, w, bins).sum(axis=(1, 3))
+
+        # Expected signal in electrons
+        signal = binned * exp_time
+        bias = self._bias * bins ** 2
+
+        # Full scale of the ADC in electrons
+        full_scale = (2 ** self._model['BitDepth'] - 1) * self._model['ElecPerADU']
+        dtype = np.uint16 if self._image_type == ASI_IMG_RAW16 else np.uint8
+        scale = np.iinfo(dtype).max / full_scale
+
+        bank = np.empty((_FRAME_BANK_SIZE, ) + signal.shape, dtype=dtype)
+        for i in range(_FRAME_BANK_SIZE):
+            electrons = self._rng.poisson(signal) + self._rng.normal(bias, self._read_noise * bins, signal.shape)
+            adu = np.clip(electrons * scale, 0, np.iinfo(dtype).max)
+            if dtype == np.uint16:
+                # Only the highest BitDepth bits of the 16 bit values are used
+                adu = np.floor(adu / 2 ** (16 - self._model['BitDepth'])) * 2 ** (16 - self._model['BitDepth'])
+            bank[i] = adu
+
+        self._frame_bank = bank
+
+    def frame_time(self) -> float:
+        """Time between two frames (in s) of the readout model. """
+
+        return readout_frame_time(self._model, self._width, self._height, self._image_type,
+                                  bool(self._controls[ASI_HIGH_SPEED_MODE]), self._controls[ASI_EXPOSURE] * 1e-6)
+
+    def _update_temperature(self):
+        """Relax the sensor temperature towards the equilibrium of the cooler. """
+
+        now = time.perf_counter()
+        if self._controls[ASI_COOLER_ON]:
+            equilibrium = max(self._controls[ASI_TARGET_TEMP], _AMBIENT_TEMPERATURE - _MAX_COOLING)
+        else:
+            equilibrium = _AMBIENT_TEMPERATURE
+
+        decay = np.exp(-(now - self._thermal_t) / _THERMAL_TIME_CONSTANT)
+        self._sensor_temperature = equilibrium + (self._sensor_temperature - equilibrium) * decay
+        self._thermal_t = now
+
+    def get_camera_property(self) -> dict:
+        """Get the properties of the camera (see zwoasi.Camera). """
+
+        return {
+            'Name': self.name,
+            'CameraID': self.id,
+            'MaxHeight': self._model['MaxHeight'],
+            'MaxWidth': self._model['MaxWidth'],
+            'IsColorCam': False,
+            'BayerPattern': 0,
+            'SupportedBins': list(self._model['SupportedBins']),
+            'SupportedVideoFormat': [ASI_IMG_RAW8, ASI_IMG_RAW16],
+            'PixelSize': self._model['PixelSize'],
+            'MechanicalShutter': False,
+            'ST4Port': False,
+            'IsCoolerCam': self._model['IsCoolerCam'],
+            'IsUSB3Host': self._model['IsUSB3Camera'],
+            'IsUSB3Camera': self._model['IsUSB3Camera'],
+            'ElecPerADU': self._model['ElecPerADU'],
+            'BitDepth': self._model['BitDepth'],
+            'IsTriggerCam': False,
+        }
+
+    def get_controls(self) -> dict:
+        """Get the available controls and their ranges (see zwoasi.Camera). """
+
+        def control(name, control_type, min_value, max_value, default, description):
+            return {
+                'Name': name,
+                'Description': description,
+                'MaxValue': max_value,
+                'MinValue': min_value,
+                'DefaultValue': default,
+                'IsAutoSupported': False,
+                'IsWritable': True,
+                'ControlType': control_type,
+            }
+
+        controls = {
+            'Gain': control('Gain', ASI_GAIN, 0, 400, 0, 'Gain'),
+            'Exposure': control('Exposure', ASI_EXPOSURE, 32, 2000000000, 10000, 'Exposure Time(us)'),
+            'BandWidth': control('BandWidth', ASI_BANDWIDTHOVERLOAD, 40, 100, 80, 'The total data transfer rate percentage'),
+            'HardwareBin': control('HardwareBin', ASI_HARDWARE_BIN, 0, 1, 0, 'Is hardware bin2:ON?'),
+            'HighSpeedMode': control('HighSpeedMode', ASI_HIGH_SPEED_MODE, 0, 1, 0, 'Is high speed mode:ON?'),
+            'Temperature': control('Temperature', ASI_TEMPERATURE, -500, 1000, 20, 'Sensor temperature(degrees Celsius)'),
+        }
+        controls['Temperature']['IsWritable'] = False
+
+        if self._model['IsCoolerCam']:
+            controls['CoolPowerPerc'] = control('CoolPowerPerc', ASI_COOLER_POWER_PERC, 0, 100, 0, 'Cooler power percent')
+            controls['CoolPowerPerc']['IsWritable'] = False
+            controls['TargetTemp'] = control('TargetTemp', ASI_TARGET_TEMP, -40, 30, 0, 'Target temperature(cool camera only)')
+            controls['CoolerOn'] = control('CoolerOn', ASI_COOLER_ON, 0, 1, 0, 'turn on/off cooler(cool camera only)')
+            controls['FanOn'] = control('FanOn', ASI_FAN_ON, 0, 1, 0, 'turn on/off fan(cool camera only)')
+
+        return controls
+
+    def get_control_value(self, control_type: int, auto=False) -> tuple:
+        """Get the value of a control (see zwoasi.Camera). """
+
+        if control_type == ASI_TEMPERATURE:
+            self._update_temperature()
+            return int(round(self._sensor_temperature * 10)), False
+        elif control_type == ASI_COOLER_POWER_PERC:
+            self._update_temperature()
+            power = (_AMBIENT_TEMPERATURE - self._sensor_temperature) / _MAX_COOLING * 100
+            return int(np.clip(power, 0, 100)), False
+
+        return self._controls.get(control_type, 0), False
+
+    def set_control_value(self, control_type: int, value, auto=False):
+        """Set the value of a control (see zwoasi.Camera). """
+
+        if control_type in (ASI_COOLER_ON, ASI_TARGET_TEMP):
+            # Let the temperature evolve with the old settings up to now
+            self._update_temperature()
+
+        self._controls[control_type] = int(value)
+
+        if control_type in (ASI_EXPOSURE, ASI_GAIN):
+            self._frame_bank = None
+
+    def get_roi_format(self) -> tuple:
+        """Get width, height, bins and image type of the ROI (see zwoasi.Camera). """
+
+        return self._width, self._height, self._bins, self._image_type
+
+    def set_roi_format(self, width: int, height: int, bins: int, image_type: int):
+        """Set width, height, bins and image type of the ROI (see zwoasi.Camera). """
+
+        if bins not in self._model['SupportedBins']:
+            raise ValueError('Illegal value for bins')
+        if width % 8 != 0 or width * bins > self._model['MaxWidth']:
+            raise ValueError('Illegal ROI width')
+        if height % 2 != 0 or height * bins > self._model['MaxHeight']:
+            raise ValueError('Illegal ROI height')
+        if image_type not in (ASI_IMG_RAW8, ASI_IMG_RAW16):
+            raise ValueError('Illegal image type')
+
+        if (bins, image_type) != (self._bins, self._image_type):
+            self._frame_bank = None
+        self._width, self._height, self._bins, self._image_type = width, height, bins, image_type
+        self._start_x, self._start_y = 0, 0
+
+    def get_roi_start_position(self) -> tuple:
+        """Get the start position of the ROI (in binned pixels, see zwoasi.Camera). """
+
+        return self._start_x, self._start_y
+
+    def set_roi_start_position(self, start_x: int, start_y: int):
+        """Set the start position of the ROI (in binned pixels, see zwoasi.Camera). """
+
+        if start_x < 0 or start_x + self._width > self._model['MaxWidth'] // self._bins:
+            raise ValueError('ROI and start position larger than binned sensor width')
+        if start_y < 0 or start_y + self._height > self._model['MaxHeight'] // self._bins:
+            raise ValueError('ROI and start position larger than binned sensor height')
+
+        self._start_x, self._start_y = start_x, start_y
+
+    def get_roi(self) -> tuple:
+        """Get start position, width and height of the ROI (see zwoasi.Camera). """
+
+        return self._start_x, self._start_y, self._width, self._height
+
+    def set_roi(self, start_x=None, start_y=None, width=None, height=None, bins=None, image_type=None):
+        """Set the ROI with the same defaults as zwoasi.Camera.set_roi. """
+
+        if bins is None:
+            bins = self._bins
+        if image_type is None:
+            image_type = self._image_type
+
+        binned_w = self._model['MaxWidth'] // bins
+        binned_h = self._model['MaxHeight'] // bins
+        if width is None:
+            width = binned_w - binned_w % 8
+        if height is None:
+            height = binned_h - binned_h % 2
+        if start_x is None:
+            start_x = (binned_w - width) // 2
+        if start_y is None:
+            start_y = (binned_h - height) // 2
+
+        self.set_roi_format(width, height, bins, image_type)
+        self.set_roi_start_position(start_x, start_y)
+
+    def start_video_capture(self):
+        """Start video mode. """
+
+        self._capturing = True
+        self._dropped = 0
+        if self._frame_bank is None:
+            self._render_frame_bank()
+        self._next_frame_t = time.perf_counter() + self.start_delay + self.frame_time()
+
+    def stop_video_capture(self):
+        """Stop video mode. """
+
+        self._capturing = False
+
+    def get_dropped_frames(self) -> int:
+        """Get the number of frames dropped since the video mode was started. """
+
+        return self._dropped
+
+    def _read_video_data(self, out: np.ndarray, timeout: int):
+        """Wait for the next frame of the readout model and copy it into out. """
+
+        if not self._capturing:
+            raise ZWO_IOError('Video capture not started')
+
+        if self._frame_bank is None:
+            self._render_frame_bank()
+
+        frame_time = self.frame_time()
+
+        # Frames which were not read out in time are dropped by the camera
+        late = time.perf_counter() - self._next_frame_t
+        if late > frame_time:
+            missed = int(late / frame_time)
+            self._dropped += missed
+            self._next_frame_t += missed * frame_time
+
+        # Inject dropped frames (the next frame arrives one frame time later)
+        while self.drop_rate and self._rng.random() < self.drop_rate:
+            self._dropped += 1
+            self._next_frame_t += frame_time
+
+        # Time out if the frame would not arrive in time or a timeout is injected
+        wait = self._next_frame_t - time.perf_counter()
+        timed_out = self.timeout_rate and self._rng.random() < self.timeout_rate
+        if timeout >= 0 and (timed_out or wait > timeout * 1e-3):
+            time.sleep(timeout * 1e-3)
+            self._next_frame_t = time.perf_counter() + frame_time
+            raise ZWO_IOError('Timeout', ASI_ERROR_TIMEOUT)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        frame = self._frame_bank[self._n_frames % _FRAME_BANK_SIZE]
+        np.copyto(out, frame[self._start_y:self._start_y + self._height, self._start_x:self._start_x + self._width])
+        self._n_frames += 1
+        self._next_frame_t += frame_time
+
+    def get_video_data(self, timeout=None, buffer_=None) -> bytearray:
+        """Read the next video frame into a bytearray (see zwoasi.Camera). """
+
+        width, height, _, image_type = self.get_roi_format()
+        dtype = np.uint16 if image_type == ASI_IMG_RAW16 else np.uint8
+        if buffer_ is None:
+            buffer_ = bytearray(width * height * np.dtype(dtype).itemsize)
+        if timeout is None:
+            timeout = self._controls[ASI_EXPOSURE] * 2e-3 + 500
+
+        self._read_video_data(np.frombuffer(buffer_, dtype=dtype).reshape(height, width), int(timeout))
+        return buffer_
+
+    def capture_video_frame(self, buffer_=None, filename=None, timeout=None) -> np.ndarray:
+        """Read the next video frame into a new array (see zwoasi.Camera). """
+
+        width, height, _, image_type = self.get_roi_format()
+        dtype = np.uint16 if image_type == ASI_IMG_RAW16 else np.uint8
+        data = self.get_video_data(timeout, buffer_)
+        return np.frombuffer(data, dtype=dtype).reshape(height, width)
+
+    def close(self):
+        """Close the camera. """
+
+        self._capturing = False
+
+
+class SimulatedZwoCamera(ZwoCameraBase, SimulatedCamera):
+    """Drop-in replacement of ZwoCamera which does not require a camera or the ZWO SDK. """
+
+    def __init__(self, camera_name: str, **options):
+        """Constructor. Options are passed to SimulatedCamera, default options are read from ZWO_SIM_OPTIONS. """
+
+        sim_options = sim_options_from_env()
+        sim_options.update(options)
+
+        super(SimulatedZwoCamera, self).__init__(camera_name, **sim_options)
+        logging.info(f'{self} simulating {camera_name} with options {sim_options}')
+
+    def __repr__(self) -> str:
+        return f'SimulatedZwoCamera({self.name})'
@@ -0,0 +1,245 @@
+import numpy as np
+
+
+# Methods for combining the frames of a live stack
+STACK_METHODS = ('mean', 'ema', 'clipped')
+
+# Size of the bands of rows of the window which are clipped at once (in bytes of float32 pixels)
+CLIP_BAND_BYTES = 2**24
+
+
+def square_sum_dtype(dtype: np.dtype, n: int) -> np.dtype:
+    """Smallest unsigned integer type which holds the sum of the squares of n pixels of type dtype without overflowing
+    (float64 for other data types).
+    """
+
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'u':
+        return np.dtype(np.float64)
+
+    max_sum = int(np.iinfo(dtype).max) ** 2 * n
+    for candidate in (np.uint16, np.uint32, np.uint64):
+        if np.iinfo(candidate).max >= max_sum:
+            return np.dtype(candidate)
+
+    return np.dtype(np.float64)
+
+
+class LiveStacker:
+    """Stack frames as they arrive to raise the signal to noise ratio without longer exposures.
+
+    * 'mean' - Mean of all frames since the last reset (exact float64 sum).
+    * 'ema' - Exponential moving average with weight alpha of the newest frame (float32).
+    * 'clipped' - Mean of the last window frames, rejecting values more than sigma standard deviations from the mean
+      of the pixel.
+
+    Adding a frame costs a few vectorized passes over the frame into buffers allocated once per frame format. For
+    'clipped', the frames of the window are kept in a ring together with running (integer) sums of the pixels and of
+    their squares, which are updated by adding the new frame and removing the oldest one. The clipping itself only runs
+    when the stack is read (see stack) or band by band for the preview (see refine).
+    """
+
+    def __init__(self, method: str = 'mean', alpha: float = 0.1, window: int = 16, sigma: float = 3.0):
+        """Constructor.
+
+        # Arguments
+        * method::str - One of STACK_METHODS.
+        * alpha::float - Weight of the newest frame for 'ema' (between 0 and 1).
+        * window::int - Number of frames stacked by 'clipped'.
+        * sigma::float - Clipping threshold of 'clipped' in standard deviations.
+        """
+
+        if method not in STACK_METHODS:
+            raise ValueError(f'Stacking method {method} not known.')
+        if not 0 < alpha <= 1:
+            raise ValueError(f'EMA weight {alpha} must be in (0, 1].')
+        if window < 1:
+            raise ValueError(f'Window of {window} frames must be positive.')
+
+        self.method = method
+        self.alpha = float(alpha)
+        self.window = int(window)
+        self.sigma = float(sigma)
+
+        # Number of frames added since the last reset
+        self.added = 0
+
+        self._format = None
+        self._stack = None
+        self._sum = None
+        self._sum_sq = None
+        self._square = None
+        self._ring = None
+        self._next = 0
+        self._refine_row = 0
+        self._clean = False
+
+    def _allocate(self, shape: tuple, dtype: np.dtype):
+        """Allocate the buffers for a frame format. """
+
+        self._format = (shape, dtype)
+        self._stack = np.zeros(shape, dtype=np.float32)
+        self._sum = self._sum_sq = self._square = self._ring = None
+
+        if self.method == 'mean':
+            self._sum = np.zeros(shape, dtype=np.float64)
+        elif self.method == 'ema':
+            # Buffer for the weighted new frame
+            self._square = np.empty(shape, dtype=np.float32)
+        else:
+            sum_dtype = np.dtype(np.uint64) if dtype.kind == 'u' else np.dtype(np.float64)
+            if dtype.kind == 'u' and int(np.iinfo(dtype).max) * self.window <= np.iinfo(np.uint32).max:
+                sum_dtype = np.dtype(np.uint32)
+            sq_dtype = square_sum_dtype(dtype, self.window)
+            self._sum = np.zeros(shape, dtype=sum_dtype)
+            self._sum_sq = np.zeros(shape, dtype=sq_dtype)
+            self._square = np.empty(shape, dtype=sq_dtype)
+            self._ring = np.empty((self.window, ) + tuple(shape), dtype=dtype)
+
+        self.reset()
+
+    def reset(self):
+        """Start a new stack (e.g., after the ROI moved). """
+
+        self.added = 0
+        self._next = 0
+        self._refine_row = 0
+        self._clean = False
+        if self._sum is not None:
+            self._sum[...] = 0
+        if self._sum_sq is not None:
+            self._sum_sq[...] = 0
+
+    @property
+    def count(self) -> int:
+        """Number of frames in the stack. """
+
+        return min(self.added, self.window) if self.method == 'clipped' else self.added
+
+    @property
+    def shape(self) -> tuple:
+        """Shape of the stacked frames (None before the first frame). """
+
+        return None if self._format is None else self._format[0]
+
+    def add(self, frame: np.ndarray):
+        """Add a frame to the stack. The stack is restarted if the frame format changed. """
+
+        if self._format != (frame.shape, frame.dtype):
+            self._allocate(frame.shape, frame.dtype)
+
+        if self.method == 'mean':
+            np.add(self._sum, frame, out=self._sum)
+        elif self.method == 'ema':
+            if self.added == 0:
+                np.copyto(self._stack, frame, casting='unsafe')
+            else:
+                # stack += alpha * (frame - stack)
+                np.multiply(frame, self.alpha, out=self._square, dtype=np.float32)
+                np.multiply(self._stack, 1 - self.alpha, out=self._stack)
+                np.add(self._stack, self._square, out=self._stack)
+        else:
+            slot = self._ring[self._next]
+            if self.added >= self.window:
+                # Remove the oldest frame from the sums
+                np.subtract(self._sum, slot, out=self._sum, casting='unsafe')
+                np.square(slot, out=self._square, dtype=self._square.dtype)
+                np.subtract(self._sum_sq, self._square, out=self._sum_sq)
+            slot[...] = frame
+            np.add(self._sum, frame, out=self._sum, casting='unsafe')
+            np.square(frame, out=self._square, dtype=self._square.dtype)
+            np.add(self._sum_sq, self._square, out=self._sum_sq)
+            self._next = (self._next + 1) % self.window
+
+        self.added += 1
+        self._clean = False
+
+    def stack(self) -> np.ndarray:
+        """Get the stacked frame (float32, updated in place by the next call after adding frames). """
+
+        if self._format is None:
+            raise ValueError('No frames were stacked.')
+        if not self._clean and self.added:
+            self._refine_row = 0
+            while not self.refine():
+                pass
+            self._clean = True
+
+        return self._stack
+
+    def refine(self) -> bool:
+        """Update the stacked frame step by step, e.g., once per frame for the preview.
+
+        For 'clipped', every call clips one band of rows (see CLIP_BAND_BYTES), so the cost is spread over several
+        frames. The other methods update the whole stacked frame at once.
+
+        # Returns
+        * done::bool - Whether the stacked frame was completely updated.
+        """
+
+        if self.method == 'mean':
+            np.divide(self._sum, max(self.added, 1), out=self._stack, casting='unsafe')
+        elif self.method == 'clipped' and self.added:
+            h, w = self._format[0]
+            rows = max(1, CLIP_BAND_BYTES // (self.count * w * 4))
+            self._clip(self._refine_row, min(self._refine_row + rows, h))
+            self._refine_row += rows
+            if self._refine_row < h:
+                return False
+            self._refine_row = 0
+
+        return True
+
+    def _clip(self, r0: int, r1: int):
+        """Compute the sigma-clipped mean of the window for the rows r0 to r1.
+
+        Rejected values are rare, so only the rejected values of the pixels which have any are subtracted from the
+        running sums instead of summing the kept values of the whole window.
+        """
+
+        n = self.count
+        mean = self._sum[r0:r1] / n
+        limit = self.sigma * np.sqrt(np.maximum(self._sum_sq[r0:r1] / n - mean**2, 0))
+        total = self._sum[r0:r1].astype(np.float64)
+        count = np.full(total.shape, n, dtype=np.int64)
+
+        ring = self._ring[:n, r0:r1]
+        if ring.dtype.kind in 'ui':
+            # For integers |x - mean| <= limit is the same as ceil(mean - limit) <= x <= floor(mean + limit), which can be
+            # compared without converting the window
+            info = np.iinfo(ring.dtype)
+            reject = ring < np.clip(np.ceil(mean - limit), info.min, info.max).astype(ring.dtype)
+            reject |= ring > np.clip(np.floor(mean + limit), info.min, info.max).astype(ring.dtype)
+        else:
+            reject = np.abs(ring - mean) > limit
+
+        pixels = np.flatnonzero(reject.any(axis=0))
+        if len(pixels):
+            reject = reject.reshape(n, -1)[:, pixels]
+            values = ring.reshape(n, -1)[:, pixels]
+            total.reshape(-1)[pixels] -= np.sum(values, axis=0, where=reject, dtype=np.float64)
+            count.reshape(-1)[pixels] -= reject.sum(axis=0)
+
+        # Pixels with all values rejected keep the plain mean
+        np.divide(total, np.maximum(count, 1), out=total)
+        np.copyto(self._stack[r0:r1], np.where(count > 0, total, mean), casting='unsafe')
+
+    def render(self, out: np.ndarray) -> np.ndarray:
+        """Write the stacked frame as last updated by stack or refine into out, rounded and clipped to the range of its
+        data type for integer types (e.g., a frame slot for the preview).
+        """
+
+        if out.dtype.kind in 'ui':
+            info = np.iinfo(out.dtype)
+            np.copyto(out, np.clip(np.rint(self._stack), info.min, info.max), casting='unsafe')
+        else:
+            np.copyto(out, self._stack, casting='unsafe')
+
+        return out
+
+    def __repr__(self) -> str:
+        if self.method == 'mean':
+            return 'LiveStacker(mean)'
+        elif self.method == 'ema':
+            return f'LiveStacker(ema, alpha={self.alpha})'
+        return f'LiveStacker(clipped, window={self.window}, sigma={self.sigma})'
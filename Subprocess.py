@@ -1,21 +1,149 @@
 import time
 from SubprocessHeader import *
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pipe, Lock, Value
+from multiprocessing.connection import wait
+from queue import Empty
+from Telemetry import get_telemetry, Telemetry
 import logging
 
+
+# Maximum number of control replies received from a channel per call of ResultMultiplexer.receive, so a subprocess
+# sending replies in a tight loop cannot starve the bulk results
+MAX_CONTROL_BATCH = 64
+
+
+class CommandQueue:
+    """Queue for sending commands from the main process to a subprocess.
+
+    Unlike multiprocessing.Queue, the receiving end is a plain connection which can be waited on together with other
+    connections (see multiprocessing.connection.wait), so the subprocess can block until a command arrives.
+    """
+
+    def __init__(self):
+        """Constructor. """
+
+        self._reader, self._writer = Pipe(duplex=False)
+        # Several threads of the main process may send commands
+        self._lock = Lock()
+
+    @property
+    def connection(self):
+        """Receiving end of the queue (for waiting on it). """
+
+        return self._reader
+
+    def put(self, com: tuple):
+        """Send a command. """
+
+        with self._lock:
+            self._writer.send(com)
+
+    def poll(self, timeout: float = 0) -> bool:
+        """Wait at most timeout seconds (forever for None) for a command. Returns whether a command is available. """
+
+        return self._reader.poll(timeout)
+
+    def empty(self) -> bool:
+        return not self._reader.poll()
+
+    def get(self) -> tuple:
+        """Receive the next command (blocks until a command is available). """
+
+        return self._reader.recv()
+
+
+class ResultChannel:
+    """Channel for sending results (uid, data) from a subprocess back to the main process.
+
+    Every subprocess has its own channel, so the main process can wait on the channels of all subprocesses at once (see
+    ResultMultiplexer) and a camera flooding its channel with frames does not delay the replies of the others. A
+    channel consists of a pipe for the bulk results (BULK_RESULTS) and a pipe for all other (control) replies, which is
+    read first.
+
+    The frame references (CMD_DISPLAY_IMAGE, CMD_RETURN_REC) refer to a limited number of frame slots in shared memory,
+    so they cannot pile up. Other results are not limited this way: the camera sends CMD_CAMERA_CENTROIDS and
+    CMD_CAMERA_GET_FPS from its acquisition thread, so a receiver which falls behind until a pipe is full blocks the
+    sender and stalls the capture. The channel does not grow without limit, but the main process has to keep reading.
+    """
+
+    def __init__(self):
+        """Constructor. """
+
+        self._control_reader, self._control_writer = Pipe(duplex=False)
+        self._bulk_reader, self._bulk_writer = Pipe(duplex=False)
+        # Several threads of a subprocess may send results
+        self._control_lock = Lock()
+        self._bulk_lock = Lock()
+        # Number of results sent but not yet received
+        self._pending = Value('i', 0)
+
+    @property
+    def control(self):
+        """Receiving end of the control replies (for waiting on it). """
+
+        return self._control_reader
+
+    @property
+    def bulk(self):
+        """Receiving end of the bulk results (for waiting on it). """
+
+        return self._bulk_reader
+
+    def put(self, item: tuple):
+        """Send a result (uid, data). """
+
+        with self._pending.get_lock():
+            self._pending.value += 1
+
+        if item[1][0] in BULK_RESULTS:
+            with self._bulk_lock:
+                self._bulk_writer.send(item)
+        else:
+            with self._control_lock:
+                self._control_writer.send(item)
+
+    def qsize(self) -> int:
+        """Number of results which were sent but not yet received. """
+
+        return self._pending.value
+
+    def empty(self) -> bool:
+        return not (self._control_reader.poll() or self._bulk_reader.poll())
+
+    def receive(self, connection) -> tuple:
+        """Receive the next result from one of the receiving ends (blocks until a result is available). """
+
+        item = connection.recv()
+        with self._pending.get_lock():
+            self._pending.value -= 1
+
+        return item
+
+    def get(self, block: bool = True, timeout: float = None) -> tuple:
+        """Receive the next result, control replies before bulk results. Raises queue.Empty if no result arrived
+        within timeout (like multiprocessing.Queue.get).
+        """
+
+        ready = wait([self._control_reader, self._bulk_reader], timeout if block else 0)
+        if not ready:
+            raise Empty
+
+        return self.receive(self._control_reader if self._control_reader in ready else self._bulk_reader)
+
+
 class Subprocess(Process):
     """A subprocess.
 
     The counter communicates with the GUI via a communication thread.
     """
-    def __init__(self, uid: int, com_queue: Queue, res_queue: Queue):
+    def __init__(self, uid: int, com_queue: CommandQueue, res_queue: ResultChannel):
         """Constructor of the subprocess. 
         
         # Arguments
         * uid::int - Unique ID of the counter
-        * com_queue::Queue(int) - Command queue. 
-        * res_queue::Queue(tuple) - Result queue for returning the counter value to the GUI. 
-                                    Returns a tuple (uid, counter).
+        * com_queue::CommandQueue(tuple) - Command queue. 
+        * res_queue::ResultChannel(tuple) - Result channel for returning the counter value to the GUI (any queue with
+                                            put works, too). Returns a tuple (uid, counter).
         """
 
         # Call constructor of the parent object
@@ -23,7 +151,8 @@ class Subprocess(Process):
 
         # Set UID
         self.uid = uid
-        self._timeout = 0.01
+        # Maximum time the event loop waits for commands before calling inloop (None: only wake up for commands)
+        self._timeout = None
         self._running = False
 
         # Connect the command and result queues
@@ -39,34 +168,81 @@ class Subprocess(Process):
 
         logging.info(f'Starting event loop of {self}')
 
-        while True:
-            # Poll the command queue for self._timeout
-            res = self.receive()
+        self._running = True
+        while self._running:
+            # Wait for commands for at most poll_timeout()
+            res = self.receive(self.poll_timeout())
 
-            if res is not None:
-                # Handle control input from the main program
+            # Handle all pending commands before running inloop again
+            while res is not None and self._running:
                 if res[0] == CMD_STOP_SUBPROCESS:
                     # Stop the eventloop
-                    break
+                    self._running = False
                 else:
-                    # Handle all other input
-                    self.handle_input(res)
-
-            # Run additional code once per iteration
-            self.inloop()
+                    if res[0] == CMD_GET_STATS:
+                        # Send the telemetry snapshot
+                        self.send((CMD_GET_STATS, self.get_stats()))
+                    else:
+                        # Handle all other input
+                        with self.telemetry.stage('command'):
+                            self.handle_input(res)
+                    res = self.receive(0)
+
+            if self._running:
+                # Run additional code once per iteration
+                self.inloop()
 
         logging.info(f'Stopped event loop of {self}')
 
-    def receive(self):
-        """Handle control commands coming from the main program. """
+    @property
+    def telemetry(self) -> Telemetry:
+        """Telemetry of the subprocess. """
 
-        if self.com_queue.empty():
-            time.sleep(self._timeout)
-            return None
-        else:
+        return get_telemetry(f'{self.__class__.__name__} {self.uid:#x}')
+
+    def get_stats(self) -> dict:
+        """Get a snapshot of the telemetry. Can be extended by child classes. """
+
+        try:
+            self.telemetry.gauge('result_queue', self.res_queue.qsize())
+        except NotImplementedError:
+            # Not available on macOS
+            pass
+
+        return self.telemetry.snapshot()
+
+    def poll_timeout(self) -> float:
+        """Time to wait for commands before calling inloop (None blocks until a command arrives, 0 only checks for
+        commands). Can be overwritten by child classes, e.g., to not wait while frames are captured.
+        """
+
+        return self._timeout
+
+    def wait_objects(self) -> list:
+        """Additional connections which wake up the event loop when they become ready. Can be overwritten by child
+        classes.
+        """
+
+        return []
+
+    def receive(self, timeout: float = None):
+        """Wait for control commands coming from the main program.
+
+        # Arguments
+        * timeout::float - Maximum time to wait (in s). None blocks until a command or one of the wait_objects() is
+                           ready.
+
+        # Returns
+        * com::tuple - The command or None if no command arrived.
+        """
+
+        ready = wait([self.com_queue.connection] + self.wait_objects(), timeout)
+        if self.com_queue.connection in ready:
             com = self.com_queue.get()
             logging.debug(f'Subrocess {self} received command {com}')
             return com
+        else:
+            return None
 
     def handle_input(self, res):
         """Handle control commands coming from the main program. Can be overwritten by child classes. """
@@ -85,14 +261,17 @@ class Subprocess(Process):
 
 
 class Interface:
-    """Interface for starting and stopping a subprocess and handling the data coming back from it. """
+    """Interface for starting and stopping a subprocess and handling the data coming back from it.
+
+    Every interface owns the command queue and the result channel of its subprocess.
+    """
 
-    def __init__(self, uid: int, res_queue: Queue) -> None:
+    def __init__(self, uid: int) -> None:
         """Constructor. """
 
         self.uid = uid
-        self.com_queue = Queue()
-        self.res_queue = res_queue
+        self.com_queue = CommandQueue()
+        self.res_queue = ResultChannel()
         self.subprocess = None
 
     def init_subprocess(self, uid):
@@ -126,11 +305,6 @@ class Interface:
             # Quickly pause
             time.sleep(timeout)
 
-    def __eq__(self, uid: int) -> bool:
-        """Compare the interface by comparing uids. """
-
-        return self.uid == uid
-
     def handle_data(self, data):
         """Handle data coming from the subprocess. Has to be overwritten by child classes. """
 
@@ -143,28 +317,76 @@ class InterfaceManager:
     def __init__(self, *args):
         """Constructor. """
 
-        # Get all interfaces
-        self._interfaces = [arg for arg in args]
-        logging.debug(f'Initialized {self} with {self._interfaces}')
+        # Get all interfaces by UID (in the order they were given)
+        self._interfaces = {arg.uid: arg for arg in args}
+        logging.debug(f'Initialized {self} with {list(self._interfaces.values())}')
 
     def __getitem__(self, uid):
         """Get an interface by UID. """
 
-        index = self._interfaces.index(uid)
-        return self._interfaces[index]
+        return self._interfaces[uid]
 
     def __iter__(self):
-        """Initialize iterator. """
+        """Iterate over the interfaces. """
 
-        self.n = 0
-        return self
+        return iter(self._interfaces.values())
 
-    def __next__(self):
-        """Iteration. """
+    def __len__(self) -> int:
+        return len(self._interfaces)
 
-        if self.n < len(self._interfaces):
-            # Return the nth interface
-            self.n += 1
-            return self._interfaces[self.n - 1]
-        else:
-            raise StopIteration
\ No newline at end of file
+
+class ResultMultiplexer:
+    """Receive the results of the subprocesses of an InterfaceManager with a single wait on all their result channels.
+
+    Every call of receive takes the pending control replies of all channels, or else a single bulk result. The channels
+    take turns for the bulk results, so the cameras share the receiver fairly, and a control reply waits for at most one
+    bulk result being handled.
+    """
+
+    def __init__(self, interface_manager: InterfaceManager):
+        """Constructor. """
+
+        self.interface_manager = interface_manager
+        self._channels = [interface.res_queue for interface in interface_manager]
+        # Pipe for waking up a waiting receive (see wakeup)
+        self._wakeup_reader, self._wakeup_writer = Pipe(duplex=False)
+        self._connections = [self._wakeup_reader]
+        for channel in self._channels:
+            self._connections += [channel.control, channel.bulk]
+        # Channel whose bulk results are taken first in the next call
+        self._next_bulk = 0
+
+    def wakeup(self):
+        """Make a waiting receive return, e.g., for stopping the thread receiving the results. """
+
+        self._wakeup_writer.send(None)
+
+    def receive(self, timeout: float = None) -> list:
+        """Wait at most timeout seconds (forever for None) for results.
+
+        # Returns
+        * results::list - (interface, data) of the received results in the order they should be handled (empty after
+                          a timeout or wakeup).
+        """
+
+        ready = wait(self._connections, timeout)
+        while self._wakeup_reader.poll():
+            self._wakeup_reader.recv()
+
+        items = []
+        for channel in self._channels:
+            if channel.control in ready:
+                for _ in range(MAX_CONTROL_BATCH):
+                    items.append(channel.receive(channel.control))
+                    if not channel.control.poll():
+                        break
+
+        if not items:
+            for i in range(len(self._channels)):
+                channel = self._channels[(self._next_bulk + i) % len(self._channels)]
+                if channel.bulk in ready:
+                    items.append(channel.receive(channel.bulk))
+                    self._next_bulk = (self._next_bulk + i + 1) % len(self._channels)
+                    break
+
+        return [(self.interface_manager[uid], data) for uid, data in items]
\ No newline at end of file
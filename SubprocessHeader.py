@@ -7,6 +7,7 @@ IMG_PROCESS_ID = 0xF3
 
 # Commands
 CMD_STOP_SUBPROCESS = 0x00
+CMD_GET_STATS = 0x01
 CMD_DISPLAY_IMAGE = 0x10
 CMD_CAMERA_GET_EXP = 0x11
 CMD_CAMERA_SET_EXP = 0x12
@@ -16,8 +17,28 @@ CMD_CAMERA_SET_ROI = 0x15
 CMD_CAMERA_GET_TEMP = 0x16
 CMD_CAMERA_SET_TEMP = 0x17
 CMD_CAMERA_GET_FPS = 0x18
+CMD_CAMERA_OVERRUN = 0x19
+CMD_CAMERA_GET_CAPTURE_STATS = 0x1A
+CMD_CAMERA_SET_PREVIEW_RATE = 0x1B
+CMD_CAMERA_DISPLAY_SKIPPED = 0x1C
+CMD_CAMERA_SET_IMAGE_TYPE = 0x1D
+CMD_CAMERA_GET_IMAGE_TYPE = 0x1E
+CMD_CAMERA_GET_TIMING = 0x1F
+CMD_CAMERA_APPLY_CONFIG = 0x20
+CMD_CAMERA_GET_CONFIG = 0x21
+CMD_CAMERA_SET_CENTROIDING = 0x22
+CMD_CAMERA_CENTROIDS = 0x23
+CMD_CAMERA_SET_CALIBRATION = 0x24
+CMD_CAMERA_SET_STACKING = 0x25
+CMD_CAMERA_SAVE_STACK = 0x26
+CMD_IMG_PROGRESS = 0x30
+CMD_IMG_SET_SELECTION = 0x31
 
 
 CMD_CAMERA_MODE_STOP = 0xA1
 CMD_CAMERA_CONTINOUS_MODE = 0xA2
-CMD_CAMERA_REC_MODE = 0xA3
\ No newline at end of file
+CMD_CAMERA_REC_MODE = 0xA3
+
+# Results which carry frame data (references to shared memory or measurements of every frame). They are received after
+# the control replies of all subprocesses (see Subprocess.ResultChannel)
+BULK_RESULTS = frozenset((CMD_DISPLAY_IMAGE, CMD_RETURN_REC, CMD_CAMERA_CENTROIDS))
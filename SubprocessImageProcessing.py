@@ -1,23 +1,343 @@
-from SubprocessHeader import * 
-from Subprocess import Subprocess, Interface
-from multiprocessing import Queue
+from SubprocessHeader import *
+from Subprocess import Subprocess, Interface, CommandQueue, ResultChannel
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from datetime import datetime
 from astropy.io import fits
+from FrameBuffer import FrameRingReader
+from ImageData import ImageData
+from FrameSelection import FrameSelector
+import numpy as np
+import time
+import os
+
+
+# Time window for the throughput reported with the progress (in s)
+THROUGHPUT_WINDOW = 10
+
+# Reader of the recording rings in a worker process (see process_recording)
+_worker_reader = None
+
+
+def recording_file_name(directory: str, uid: int, header: dict, seq: int) -> str:
+    """Name of the FITS file of a recording. The UID of the camera and the sequence number of the first frame keep
+    the names of short recordings and of several cameras apart.
+    """
+
+    start_time = header.get('start_time') or datetime.utcnow()
+    return os.path.join(directory, f"{start_time.strftime('%Y-%m-%d_%H:%M:%S')}_{uid:x}_{seq:08d}.fits")
+
+
+def process_recording(uid: int, ref, header: dict, meta: dict, directory: str, compression: dict = None, selection: dict = None) -> dict:
+    """Compute the statistics of a recording in shared memory, write it to a FITS file and release its buffer.
+
+    With a selection only the sharpest frames of the recording are written, together with their scores (SCORE column
+    of the FRAMES table), and optionally their shift-and-add stack to a second file ending in _stack.fits.
+
+    Runs in a worker process of the ImageSubprocess.
+
+    # Arguments
+    * uid::int - UID of the camera subprocess.
+    * ref::FrameRef - Reference to the recording (n, height, width) in the recording ring of the camera subprocess.
+    * header::dict - Arguments of ImageData for the header.
+    * meta::dict - Per-frame metadata (SEQ, T_NS, DROPPED).
+    * directory::str - Directory of the FITS file.
+    * compression::dict - Arguments of FitsCompressedWriter (None for an uncompressed file). The recordings are
+                          compressed in parallel, so each recording is compressed by its worker.
+    * selection::dict - Arguments of FrameSelector (None to write all frames).
+
+    # Returns
+    * result::dict - File name, size and statistics of the recording.
+    """
+
+    global _worker_reader
+    if _worker_reader is None:
+        _worker_reader = FrameRingReader()
+
+    t_start = time.perf_counter()
+    frames = _worker_reader.get(ref)
+    if frames is None:
+        raise FileNotFoundError(f'Recording {ref.name} was freed before it was processed.')
+
+    try:
+        file_name = recording_file_name(directory, uid, header, int(meta['SEQ'][0]))
+        stack_file = None
+        if selection is None:
+            index = np.arange(len(frames))
+            with ImageData(None, **header).open_stream(file_name, compression=compression) as writer:
+                writer.append(frames, **meta)
+        else:
+            selector = FrameSelector(**selection)
+            scores, centers = selector.measure(frames)
+            index = selector.select(scores)
+            selected_meta = {key: value[index] for key, value in meta.items()}
+            with ImageData(None, selection=selector.metric, n_burst=len(frames), **header).open_stream(file_name, compression=compression) as writer:
+                writer.append(frames[index], **selected_meta, SCORE=scores[index])
+            if selector.stack:
+                stack_file = file_name[:-len('.fits')] + '_stack.fits'
+                stack = selector.shift_and_add(frames, index, centers)
+                ImageData(stack, n_combined=len(index), selection=selector.metric, n_burst=len(frames), **header).write_fits_to_file(stack_file)
+        # Mean of every frame, e.g., for monitoring the brightness during a recording
+        frame_mean = frames.mean(axis=(1, 2))
+        n_bytes = frames.nbytes
+    finally:
+        # Drop the view before giving the buffer back to the camera subprocess
+        del frames
+        _worker_reader.release(ref)
+
+    return {
+        'uid': uid,
+        'file_name': file_name,
+        'stack_file': stack_file,
+        'frames': len(index),
+        'recorded': len(frame_mean),
+        'bytes': n_bytes,
+        'file_bytes': os.path.getsize(file_name),
+        'seconds': time.perf_counter() - t_start,
+        't_written_ns': time.perf_counter_ns(),
+        't_last_frame_ns': int(meta['T_NS'][-1]),
+        'min': writer.data_min.item(),
+        'max': writer.data_max.item(),
+        'mean': float(frame_mean.mean()),
+        'frame_mean': frame_mean,
+    }
 
 
 class ImageSubprocess(Subprocess):
-    def __init__(self, uid: int, com_queue: Queue, res_queue: Queue):
+    """Processes recordings of the camera subprocesses in a pool of worker processes.
+
+    Recordings arrive as references to the shared memory recording rings of the camera subprocesses
+    (CMD_RETURN_REC, uid, ref, header, meta). A worker writes the recording to a FITS file and computes its statistics
+    and then releases the buffer, so a camera subprocess can only get ahead by as many recordings as its ring holds.
+    After every recording the progress (CMD_IMG_PROGRESS) is sent to the main process. Recordings of cameras with a
+    frame selection (CMD_IMG_SET_SELECTION) are reduced to their sharpest frames.
+    """
+
+    def __init__(self, uid: int, com_queue: CommandQueue, res_queue: ResultChannel, directory: str = '.', n_workers: int = None, compression: dict = None):
+        """Constructor.
+
+        # Arguments
+        * directory::str - Directory of the FITS files.
+        * n_workers::int - Number of worker processes (None for one per CPU).
+        * compression::dict - Arguments of FitsCompressedWriter (None for uncompressed files).
+        """
+
         super().__init__(uid, com_queue, res_queue)
 
+        self.directory = directory
+        self.n_workers = n_workers
+        self.compression = compression
+
+        self.pool = None
+        # Recordings being processed (future -> (uid, ref))
+        self._jobs = {}
+        # Arguments of FrameSelector by UID of the camera subprocess (see set_selection)
+        self.selection = {}
+        # Releases the buffers of recordings which failed
+        self._reader = None
+
+        # Number of recordings which were processed or failed, number of frames recorded and written, bytes of the
+        # frames and of the files
+        self.done = 0
+        self.failed = 0
+        self.recorded = 0
+        self.frames = 0
+        self.bytes = 0
+        self.file_bytes = 0
+        # (time, bytes) of the recordings finished within THROUGHPUT_WINDOW
+        self._finished = deque()
+
+    def run(self):
+        """Extend the event loop by starting the worker pool and waiting for all recordings when stopping. """
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.pool = ProcessPoolExecutor(self.n_workers)
+        self._reader = FrameRingReader()
+
+        super(ImageSubprocess, self).run()
+
+        # Finish the recordings which were already received
+        self.pool.shutdown(wait=True)
+        self.collect_results()
+        self._reader.close()
+
+    def poll_timeout(self) -> float:
+        """Check for finished recordings regularly while recordings are processed. """
+
+        return 0.05 if self._jobs else None
+
     def handle_input(self, res):
         if res[0] == CMD_RETURN_REC:
-            data = res[1]
+            self.submit(*res[1:])
+        elif res[0] == CMD_IMG_PROGRESS:
+            self.send_progress()
+        elif res[0] == CMD_IMG_SET_SELECTION:
+            self.set_selection(*res[1:])
+        else:
+            raise NotImplementedError(f'{res[0]}')
+
+    def inloop(self):
+        """Send the results of finished recordings. """
+
+        self.collect_results()
+
+    def set_selection(self, uid: int, options: dict = None):
+        """Keep only the sharpest frames of the following recordings of the camera subprocess uid.
+
+        # Arguments
+        * uid::int - UID of the camera subprocess.
+        * options::dict - Arguments of FrameSelector (None to write all frames).
+        """
+
+        if options is None:
+            self.selection.pop(uid, None)
+        else:
+            try:
+                FrameSelector(**options)
+            except (TypeError, ValueError) as e:
+                logging.error(f'{self} cannot select frames with {options}: {e}')
+                return
+            self.selection[uid] = options
+        logging.info(f'{self} selects frames of {uid:#x} with {options}.')
 
-    def convert_to_fits(self, data):
-        primary_hdu = fits.ImageHDU(data[0])
-        # TODO: also get the header
+    def submit(self, uid: int, ref, header: dict, meta: dict):
+        """Hand a recording to the worker pool. """
+
+        args = (process_recording, uid, ref, header, meta, self.directory, self.compression, self.selection.get(uid))
+        try:
+            future = self.pool.submit(*args)
+        except BrokenProcessPool:
+            logging.exception(f'Worker pool of {self} broke. Restarting it.')
+            self.pool = ProcessPoolExecutor(self.n_workers)
+            future = self.pool.submit(*args)
+
+        self._jobs[future] = (uid, ref)
+        self.telemetry.gauge('pending', len(self._jobs))
+
+    def collect_results(self):
+        """Handle the recordings which were processed. """
+
+        finished = [future for future in self._jobs if future.done()]
+        for future in finished:
+            uid, ref = self._jobs.pop(future)
+            try:
+                result = future.result()
+            except Exception:
+                logging.exception(f'{self} failed to process a recording of {uid:#x}.')
+                self.failed += 1
+                # Make sure the camera subprocess gets the buffer back
+                self._reader.release(ref)
+                continue
+
+            self.done += 1
+            self.recorded += result['recorded']
+            self.frames += result['frames']
+            self.bytes += result['bytes']
+            self.file_bytes += result['file_bytes']
+            self._finished.append((time.perf_counter(), result['bytes']))
+            self.telemetry.count('recordings')
+            self.telemetry.latency('process_recording', result['seconds'])
+            self.telemetry.latency('capture_to_disk', (result['t_written_ns'] - result['t_last_frame_ns']) * 1e-9)
+            logging.info(f"{self} wrote {result['frames']} of {result['recorded']} frames to {result['file_name']} in {result['seconds']:.2f} s.")
+
+            self.send_progress(result)
+
+        if finished:
+            self.telemetry.gauge('pending', len(self._jobs))
+
+    def throughput(self) -> float:
+        """Bytes written per second within THROUGHPUT_WINDOW. """
+
+        now = time.perf_counter()
+        while self._finished and now - self._finished[0][0] > THROUGHPUT_WINDOW:
+            self._finished.popleft()
+
+        return sum(n_bytes for _, n_bytes in self._finished) / THROUGHPUT_WINDOW
+
+    def send_progress(self, result: dict = None):
+        """Send the progress together with the result of the last recording. """
+
+        progress = {
+            'pending': len(self._jobs),
+            'done': self.done,
+            'failed': self.failed,
+            'recorded': self.recorded,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'file_bytes': self.file_bytes,
+            'throughput': self.throughput(),
+            'result': result,
+        }
+        self.send((CMD_IMG_PROGRESS, progress))
+
+    def convert_to_fits(self, data, header: fits.Header = None):
+        primary_hdu = fits.PrimaryHDU(data[0], header=header)
         hdul = fits.HDUList([primary_hdu])
         for image in data[1:]:
-            image_hdu = fits.ImageHDU(data)
+            image_hdu = fits.ImageHDU(image)
             hdul.append(image_hdu)
 
-        return hdul
\ No newline at end of file
+        return hdul
+
+
+class ImageInterface(Interface):
+    """Interface to the ImageSubprocess. """
+
+    def __init__(self, directory: str = '.', n_workers: int = None, compression: dict = None):
+        """Constructor. """
+
+        super().__init__(IMG_PROCESS_ID)
+
+        self.directory = directory
+        self.n_workers = n_workers
+        self.compression = compression
+
+        # Last progress report and telemetry snapshot of the subprocess
+        self.progress = None
+        self.stats = None
+
+    def init_subprocess(self):
+        """Overwrite the parent function for initializing the subprocess. """
+
+        return ImageSubprocess(self.uid, self.com_queue, self.res_queue, self.directory, self.n_workers, self.compression)
+
+    def process_recording(self, uid: int, ref, header: dict, meta: dict):
+        """Hand a recording of the camera subprocess uid over to the subprocess. """
+
+        self.com_queue.put((CMD_RETURN_REC, uid, ref, header, meta))
+
+    def set_selection(self, uid: int, options: dict = None):
+        """Let the subprocess keep only the sharpest frames of the recordings of the camera subprocess uid (options of
+        FrameSelector, None to keep all frames).
+        """
+
+        self.com_queue.put((CMD_IMG_SET_SELECTION, uid, options))
+
+    def get_progress(self):
+        """Query the progress from the subprocess. """
+
+        self.com_queue.put((CMD_IMG_PROGRESS, ))
+
+    def get_stats(self):
+        """Query the telemetry snapshot from the subprocess. """
+
+        self.com_queue.put((CMD_GET_STATS, ))
+
+    def handle_data(self, data):
+        """Handle data sent back from the image processing subprocess. """
+
+        cmd = data[0]
+
+        if cmd == CMD_IMG_PROGRESS:
+            self.update_progress(data[1])
+        elif cmd == CMD_GET_STATS:
+            self.stats = data[1]
+        else:
+            raise NotImplementedError(f'{cmd}')
+
+    def update_progress(self, progress: dict):
+        """Store the progress of the subprocess. """
+
+        self.progress = progress
+        logging.debug(f"{self} {progress['done']} recordings done, {progress['pending']} pending, {progress['throughput'] / 2**20:.1f} MiB/s")
@@ -1,12 +1,19 @@
-from zwoasi import init, Camera, ASI_EXPOSURE, ASI_HIGH_SPEED_MODE, ASI_IMG_RAW8, ASI_COOLER_ON, ASI_FAN_ON, ASI_TEMPERATURE, ASI_TARGET_TEMP, ASI_IMG_RAW16
-from Subprocess import Subprocess, Interface
+from ZwoCamera import ZwoCamera, ZWO_IOError, ASI_IMG_RAW8, ASI_IMG_RAW16, ASI_HARDWARE_BIN, ASI_ERROR_TIMEOUT, IMAGE_TYPE_DTYPES
+from SimulatedCamera import SimulatedZwoCamera
+from Subprocess import Subprocess, CommandQueue, ResultChannel
 from SubprocessHeader import *
-from multiprocessing import Queue
-from PyQt5.QtGui import QImage, QPixmap
-from PIL  import Image
+from datetime import datetime
 import time
-from sys import platform
-from RoiWarningDialog import RoiWarningDialog
+import os
+from FrameBuffer import FrameRingBuffer, DisplayMailbox
+from FrameProcessing import SoftwareBinning, BINNING_METHODS
+from Centroiding import Centroider
+from Calibration import CalibrationLibrary
+from Stacking import LiveStacker
+from ImageData import ImageData
+from Acquisition import AcquisitionThread
+from FrameTiming import FrameTiming
+import numpy as np
 
 
 def roi_absolute_to_swh(roi_x_1, roi_x_2, roi_y_1, roi_y_2):
@@ -52,136 +59,172 @@ e = roi_absolute_to_offset(*d, 1280, 960)
 
 assert a == e
 
+# Image type used by default. The science camera is read out with the full 12 bits
+DEFAULT_IMAGE_TYPES = {
+    'ZWO ASI120MM Mini': ASI_IMG_RAW8,
+    'ZWO ASI174MM-Cool': ASI_IMG_RAW16,
+}
 
-class ZwoCamera(Camera):
-    """Extension of zwoasi.Camera class. """
+# Subprocess UIDs of the cameras
+CAMERA_UIDS = {
+    'ZWO ASI120MM Mini': CAMERA_ID,
+    'ZWO ASI174MM-Cool': COOL_CAMERA_ID,
+}
 
-    def __init__(self, camera_name: str):
-        # Load the DLL
-        self.load_lib()
+# Names of the image types in the GUI
+IMAGE_TYPE_NAMES = {ASI_IMG_RAW8: 'RAW8', ASI_IMG_RAW16: 'RAW16'}
 
-        # Initialize the camera
-        super(ZwoCamera, self).__init__(camera_name)
+# Settings which can be changed together with CMD_CAMERA_APPLY_CONFIG. bins is the binning of the camera, soft_bins
+# the binning applied by the subprocess with soft_bin_method ('sum' or 'mean')
+CONFIG_KEYS = ('exp_time', 'roi', 'image_type', 'bins', 'highspeed', 'soft_bins', 'soft_bin_method')
 
-        self._exp_time = None
-        self._highspeed = False
-
-    def __del__(self):
-        """Overwrite destructor to handle exceptions during closing. """
-
-        try:
-            self.close()
-        except Exception:
-            # Handle exceptions during closing (i.e., when no camera was connected)
-            pass
-        
-    def load_lib(self):
-        """Initialize the camera. """
+# Queries which are answered from settings cached by the subprocess, without waiting for the acquisition thread
+CACHED_QUERIES = (CMD_CAMERA_GET_EXP, CMD_CAMERA_GET_IMAGE_TYPE)
 
-        if platform == 'linux' or platform == 'linux2':
-            init('libASICamera2.so')
-        elif platform == 'win32':
-            init('ASICamera2.dll')
-        else:
-            raise NotImplementedError('Platform not implemented.')
+# Number of recordings which can be processed at the same time before the camera has to drop frames and the time the
+# subprocess waits for them to be processed when it stops (in s)
+REC_BUFFER_SLOTS = 2
+REC_RELEASE_TIMEOUT = 60
 
-    @property
-    def exp_time(self) -> float:
-        """Get the exposure time (in seconds). """
+# Centroids are sent in batches every CENTROID_BATCH_INTERVAL seconds, and preview frames at CENTROID_PREVIEW_RATE
+# frames per second while centroiding
+CENTROID_BATCH_INTERVAL = 0.05
+CENTROID_PREVIEW_RATE = 2
 
-        self._exp_time = self.get_control_value(ASI_EXPOSURE)[0] * 1e-6
-        logging.debug(f'{self} read out exposure time of {self._exp_time * 1e6} us')
-        return self._exp_time
+# Maximum number of times per second the stack is rendered for display while stacking
+STACK_PREVIEW_RATE = 2
 
-    @exp_time.setter
-    def exp_time(self, exp_time: float):
-        """Set the exposuer time (in seconds). """
+# Number of frames in a row which may time out before the camera is considered lost
+MAX_FRAME_TIMEOUTS = 20
 
-        # Calculate the exposure time in us
-        exp_time_us = int(exp_time * 1e6)
-        # Set the exposure time
-        logging.debug(f'{self} set exposure time to {exp_time_us} us')
-        self.set_control_value(ASI_EXPOSURE, exp_time_us)
-        
-    @property
-    def highspeed(self) -> bool:
-        """Get whether highspeed mode is enabled. """
 
-        self._highspeed = self.get_control_value(ASI_HIGH_SPEED_MODE) * 1e-6
-        return self._highspeed
+def same_setting(key: str, a, b) -> bool:
+    """Compare two values of a setting (see CONFIG_KEYS) as the camera would store them. """
 
-    @highspeed.setter
-    def highspeed(self, highspeed: bool):
-        """Enable/disable highspeed mode. """
+    if key == 'exp_time':
+        # The camera stores the exposure time in us
+        return int(a * 1e6) == int(b * 1e6)
+    elif key == 'roi':
+        return tuple(a) == tuple(b)
+    elif key == 'highspeed':
+        return bool(a) == bool(b)
+    return a == b
 
-        self.set_control_value(ASI_HIGH_SPEED_MODE, bool(highspeed))
 
-    @property
-    def is_cooled(self):
-        return self.get_camera_property()['IsCoolerCam']
+def open_camera(camera_type: str, backend: str = None):
+    """Open a camera.
 
-    def enable_cooler(self):
-        if self.is_cooled:
-            self.set_control_value(ASI_COOLER_ON, 1)
-            self.set_control_value(ASI_FAN_ON, 1)
-            logging.debug(f'{self}: Enabeling cooler')
-        else:
-            logging.info(f'{self} is not cooled')
+    # Arguments
+    * camera_type::str - Name of the camera.
+    * backend::str - 'zwo' for the camera hardware or 'sim' for a simulated camera. Defaults to the environment
+                     variable ZWO_CAMERA_BACKEND (or 'zwo' if it is not set).
+    """
 
-    def disable_cooler(self):
-        if self.is_cooled:
-            self.set_control_value(ASI_COOLER_ON, 0)
-            self.set_control_value(ASI_FAN_ON, 0)
-            logging.debug(f'{self}: Disabeling cooler')
-        else:
-            logging.info(f'{self} is not cooled')
-
-    @property
-    def temperature(self):
-        if self.is_cooled:
-            # Get the temperature (x10)
-            t = self.get_control_value(ASI_TEMPERATURE)[0]
-            logging.debug(f'Getting temperature')
-            return t / 10
-        else:
-            logging.info(f'{self} is not cooled')
-
-    @temperature.setter
-    def temperature(self, t: float):
-        if self.is_cooled:
-            assert t > -40 and t < 20, 'Temperature out of range'
-            self.set_control_value(ASI_TARGET_TEMP, t)
-            logging.debug(f'Setting temperature to {t}')
-        else:
-            logging.info(f'{self} is not cooled')
+    if backend is None:
+        backend = os.environ.get('ZWO_CAMERA_BACKEND', 'zwo')
 
+    if backend == 'zwo':
+        return ZwoCamera(camera_type)
+    elif backend == 'sim':
+        return SimulatedZwoCamera(camera_type)
+    else:
+        raise NotImplementedError(f'Camera backend {backend} not known.')
 
 
 class CameraSubprocess(Subprocess):
     """Implentation of a subprocess for running the ZWO mini camera. """
-    def __init__(self, uid: int, camera_type: str, com_queue: Queue, res_queue: Queue):
-        """Camera type: ZWO ASI120MM Mini or ZWO ASI174MM-Cool"""
+    def __init__(self, uid: int, camera_type: str, com_queue: CommandQueue, res_queue: ResultChannel, backend: str = None, preview_rate: float = 30,
+                 image_type: int = None):
+        """Camera type: ZWO ASI120MM Mini or ZWO ASI174MM-Cool. Backend: 'zwo', 'sim' or None (see open_camera).
+        Preview rate: Maximum number of frames per second sent for display. Image type: ASI_IMG_RAW8 or ASI_IMG_RAW16
+        (defaults to DEFAULT_IMAGE_TYPES). """
         super().__init__(uid, com_queue, res_queue)
 
         self._camera_type = camera_type
+        self._backend = backend
+
+        if image_type is None:
+            image_type = DEFAULT_IMAGE_TYPES.get(camera_type, ASI_IMG_RAW8)
+        self._image_type = image_type
 
         self._sensor_w = None
         self._sensor_h = None
+        # Exposure time last read back from the camera (see CACHED_QUERIES)
+        self._exp_time = None
 
         self._mode = None
 
-        # Timer for updating the GUI regularly
+        # Timer for updating the GUI regularly (in s)
         self._update_timer = 0
-
-        self._fps_timer = 0
+        self._update_interval = 10
+
+        # Shared memory ring for handing frames to the main process
+        self.frame_buffer = None
+        self._reported_overruns = 0
+
+        # Only the newest frame is sent for display, at most preview_rate times per second
+        self.display = None
+        self._preview_rate = preview_rate
+        self._reported_skipped = 0
+
+        # Number of frames of a recording and the frame of the running recording which is read out next
+        self._n_rec = 1000
+        self._rec_index = 0
+        self._rec_start = None
+        # Common start time (time.perf_counter_ns) and session of a recording synchronized with other cameras (see
+        # SyncCapture)
+        self._sync_start_ns = None
+        self.sync_id = None
+        # Number of frames left to record before the camera stops (None for no limit)
+        self._rec_limit = None
+
+        # Thread reading out the camera and the number of frames in a row which timed out
+        self.acquisition = None
+        self._frame_timeouts = 0
+
+        # Timing of the frames captured since streaming or recording was started
+        self.timing = FrameTiming()
+
+        # Shared memory ring of recordings handed to the image processing subprocess, the cube of the running
+        # recording and its per-frame metadata
+        self.rec_buffer = None
+        self._rec_slot = None
+        self._rec_data = None
+        self._rec_meta = None
+        self._rec_stalled = False
+        # Pre-allocated capture buffers (reallocated only when the ROI format changes)
+        self._scratch_frame = None
+        self.buffer_allocations = 0
+        # Name and time of the last frame of a running gap measurement (see start_gap_measurement)
+        self._gap = None
+        # Binning applied to the frames before they are published or recorded (None for no software binning)
+        self.binning = None
+        # ROI requested by the main process (in unbinned sensor pixels, see roi_to_swh)
+        self._roi = None
+        # Measures the stars in every frame (None if disabled) and the records waiting to be sent
+        self.centroider = None
+        self._centroids = []
+        self._centroids_sent = 0
+        self._dropped_frame = None
+        # Master frames (None if disabled) and the calibration of the current frame format, which is looked up again
+        # before the next frame once the conditions changed (see invalidate_calibration)
+        self.calibration_library = None
+        self.calibration = None
+        self._calibration_dirty = False
+        # Stacks the frames in continuous mode (None if disabled), the time the stack was started and when it is
+        # rendered for display next
+        self.stacker = None
+        self._stack_start = None
+        self._next_stack_preview = 0
+        self._stack_rendering = False
     
     def run(self):
         """Extend the event loop of subprocess. """
         
         # Set camera
         try:
-            self.camera = ZwoCamera(self._camera_type)
-        except ValueError:
+            self.camera = open_camera(self._camera_type, self._backend)
+        except (ValueError, ImportError):
             # Stop the subprocess if the camera was not found
             logging.info(f'Could not connect to camera {self._camera_type}. Stopping {self}.')
             # Tell the main process that the camera subprocess has stopped
@@ -192,72 +235,525 @@ class CameraSubprocess(Subprocess):
         self._sensor_w = info['MaxWidth']
         self._sensor_h = info['MaxHeight']
 
-        self.camera.set_roi(0, 0, self._sensor_w, self._sensor_h, image_type=ASI_IMG_RAW8)
+        self.camera.set_roi(0, 0, self._sensor_w, self._sensor_h, image_type=self._image_type)
+        self._roi = self.current_roi()
         self.camera.exp_time = 1e-3
+        self._exp_time = self.camera.exp_time
         self.camera.highspeed = True
         if self.camera.is_cooled:
             self.camera.enable_cooler()
             self.camera.temperature = 0
 
+        # Allocate the frame ring for the full sensor so ROI changes do not require reallocation
+        self.frame_buffer = FrameRingBuffer(self.uid, (self._sensor_h, self._sensor_w), self.camera.frame_dtype)
+        self.display = DisplayMailbox(self.frame_buffer, self._preview_rate)
+
+        # Tell the main process which image type is used
+        self.get_image_type()
+
         # Enable video mode
         self.camera.start_video_capture()
 
+        # Read out the camera on a separate thread
+        self.acquisition = AcquisitionThread(self.capture_frame, self.is_capturing, self.idle, self.idle_timeout, name=f'{self.uid:#x}')
+        self.acquisition.start()
+
         # Run the subprocess event loop
         super(CameraSubprocess, self).run()
 
+        # Stop reading out the camera (after the current frame)
+        self.acquisition.stop()
+        self.end_session()
+
         # Stop video mode
         self.camera.stop_video_capture()
         self.camera.highspeed = False
 
+        # Free the frame ring and the recordings once they are processed
+        self.frame_buffer.close()
+        self.close_rec_buffer()
+
         # Tell the main process that the camera subprocess has stopped
         self.send((CMD_STOP_SUBPROCESS,))
 
 
+    def handle_input(self, res):
+        """Overwrite the function that handles commands from the main process.
+
+        Commands are applied by the acquisition thread between two frames, so they never wait for more than a frame.
+        Queries of cached settings (CACHED_QUERIES) are answered right away, unless commands are still waiting for the
+        acquisition thread (which may change the settings, and the replies have to keep the order of the commands).
+        """
+
+        if res[0] in CACHED_QUERIES and not self.acquisition.pending:
+            self.answer_query(res)
+        else:
+            self.acquisition.call(self.apply_command, res)
+
+    def answer_query(self, res):
+        """Answer a query from the settings cached by the subprocess (called by the thread of the event loop). """
+
+        if res[0] == CMD_CAMERA_GET_EXP:
+            self.send((CMD_CAMERA_GET_EXP, self._exp_time))
+        elif res[0] == CMD_CAMERA_GET_IMAGE_TYPE:
+            self.get_image_type()
+        self.telemetry.count('cached_queries')
+
+    def wait_objects(self) -> list:
+        """Overwrite to also wake up the event loop when the acquisition thread stops. """
+
+        return [self.acquisition.sentinel]
+
     def inloop(self):
-        """Add a function call in the event loop to read out the camera. """
-        
-        
+        """Stop the event loop if the acquisition thread stopped (e.g., due to a camera error). """
+
+        if self.acquisition.sentinel.poll() or not self.acquisition.is_alive():
+            if self.acquisition.error is not None:
+                logging.error(f'Acquisition thread of {self} stopped due to {self.acquisition.error!r}.')
+            logging.info(f'Acquisition thread of {self} stopped. Stopping {self}.')
+            self._running = False
+
+    def is_capturing(self) -> bool:
+        """Whether frames are read out. """
+
+        return self._mode in (CMD_CAMERA_CONTINOUS_MODE, CMD_CAMERA_REC_MODE)
+
+    def capture_frame(self):
+        """Read out a single frame (called by the acquisition thread).
+
+        A frame which times out is skipped (counted as frame_timeouts). Only MAX_FRAME_TIMEOUTS timeouts in a row stop
+        the acquisition.
+        """
+
+        try:
+            self.handle_frame()
+        except ZWO_IOError as e:
+            if getattr(e, 'error_code', None) != ASI_ERROR_TIMEOUT:
+                raise
+            self._frame_timeouts += 1
+            self.telemetry.count('frame_timeouts')
+            logging.debug(f'{self} frame timed out ({self._frame_timeouts} in a row).')
+            if self._frame_timeouts >= MAX_FRAME_TIMEOUTS:
+                raise
+        else:
+            self._frame_timeouts = 0
+
+    def handle_frame(self):
+        """Read out a frame and record, stack or publish it depending on the mode. """
+
         if self._mode == CMD_CAMERA_REC_MODE:
-            img_data = []
-            t_s = time.time()
-            for i in range(1000):
-                img_data.append(self.camera.capture_video_frame())
-            # Get FPS
-            t_f = time.time()    
-            fps = 1000 / (t_f - t_s)
-            self.send((CMD_CAMERA_GET_FPS, fps))
-            # Update GUI
-            self.send((CMD_DISPLAY_IMAGE, img_data[-1]))    
-            # Return Image stack
-            self.send((CMD_RETURN_REC, img_data))    
+            if self._sync_start_ns is not None:
+                if time.perf_counter_ns() < self._sync_start_ns:
+                    # Frames read out before the common start time of a synchronized recording are not recorded
+                    img_data = self.get_dropped_frame()
+                    info = self.read_frame(img_data)
+                    self.frame_captured(img_data, info)
+                    return
+                self._sync_start_ns = None
+
+            if self._calibration_dirty:
+                # Look the calibration up before the frame, so a change can still hand over the frames recorded so far
+                self.update_calibration()
+
+            if self._rec_index == 0 and not self.start_recording():
+                # All recording buffers are still being processed. Read out the frame so the camera does not stall
+                img_data = self.get_dropped_frame()
+                info = self.read_frame(img_data)
+                self.frame_captured(img_data, info)
+                self.update_gui(self._update_interval)
+                return
+
+            img_data = self._rec_data
+            info = self.read_frame(img_data[self._rec_index])
+            self.frame_captured(img_data[self._rec_index], info)
+            for key, value in zip(('SEQ', 'T_NS', 'DROPPED'), info):
+                self._rec_meta[key][self._rec_index] = value
+            self._rec_index += 1
+
+            if self._rec_limit is not None:
+                self._rec_limit -= 1
+
+            if self._rec_index == self._n_rec or self._rec_limit == 0:
+                self.finish_recording(info)
+
+            if self._rec_limit == 0:
+                # All requested frames were recorded
+                logging.info(f'{self} recorded the requested frames. Stopping.')
+                self.end_session()
+                self._mode = CMD_CAMERA_MODE_STOP
+                self._rec_limit = None
+                self._sync_start_ns, self.sync_id = None, None
+                self.send((CMD_CAMERA_MODE_STOP, ))
+        elif self._mode == CMD_CAMERA_CONTINOUS_MODE and self.stacker is not None:
+            # The frames go into the stack and the stack is displayed instead
+            img_data = self.get_dropped_frame()
+            info = self.read_frame(img_data)
+            self.frame_captured(img_data, info)
+            with self.telemetry.stage('stack'):
+                if self.stacker.added == 0:
+                    self._stack_start = datetime.utcnow()
+                self.stacker.add(img_data)
+            self.publish_stack(info)
         elif self._mode == CMD_CAMERA_CONTINOUS_MODE:
-            img_data = self.camera.capture_video_frame()
-            # GET FPS
-            t_f = time.time()
-            fps = 1 / (t_f - self._fps_timer)
-            self._fps_timer = t_f
-            self.send((CMD_CAMERA_GET_FPS, fps))
-            self.send((CMD_DISPLAY_IMAGE, img_data))        
+            # Read the frame directly into a free slot of the frame ring
+            self.frame_buffer.resize(*self.frame_format())
+            slot, img_data = self.frame_buffer.acquire()
+            if slot is None:
+                # The main process is behind. Still read out the frame so the camera does not stall
+                img_data = self.get_dropped_frame()
+            info = self.read_frame(img_data)
+            self.frame_captured(img_data, info)
+            if slot is None:
+                self.report_overruns()
+            else:
+                with self.telemetry.stage('publish'):
+                    self.offer_preview(slot, info=info)
 
         # Update the GUI every 10 seconds
-        self.update_gui(10)
+        self.update_gui(self._update_interval)
 
-    def handle_input(self, res):
-        """Overwrite the function that handles commands from the main process. """
+    def read_frame(self, out: np.ndarray):
+        """Read out the next frame into out (in the format of frame_format()), applying the software binning and the
+        calibration.
+
+        # Returns
+        * info::FrameInfo - FrameInfo of the frame.
+        """
+
+        if self.binning is None:
+            with self.telemetry.stage('capture'):
+                self.camera.capture_video_frame_into(out)
+        else:
+            with self.telemetry.stage('capture'):
+                raw = self.camera.capture_video_frame_into(self.get_scratch_frame())
+            with self.telemetry.stage('binning'):
+                self.binning(raw, out)
+
+        if self._calibration_dirty:
+            self.update_calibration()
+        if self.calibration is not None:
+            with self.telemetry.stage('calibration'):
+                self.calibration(out, out=out)
+
+        return self.camera.last_frame
+
+    def frame_captured(self, frame: np.ndarray, info):
+        """Update the statistics and measure the stars of a frame which was just read out. """
+
+        self.timing.add(info)
+        if self._gap is not None:
+            self.end_gap_measurement(info)
+        self.telemetry.count('capture', info.t_ns)
+
+        if self.centroider is not None:
+            with self.telemetry.stage('centroid'):
+                self.measure_centroids(frame, info)
+
+    def frame_format(self) -> tuple:
+        """Shape and data type of the frames after the software binning. """
+
+        if self.binning is None:
+            return self.camera.frame_shape, self.camera.frame_dtype
+        return self.binning.output_format(self.camera.frame_shape, self.camera.frame_dtype)
+
+    def total_binning(self) -> int:
+        """Binning of the camera times the software binning. """
+
+        bins = self.camera.get_roi_format()[2]
+        return bins * (self.binning.factor if self.binning is not None else 1)
+
+    def idle(self):
+        """Send the pending preview frame and update the GUI while no frames are read out. """
+
+        # Send the last frame once the main process has caught up
+        self.offer_preview(None)
+        self.send_centroids()
+        self.update_gui(self._update_interval)
+
+    def idle_timeout(self) -> float:
+        """Time the acquisition thread sleeps while no frames are read out.
+
+        The thread sleeps until the GUI has to be updated or a pending preview frame can be sent.
+        """
+
+        timeout = max(self._update_interval - (time.time() - self._update_timer), 0)
+        if self.display.pending:
+            # The main process releases frames through the shared memory, so check again after one preview period
+            timeout = min(timeout, 1 / (self._preview_rate or 100))
+
+        return timeout
+
+    def offer_preview(self, slot, report_fps=True, info=None):
+        """Offer a newly captured frame for display (slot None only flushes the pending frame).
+
+        The frame reference is only sent if the main process has released the previous preview frame and the preview
+        rate is not exceeded. The FPS are reported together with the preview frames. info (the FrameInfo of the frame)
+        is sent with the reference.
+        """
+
+        ref = self.display.poll() if slot is None else self.display.offer(slot, info)
+        if ref is None:
+            return
+
+        self.send((CMD_DISPLAY_IMAGE, ref))
+
+        # Sample the fill levels of the transport with the preview rate
+        self.telemetry.gauge('ring_occupancy', self.frame_buffer.occupancy)
+
+        if report_fps:
+            # Capture rate over the last seconds
+            self.send((CMD_CAMERA_GET_FPS, self.telemetry.rate('capture')))
+
+    def publish_frame(self, img_data, report_fps=True, info=None):
+        """Copy a frame into the shared memory ring and offer it for display. """
+
+        self.frame_buffer.resize(img_data.shape, img_data.dtype)
+        slot, view = self.frame_buffer.acquire()
+        if slot is None:
+            self.report_overruns()
+            return
+
+        view[...] = img_data
+        self.offer_preview(slot, report_fps, info)
+
+    def publish_stack(self, info=None):
+        """Render the stack into the frame ring and offer it for display, at most STACK_PREVIEW_RATE times per
+        second. Rendering a clipped stack is spread over several frames (see LiveStacker.refine).
+        """
+
+        now = time.perf_counter()
+        if not self._stack_rendering and now < self._next_stack_preview:
+            return
+
+        self._stack_rendering = True
+        with self.telemetry.stage('stack_render'):
+            if not self.stacker.refine():
+                return
+        self._stack_rendering = False
+        self._next_stack_preview = now + 1 / STACK_PREVIEW_RATE
+
+        self.frame_buffer.resize(*self.frame_format())
+        slot, view = self.frame_buffer.acquire()
+        if slot is None:
+            self.report_overruns()
+            return
+
+        with self.telemetry.stage('publish'):
+            self.stacker.render(view)
+            self.telemetry.gauge('stack_frames', self.stacker.count)
+            self.offer_preview(slot, info=info)
+
+    def report_overruns(self):
+        """Tell the main process how many frames were dropped because the frame ring was full. """
+
+        if self.frame_buffer.overruns - self._reported_overruns >= self.frame_buffer.n_slots:
+            # Report overruns in batches to not flood the result queue while the main process is behind
+            self._reported_overruns = self.frame_buffer.overruns
+            logging.debug(f'{self} frame ring overrun ({self._reported_overruns} frames dropped)')
+            self.send((CMD_CAMERA_OVERRUN, self._reported_overruns))
+
+    def get_rec_buffer(self) -> FrameRingBuffer:
+        """Get the shared memory ring of recordings, resized to the current ROI format.
+
+        Returns None if the ring has to be reallocated while recordings in it are still being processed.
+        """
+
+        frame_shape, frame_dtype = self.frame_format()
+        shape = (self._n_rec, ) + frame_shape
+        if self.rec_buffer is None:
+            self.rec_buffer = FrameRingBuffer(self.uid, shape, frame_dtype, REC_BUFFER_SLOTS, prefix='rec')
+            self.buffer_allocations += 1
+        elif self.rec_buffer.shape != shape or self.rec_buffer.dtype != frame_dtype:
+            if int(np.prod(shape)) * frame_dtype.itemsize > self.rec_buffer.slot_bytes:
+                if self.rec_buffer.occupancy:
+                    return None
+                self.buffer_allocations += 1
+            self.rec_buffer.resize(shape, frame_dtype)
+
+        return self.rec_buffer
+
+    def start_recording(self) -> bool:
+        """Get a free cube of the recording ring for the next recording.
+
+        If the image processing has not released any cube yet, the frame is dropped (counted as rec_dropped).
+
+        # Returns
+        * started::bool - Whether a recording was started.
+        """
+
+        rec_buffer = self.get_rec_buffer()
+        self._rec_slot, self._rec_data = (None, None) if rec_buffer is None else rec_buffer.acquire()
+        if self._rec_slot is None:
+            if not self._rec_stalled:
+                logging.warning(f'{self} drops frames until a recording was processed.')
+                self._rec_stalled = True
+            self.telemetry.count('rec_dropped')
+            return False
+
+        self._rec_stalled = False
+        self._rec_start = (datetime.utcnow(), time.time())
+        # New arrays for every recording, since the result queue pickles them in the background
+        self._rec_meta = {key: np.zeros(self._n_rec, dtype=np.int64) for key in ('SEQ', 'T_NS', 'DROPPED')}
+
+        return True
+
+    def finish_recording(self, info=None):
+        """Hand the running recording over to the image processing. A recording stopped early only contains the frames
+        recorded so far.
+        """
+
+        n_frames = self._rec_index
+        self._rec_index = 0
+        start_time, t_s = self._rec_start
+        # Get FPS
+        t_f = time.time()
+        end_time = datetime.utcnow()
+        fps = n_frames / (t_f - t_s)
+        self.send((CMD_CAMERA_GET_FPS, fps))
+        # Update GUI
+        with self.telemetry.stage('publish'):
+            self.publish_frame(self._rec_data[n_frames - 1], report_fps=False, info=info)
+        # Hand the recording over in shared memory, the buffer is reused once the image processing released it
+        with self.telemetry.stage('record'):
+            header = self.frame_header(start_time, end_time)
+            ref = self.rec_buffer.publish(self._rec_slot, info)
+            meta = self._rec_meta
+            if n_frames < self._n_rec:
+                ref = ref._replace(shape=(n_frames, ) + ref.shape[1:])
+                meta = {key: value[:n_frames] for key, value in meta.items()}
+            self.send((CMD_RETURN_REC, ref, header, meta))
+            self._rec_slot = None
+            self._rec_data = None
+            self._rec_meta = None
+        self.telemetry.gauge('rec_occupancy', self.rec_buffer.occupancy)
+
+    def split_recording(self):
+        """Hand the frames recorded so far over as a recording of their own before a setting which goes into the
+        header of the recording changes (the recording continues with the next frame).
+        """
+
+        if self._mode == CMD_CAMERA_REC_MODE and self._rec_index:
+            self.finish_recording()
+
+    def close_rec_buffer(self, timeout: float = REC_RELEASE_TIMEOUT):
+        """Wait at most timeout seconds for the recordings to be processed and free the recording ring. """
+
+        if self.rec_buffer is None:
+            return
+
+        t_end = time.perf_counter() + timeout
+        while self.rec_buffer.occupancy and time.perf_counter() < t_end:
+            time.sleep(0.05)
+        if self.rec_buffer.occupancy:
+            logging.warning(f'{self} frees {self.rec_buffer.occupancy} recordings which were not processed.')
+
+        self.rec_buffer.close()
+        self.rec_buffer = None
+
+    def get_dropped_frame(self) -> np.ndarray:
+        """Get a pre-allocated frame in the format of frame_format() for frames which are not displayed. """
+
+        if self.binning is None:
+            return self.get_scratch_frame()
+
+        frame_shape, frame_dtype = self.frame_format()
+        if self._dropped_frame is None or self._dropped_frame.shape != frame_shape or self._dropped_frame.dtype != frame_dtype:
+            self._dropped_frame = np.empty(frame_shape, dtype=frame_dtype)
+            self.buffer_allocations += 1
+
+        return self._dropped_frame
+
+    def get_scratch_frame(self) -> np.ndarray:
+        """Get a pre-allocated frame in the format of the camera (for frames which are dropped or binned). """
+
+        if self._scratch_frame is None or self._scratch_frame.shape != self.camera.frame_shape or self._scratch_frame.dtype != self.camera.frame_dtype:
+            self._scratch_frame = np.empty(self.camera.frame_shape, dtype=self.camera.frame_dtype)
+            self.buffer_allocations += 1
+
+        return self._scratch_frame
+
+    def get_stats(self) -> dict:
+        """Extend the telemetry snapshot by the state of the frame ring and the frame timing. """
+
+        if self.frame_buffer is not None:
+            self.telemetry.gauge('ring_occupancy', self.frame_buffer.occupancy)
+
+        stats = super(CameraSubprocess, self).get_stats()
+        stats['counters'] = {
+            'ring_overruns': self.frame_buffer.overruns if self.frame_buffer is not None else 0,
+            'rec_overruns': self.rec_buffer.overruns if self.rec_buffer is not None else 0,
+            'display_shown': self.display.shown if self.display is not None else 0,
+            'display_skipped': self.display.skipped if self.display is not None else 0,
+        }
+        stats['timing'] = self.timing.report()
+        stats['sdk_calls'] = dict(self.camera.sdk_calls)
+
+        return stats
+
+    def get_capture_stats(self):
+        """Send the capture counters to the main process.
+
+        The number of buffer allocations only grows when the ROI format changes, not with the number of frames.
+        """
+
+        stats = {
+            'frames_captured': self.camera.frames_captured,
+            'frames_allocated': self.camera.frames_allocated,
+            'buffer_allocations': self.buffer_allocations,
+            'ring_allocations': self.frame_buffer.generation,
+            'controls_applied': self.acquisition.controls_applied,
+            'control_latency': self.acquisition.control_latency,
+            'sdk_calls': dict(self.camera.sdk_calls),
+        }
+        logging.debug(f'{self} capture stats {stats}')
+        self.send((CMD_CAMERA_GET_CAPTURE_STATS, stats))
+
+    def apply_command(self, res):
+        """Handle a command and record the number of SDK calls it needed. """
+
+        n_calls = self.camera.n_sdk_calls
+        try:
+            self.handle_command(res)
+        except Exception:
+            # A failing command (e.g., invalid settings) must not stop the acquisition
+            logging.exception(f'{self} failed to apply command {res[0]:#x}.')
+            self.telemetry.count('command_errors')
+        finally:
+            self.telemetry.gauge(f'sdk_calls {res[0]:#x}', self.camera.n_sdk_calls - n_calls)
+
+    def handle_command(self, res):
+        """Handle a command from the main process (called by the acquisition thread). """
 
         if res[0] == CMD_CAMERA_GET_EXP:
             self.get_exposure_time()
         elif res[0] == CMD_CAMERA_SET_EXP:
             self.set_exposure_time(res[1])
         elif res[0] == CMD_CAMERA_MODE_STOP:
-            # Set camera mode to not recording
+            # Set camera mode to not recording (drops an unfinished recording unless (keep, ) is given)
+            if self._mode == CMD_CAMERA_REC_MODE and self._rec_index and len(res) > 1 and res[1]:
+                self.finish_recording()
+            self.end_session()
             self._mode = CMD_CAMERA_MODE_STOP
+            self._rec_index = 0
+            self._rec_limit = None
+            self._sync_start_ns, self.sync_id = None, None
         elif res[0] == CMD_CAMERA_CONTINOUS_MODE:
             # Set camera mode to continusous
+            self.end_session()
+            self.reset_stack()
             self._mode = CMD_CAMERA_CONTINOUS_MODE
+            self._rec_index = 0
+            self._rec_limit = None
+            self._sync_start_ns, self.sync_id = None, None
         elif res[0] == CMD_CAMERA_REC_MODE:
-            # Set camera mode to recording
-            self._mode = CMD_CAMERA_REC_MODE   
+            # Set camera mode to recording, optionally from a common start time of several cameras (start_ns, sync_id)
+            # and for a limited number of frames (n_frames), after which the camera stops
+            self.end_session()
+            self._mode = CMD_CAMERA_REC_MODE
+            self._rec_index = 0
+            self._sync_start_ns, self.sync_id, self._rec_limit = (tuple(res[1:4]) + (None, None, None))[:3]
+            # Allocate the recording ring now rather than with the first frame of the recording
+            self.get_rec_buffer()
         elif res[0] == CMD_CAMERA_GET_ROI:
             self.get_roi()
         elif res[0] == CMD_CAMERA_SET_ROI:
@@ -266,15 +762,49 @@ class CameraSubprocess(Subprocess):
             self.get_temperature()
         elif res[0] == CMD_CAMERA_SET_TEMP:
             self.set_temperature(res[1])
+        elif res[0] == CMD_CAMERA_GET_CAPTURE_STATS:
+            self.get_capture_stats()
+        elif res[0] == CMD_CAMERA_SET_PREVIEW_RATE:
+            self.set_preview_rate(res[1])
+        elif res[0] == CMD_CAMERA_GET_IMAGE_TYPE:
+            self.get_image_type()
+        elif res[0] == CMD_CAMERA_SET_IMAGE_TYPE:
+            self.set_image_type(res[1])
+        elif res[0] == CMD_CAMERA_GET_TIMING:
+            self.send((CMD_CAMERA_GET_TIMING, self.timing.report()))
+        elif res[0] == CMD_CAMERA_APPLY_CONFIG:
+            self.apply_config(res[1])
+        elif res[0] == CMD_CAMERA_GET_CONFIG:
+            self.get_config()
+        elif res[0] == CMD_CAMERA_SET_CENTROIDING:
+            self.set_centroiding(res[1])
+        elif res[0] == CMD_CAMERA_SET_CALIBRATION:
+            self.set_calibration(res[1])
+        elif res[0] == CMD_CAMERA_SET_STACKING:
+            self.set_stacking(res[1])
+        elif res[0] == CMD_CAMERA_SAVE_STACK:
+            self.save_stack(*res[1:])
         else:
             raise NotImplementedError(f'{res[0]}')
 
         
+    def end_session(self):
+        """Send the timing report of the frames captured since streaming or recording was started and start a new
+        session.
+        """
+
+        self.send_centroids(force=True)
+        if self.timing.frames:
+            report = self.timing.log(f'{self} capture session: ')
+            self.send((CMD_CAMERA_GET_TIMING, report))
+        self.timing.reset()
+
     def get_exposure_time(self):
         """Get the exposure time from the camera and put the result on the res_queue. """
 
         logging.debug(f'{self} reads out exposure time.')
-        data = [CMD_CAMERA_GET_EXP, self.camera.exp_time]
+        self._exp_time = self.camera.exp_time
+        data = [CMD_CAMERA_GET_EXP, self._exp_time]
         self.send(data)
 
     def set_exposure_time(self, val: float):
@@ -282,7 +812,12 @@ class CameraSubprocess(Subprocess):
         
         logging.debug(f'{self} sets exposure time.')
         #self.camera.stop_video_capture()
+        self.split_recording()
+        # The frame rate changes, so the timing of the following frames is reported separately
+        self.end_session()
         self.camera.exp_time = val
+        self.invalidate_calibration()
+        self.reset_stack()
 
         self.get_exposure_time()
 
@@ -300,9 +835,18 @@ class CameraSubprocess(Subprocess):
         if self.camera.is_cooled:
             logging.debug(f'{self} sets temerature.')
             self.camera.temperature = val
+            self.invalidate_calibration()
 
 
 
+    def set_preview_rate(self, rate: float):
+        """Set the maximum number of frames per second sent for display (None for no limit). """
+
+        logging.debug(f'{self} sets preview rate to {rate}.')
+        self._preview_rate = rate
+        if self.centroider is None:
+            self.display.max_rate = rate
+
     def get_roi(self):
         """Get the ROI and trigger updating of the GUI.
         
@@ -315,19 +859,11 @@ class CameraSubprocess(Subprocess):
         * sensor_h::int - Height of the camera sensor.
         """
 
-        # Get the ROI from the camera
-        start_x, start_y, width, height = self.camera.get_roi()
-
-        # Calculate the absolute ROI
-        roi_x_1, roi_x_2, roi_y_1, roi_y_2 = roi_swh_to_absolute(start_x, start_y, width, height)
-
-        # Calculate the values we display in the GUI
-        offset_x, roi_width, offset_y, roi_height = roi_absolute_to_offset(roi_x_1, roi_x_2, roi_y_1, roi_y_2, self._sensor_w, self._sensor_h)
+        # Calculate the values we display in the GUI (in unbinned sensor pixels)
+        offset_x, roi_width, offset_y, roi_height = self.current_roi()
 
         # Log values
-        logging.info(f'{self} get ROI x: ({roi_x_1}, {roi_x_2}) y: ({roi_y_1}, {roi_y_2}).')
-        logging.debug(f'ROI offset values x: ({offset_x}, {roi_width}) y: ({offset_y}, {roi_height}).')
-        logging.debug(f'ROI swh values x: ({start_x}, {start_y}) y: ({width}, {height}).')
+        logging.info(f'{self} get ROI offset values x: ({offset_x}, {roi_width}) y: ({offset_y}, {roi_height}).')
 
         # Return data
         data = [CMD_CAMERA_GET_ROI, (offset_x, roi_width, offset_y, roi_height, self._sensor_w, self._sensor_h)]
@@ -335,328 +871,489 @@ class CameraSubprocess(Subprocess):
 
         #return offset_x, roi_width, offset_y, roi_height
 
-    def set_roi(self, offset_x, roi_width, offset_y, roi_height):
-        """Set the ROI.
-        
+    def roi_to_swh(self, offset_x, roi_width, offset_y, roi_height, bins: int = 1) -> tuple:
+        """Convert a ROI given by its offset from the sensor center to the start position, width and height used by
+        the camera.
+
+        The ROI is given in unbinned sensor pixels, so it stays the same when the binning changes. The camera expects
+        binned pixels, a width divisible by 8 and a height divisible by 2, so the binned ROI may be slightly smaller.
+
         # Arguments
         * offset_x::int - Offset from the sensor center in x.
         * roi_width::int -  Width of the ROI.
         * offset_y::int - Offset from the sensor center in y.
         * roi_height::int - Height of the ROI.
+        * bins::int - Binning of the camera.
         """
 
+        sensor_w, sensor_h = self._sensor_w, self._sensor_h
+
         # Calculate the absolute size of the ROI
-        roi_x_1, roi_x_2, roi_y_1, roi_y_2 = roi_offset_to_absolute(offset_x, roi_width, offset_y, roi_height, self._sensor_w, self._sensor_h)
+        roi_x_1, roi_x_2, roi_y_1, roi_y_2 = roi_offset_to_absolute(offset_x, roi_width, offset_y, roi_height, sensor_w, sensor_h)
 
         # Check the size
-        assert roi_x_1 >= 0 and roi_x_1 <= self._sensor_w, 'roi_x_1 out of range.'
-        assert roi_x_2 >= 0 and roi_x_2 <= self._sensor_w, 'roi_x_2 out of range.'
-        assert roi_y_1 >= 0 and roi_y_1 <= self._sensor_h, 'roi_y_1 out of range.'
-        assert roi_y_2 >= 0 and roi_y_2 <= self._sensor_h, 'roi_y_2 out of range.'
-
-        # Calculate the width and height of the ROI
-        start_x, start_y, width, height = roi_absolute_to_swh(roi_x_1, roi_x_2, roi_y_1, roi_y_2)
+        assert roi_x_1 >= 0 and roi_x_1 <= sensor_w, 'roi_x_1 out of range.'
+        assert roi_x_2 >= 0 and roi_x_2 <= sensor_w, 'roi_x_2 out of range.'
+        assert roi_y_1 >= 0 and roi_y_1 <= sensor_h, 'roi_y_1 out of range.'
+        assert roi_y_2 >= 0 and roi_y_2 <= sensor_h, 'roi_y_2 out of range.'
 
         # Log values
-        logging.info(f'{self} set ROI to x: ({roi_x_1}, {roi_x_2}) y: ({roi_y_1}, {roi_y_2}).')
         logging.debug(f'ROI offset values x: ({offset_x}, {roi_width}) y: ({offset_y}, {roi_height}).')
-        logging.debug(f'ROI swh values x: ({start_x}, {start_y}) y: ({width}, {height}).')
+        logging.debug(f'ROI absolute values x: ({roi_x_1}, {roi_x_2}) y: ({roi_y_1}, {roi_y_2}).')
 
-        # Stop video recording to prevent crash
-        self.camera.stop_video_capture()
-        # Update ROI
-        self.camera.set_roi(start_x, start_y, width, height, image_type=ASI_IMG_RAW8)
-        # Continue recording
-        self.camera.start_video_capture()
+        # Calculate the width and height of the ROI
+        start_x, start_y, width, height = roi_absolute_to_swh(roi_x_1, roi_x_2, roi_y_1, roi_y_2)
+        if bins > 1:
+            width = max(width // bins // 8 * 8, 8)
+            height = max(height // bins // 2 * 2, 2)
+            start_x = min(start_x // bins, sensor_w // bins - width)
+            start_y = min(start_y // bins, sensor_h // bins - height)
 
-    def get_sensor_size(self):
-        return (self._sensor_w, self._sensor_h)
+        return start_x, start_y, width, height
 
-    def update_gui(self, update_rate):
-        """Get the state of the camera and update the GUI every few seconds. """
+    def set_roi(self, offset_x, roi_width, offset_y, roi_height):
+        """Set the ROI.
+        
+        # Arguments
+        * offset_x::int - Offset from the sensor center in x.
+        * roi_width::int -  Width of the ROI.
+        * offset_y::int - Offset from the sensor center in y.
+        * roi_height::int - Height of the ROI.
+        """
 
-        if time.time() - self._update_timer > update_rate:
-            self.get_temperature()
-            self._update_timer = time.time()
+        _, _, bins, _ = self.camera.get_roi_format()
+        start_x, start_y, width, height = self.roi_to_swh(offset_x, roi_width, offset_y, roi_height, bins)
+        self._roi = (offset_x, roi_width, offset_y, roi_height)
+        logging.info(f'{self} set ROI to start ({start_x}, {start_y}) size ({width}, {height}).')
 
+        self.change_roi(start_x, start_y, width, height, bins, self._image_type)
 
-class CameraInterface(Interface):
-    def __init__(self, camera_type, image_label, res_queue: Queue, settings_window, streaming_button, rec_button, settings_button, fps_display):
-        """Constructor. camera_type: ZWO ASI120MM Mini or ZWO ASI174MM-Cool"""
+    def change_roi(self, start_x: int, start_y: int, width: int, height: int, bins: int, image_type: int):
+        """Change the ROI. A ROI of the same format is only moved, otherwise the video capture is restarted.
 
-        if camera_type == 'ZWO ASI120MM Mini':
-            ID = CAMERA_ID
-        elif camera_type == 'ZWO ASI174MM-Cool':
-            ID = COOL_CAMERA_ID
+        # Arguments
+        * start_x::int - Start of the ROI in x (in binned pixels).
+        * start_y::int - Start of the ROI in y (in binned pixels).
+        * width::int - Width of the ROI (in binned pixels).
+        * height::int - Height of the ROI (in binned pixels).
+        * bins::int - Binning.
+        * image_type::int - ASI_IMG_RAW8 or ASI_IMG_RAW16.
+        """
+
+        if (width, height, bins, image_type) == tuple(self.camera.get_roi_format()):
+            self.move_roi(start_x, start_y)
         else:
-            raise NotImplementedError(f'{camera_type} not known.')
+            # The frame rate changes, so the timing of the following frames is reported separately
+            self.end_session()
+            self.restart_capture(start_x, start_y, width, height, bins, image_type)
+
+    def move_roi(self, start_x: int, start_y: int):
+        """Move the ROI without changing its format. The camera keeps streaming and recording, but the frames recorded
+        so far are handed over as a recording of their own, since the header of a recording has a single origin.
+        """
 
-        super().__init__(ID, res_queue)
+        if (start_x, start_y) == tuple(self.camera.get_roi_start_position()):
+            return
 
-        # Initialize GUI elements for controling the camera
+        self.split_recording()
+        self.start_gap_measurement('roi_move_gap')
+        self.camera.set_roi_start_position(start_x, start_y)
+        self.telemetry.count('roi_move')
+        self.invalidate_calibration()
+        self.reset_stack()
+        if self.centroider is not None:
+            self.centroider.reset()
+
+    def start_gap_measurement(self, name: str):
+        """Record the time between the last frame and the next frame as the latency name (e.g., the frames lost by
+        changing the ROI).
+        """
 
-        # Initialize the GUI element for displaying the camera image
-        self.image_label = image_label
-        self.streaming_button = streaming_button
-        self.recording_button = rec_button
-        self.settings_button = settings_button
-        self.fps_display = fps_display
+        if self.is_capturing() and self.camera.last_frame is not None:
+            self._gap = (name, self.camera.last_frame.t_ns)
+        else:
+            self._gap = None
 
-        # Settings window
-        self.settings_window = settings_window
-        self.settings_window.connect_signals(self.set_exp_time, self.set_roi, self.set_temperature)
+    def end_gap_measurement(self, info):
+        """Complete the gap measurement with the FrameInfo of the next frame. """
 
-        # Signals
-        self.streaming_button.clicked.connect(self.toggle_streaming_mode)
-        self.recording_button.clicked.connect(self.toggle_recording_mode)     
-        self.settings_button.clicked.connect(self.toggle_settings) 
+        name, t_ns = self._gap
+        self._gap = None
+        gap = (info.t_ns - t_ns) * 1e-9
+        self.telemetry.latency(name, gap)
+        logging.debug(f'{self} {name}: {gap * 1e3:.1f} ms')
 
-        # Camera time
-        self._camera_type = camera_type
+    def restart_capture(self, start_x: int, start_y: int, width: int, height: int, bins: int, image_type: int):
+        """Change the ROI format. The video capture has to be stopped for it, and the frames recorded so far are handed
+        over as a recording of their own.
 
-        # Camera state
-        self._camera_state = None
+        # Arguments
+        * start_x::int - Start of the ROI in x (in binned pixels).
+        * start_y::int - Start of the ROI in y (in binned pixels).
+        * width::int - Width of the ROI (in binned pixels).
+        * height::int - Height of the ROI (in binned pixels).
+        * bins::int - Binning.
+        * image_type::int - ASI_IMG_RAW8 or ASI_IMG_RAW16.
+        """
+
+        self.split_recording()
+        self.start_gap_measurement('roi_restart_gap')
+        # Stop video recording to prevent crash
+        self.camera.stop_video_capture()
+        # Update ROI
+        self.camera.set_roi(start_x, start_y, width, height, bins, image_type)
+        self._image_type = image_type
+        # Resize the frame slots (reallocates the ring for larger pixels)
+        self.frame_buffer.resize(*self.frame_format())
+        # Continue recording
+        self.camera.start_video_capture()
+        self.telemetry.count('capture_restart')
+        self.invalidate_calibration()
+        self.reset_stack()
+        if self.centroider is not None:
+            self.centroider.reset()
+
+    def current_roi(self) -> tuple:
+        """Get the ROI by its offset from the sensor center in unbinned sensor pixels. """
+
+        width, height, bins, _ = self.camera.get_roi_format()
+        start_x, start_y = self.camera.get_roi_start_position()
+        return roi_absolute_to_offset(*roi_swh_to_absolute(start_x * bins, start_y * bins, width * bins, height * bins), self._sensor_w, self._sensor_h)
+
+    def current_config(self) -> dict:
+        """Get the current settings (see CONFIG_KEYS). The ROI is the requested one, given by its offset from the
+        sensor center in unbinned sensor pixels. The ROI of the camera may be slightly smaller for binned frames.
+        """
 
-        # Show warning for large ROIs
-        self._warn_large_roi = True
+        _, _, bins, image_type = self.camera.get_roi_format()
+
+        return {
+            'exp_time': self.camera.exp_time,
+            'roi': self._roi,
+            'image_type': image_type,
+            'bins': bins,
+            'highspeed': self.camera.highspeed,
+            'soft_bins': self.binning.factor if self.binning is not None else 1,
+            'soft_bin_method': self.binning.method if self.binning is not None else 'sum',
+        }
+
+    def get_config(self):
+        """Send the current settings together with the ROI of the camera, the sensor size, the supported binnings,
+        the bit depth of the camera and the number of significant bits of the frames (after software binning) to the
+        main process.
+        """
 
-    def toggle_controls(self, state: bool):
-        """Enable or disable the controls. """
+        config = self.current_config()
+        config['camera_roi'] = self.current_roi()
+        config['sensor_w'] = self._sensor_w
+        config['sensor_h'] = self._sensor_h
+        config['supported_bins'] = list(self.camera.get_camera_property()['SupportedBins'])
+        config['bit_depth'] = self.camera.bit_depth
+        frame_bits = 8 * IMAGE_TYPE_DTYPES[config['image_type']].itemsize
+        config['frame_bits'] = self.binning.bit_depth(frame_bits) if self.binning is not None else frame_bits
+        self.send((CMD_CAMERA_GET_CONFIG, config))
+
+    def apply_config(self, config: dict):
+        """Apply several settings at once (see CONFIG_KEYS) and send the resulting settings back.
+
+        Only settings which differ from the current ones are changed, and the video capture is restarted at most once
+        for all changes of the ROI format. A ROI which is only moved does not need a restart. The ROI is given in
+        unbinned sensor pixels, so it stays in place when the binning changes. Binnings not supported by the camera
+        are ignored.
+        """
 
-        self.streaming_button.setEnabled(state)
-        self.recording_button.setEnabled(state)
-        self.settings_button.setEnabled(state)
-        self.fps_display.setEnabled(state)
+        unknown = set(config) - set(CONFIG_KEYS)
+        if unknown:
+            raise ValueError(f'Unknown settings {unknown}.')
+
+        current = self.current_config()
+        changes = {key: value for key, value in config.items() if value is not None and not same_setting(key, value, current[key])}
+        if 'image_type' in changes and changes['image_type'] not in IMAGE_TYPE_DTYPES:
+            raise ValueError(f'Image type {changes["image_type"]} not supported.')
+        if 'bins' in changes and changes['bins'] not in self.camera.get_camera_property()['SupportedBins']:
+            logging.warning(f'{self} does not support {changes["bins"]}x{changes["bins"]} binning.')
+            del changes['bins']
+        if changes.get('soft_bins', current['soft_bins']) == 1:
+            # The method does not matter without software binning
+            changes.pop('soft_bin_method', None)
+
+        if changes:
+            logging.info(f'{self} applies {changes}.')
+            if 'exp_time' in changes:
+                # The exposure time goes into the header, so the frames recorded so far are a recording of their own
+                self.split_recording()
+            if changes.keys() & {'exp_time', 'highspeed'}:
+                # The frame rate changes, so the timing of the following frames is reported separately
+                self.end_session()
+
+            if 'exp_time' in changes:
+                self.camera.exp_time = changes['exp_time']
+                self._exp_time = self.camera.exp_time
+                self.invalidate_calibration()
+                self.reset_stack()
+            if 'highspeed' in changes:
+                self.camera.highspeed = changes['highspeed']
+
+            if changes.keys() & {'soft_bins', 'soft_bin_method'}:
+                self.set_software_binning(changes.get('soft_bins', current['soft_bins']), changes.get('soft_bin_method', current['soft_bin_method']))
+            if 'bins' in changes:
+                self.set_hardware_binning(changes['bins'] > 1)
+
+            if changes.keys() & {'roi', 'image_type', 'bins', 'soft_bins', 'soft_bin_method'}:
+                bins = changes.get('bins', current['bins'])
+                image_type = changes.get('image_type', current['image_type'])
+                self._roi = tuple(changes.get('roi', current['roi']))
+                self.change_roi(*self.roi_to_swh(*self._roi, bins), bins, image_type)
+
+        # Report the final state once
+        self.get_config()
+
+    def set_software_binning(self, factor: int, method: str = 'sum'):
+        """Bin the frames by factor before they are published or recorded (1 to disable). The frames recorded so far
+        are handed over as a recording of their own, since the frame format changes.
+        """
 
-    def toggle_streaming_mode(self):
-        if self._camera_state == CMD_CAMERA_MODE_STOP or self._camera_state == CMD_CAMERA_REC_MODE:
-            self.set_continuous_mode()
+        self.split_recording()
+        if factor > 1:
+            self.binning = SoftwareBinning(factor, method)
         else:
-            self.stop_recording()
+            self.binning = None
+        logging.info(f'{self} uses software binning {self.binning}.')
+        self.invalidate_calibration()
+        self.reset_stack()
+        # The peaks were found on the previous grid (the ROI may not move, see move_roi)
+        if self.centroider is not None:
+            self.centroider.reset()
 
-    def toggle_recording_mode(self):
-        if self._camera_state == CMD_CAMERA_MODE_STOP or self._camera_state == CMD_CAMERA_CONTINOUS_MODE:
-            self.set_rec_mode()
-        else:
-            self.stop_recording()
-
-    def toggle_settings(self):
-        if not self.settings_window.isVisible():
-            self.settings_window.show()
-
-    def load_camera_settings(self):
-        self.get_exp_time()
-        self.get_roi()
-
-    def init_subprocess(self):
-        """Overwrite the parent function for initializing the subprocess. """
-
-        return CameraSubprocess(self.uid, self._camera_type, self.com_queue, self.res_queue)
-
-    def crash_cleanup(self):
-        """Handle a crashed subprocess. """
-
-        logging.info(f'subprocess {self.subprocess} crashed. {self} resetting GUI.')
-        # Cleanly stop the subprocess
-        self.subprocess.join()
-        self.subprocess = None
-
-        # Disable the GUI elements
-        self.toggle_controls(False)
-
-    def handle_data(self, data):
-        """Handle data sent back from the camera subprocess. """
-
-        cmd = data[0]
-
-        if cmd == CMD_DISPLAY_IMAGE:
-            self.display_image(data[1])
-        elif cmd == CMD_CAMERA_GET_EXP:
-            self.display_exp_time(data[1])
-        elif cmd == CMD_CAMERA_GET_ROI:
-            self.update_roi(*data[1])
-        elif cmd == CMD_CAMERA_GET_TEMP:
-            self.update_temperature(data[1])
-        elif cmd == CMD_CAMERA_GET_FPS:
-            self.update_fps_dispaly(data[1])
-        elif cmd == CMD_RETURN_REC:
-            pass
-        elif cmd == CMD_STOP_SUBPROCESS:
-            self.crash_cleanup()
-        else:
-            raise NotImplementedError(f'{cmd}')
+    def set_hardware_binning(self, enable: bool):
+        """Let the sensor combine the pixels of a bin, if the camera supports it (otherwise the SDK bins the frames). """
 
-    def display_image(self, image_data):
-        """Display an image. """
+        controls = self.camera.get_controls()
+        if 'HardwareBin' in controls and controls['HardwareBin']['IsWritable']:
+            self.camera.set_control_value(ASI_HARDWARE_BIN, int(enable))
 
-        # Convert image to 8 bit grayscale
-        pil_image = Image.fromarray(image_data, 'L')
-        # Get image size
-        #w, h = pil_image.size
+    def set_centroiding(self, options: dict = None):
+        """Measure the stars in every frame and send their centroids (CMD_CAMERA_CENTROIDS) instead of frames.
 
-        # Get the aspect ratio
-        #(_, roi_w, _, roi_h) = self.settings_window.get_roi_values()
+        While centroiding, preview frames are only sent at CENTROID_PREVIEW_RATE.
 
-        # Get the size of the output
-        output_w = 640
-        output_h = 480 #int(640 * roi_h / roi_w)
-        #print(roi_h, roi_w, output_h)
+        # Arguments
+        * options::dict - Arguments of Centroider (None to stop centroiding).
+        """
 
-        pil_image = pil_image.resize((output_w, output_h))
-        #w, h = pil_image.size
-        #print(w, h)
+        self.send_centroids(force=True)
 
-        # Get byte representation
-        byte_data = pil_image.tobytes("raw", "L")
-        # Generate QImage object
-        qimage = QImage(byte_data, output_w, output_h, QImage.Format_Grayscale8)
-        # Transform it to QPixmap object
-        qpixmap = QPixmap.fromImage(qimage)
-        # Display the image
-        self.image_label.setPixmap(qpixmap)
+        if options is None:
+            self.centroider = None
+            self.display.max_rate = self._preview_rate
+        else:
+            try:
+                self.centroider = Centroider(**options)
+            except (TypeError, ValueError) as e:
+                logging.error(f'{self} cannot measure centroids with {options}: {e}')
+                return
+            self.display.max_rate = min(CENTROID_PREVIEW_RATE, self._preview_rate or CENTROID_PREVIEW_RATE)
+        logging.info(f'{self} uses {self.centroider}.')
 
-    def display_exp_time(self, val):
-        """Display the exposure time in the GUI. """
+    def measure_centroids(self, frame: np.ndarray, info):
+        """Measure the stars in a frame and send the records in batches.
 
-        logging.debug(f'{self} received exposure {val * 1e6} us from {self.subprocess}.')
-        self.settings_window.set_exp_time(val)
+        The positions and FWHMs are converted from pixels of the (binned) frame to unbinned sensor pixels.
+        """
 
-    def update_roi(self, offset_x, roi_width, offset_y, roi_height, sensor_w, sensor_h):
-        """Update the GUI with current ROI values.
-        
-        # Arguments
-        * offset_x::int - Offset from the sensor center in x.
-        * roi_width::int -  Width of the ROI.
-        * offset_y::int - Offset from the sensor center in y.
-        * roi_height::int - Height of the ROI.
-        * sensor_w::int - Width of the camera sensor.
-        * sensor_h::int - Height of the camera sensor.
+        records = self.centroider(frame, info.seq, info.t_ns)
+        if len(records):
+            start_x, start_y = self.camera.get_roi_start_position()
+            bins = self.camera.get_roi_format()[2]
+            total = self.total_binning()
+            # Center of a binned pixel in unbinned sensor pixels
+            records['x'] = start_x * bins + records['x'] * total + (total - 1) / 2
+            records['y'] = start_y * bins + records['y'] * total + (total - 1) / 2
+            records['fwhm'] *= total
+            self._centroids.append(records)
+
+        self.send_centroids()
+
+    def send_centroids(self, force: bool = False):
+        """Send the collected centroids if CENTROID_BATCH_INTERVAL has passed since the last batch (or if forced). """
+
+        if not self._centroids or (not force and time.perf_counter() - self._centroids_sent < CENTROID_BATCH_INTERVAL):
+            return
+
+        self.send((CMD_CAMERA_CENTROIDS, np.concatenate(self._centroids)))
+        self._centroids = []
+        self._centroids_sent = time.perf_counter()
+
+    def set_calibration(self, directory: str = None):
+        """Calibrate every frame with the master frames in directory (None to stop calibrating). The masters in use are
+        sent to the main process (CMD_CAMERA_SET_CALIBRATION) whenever they change.
         """
-        
-        # Log values
-        logging.debug(f'{self} updates ROI to {offset_x}, {roi_width}, {offset_y}, {roi_height}.')
 
+        if directory is None:
+            self.calibration_library = None
+        else:
+            try:
+                self.calibration_library = CalibrationLibrary(directory)
+            except OSError as e:
+                logging.error(f'{self} cannot use the master frames in {directory}: {e}')
+                return
+        logging.info(f'{self} uses {self.calibration_library}.')
 
-        # Update GUI
-        self.settings_window.set_roi_values(offset_x, roi_width, offset_y, roi_height, sensor_w, sensor_h)
+        self.update_calibration()
 
-    def set_temperature(self):
-        """Set the temperature of the camera. """
+    def invalidate_calibration(self):
+        """Look the calibration up again before the next frame (e.g., after the ROI or the exposure time changed). """
 
-        try:
-            temperature = self.settings_window.get_temperature()
-            logging.debug(f'{self} setting temperature to {temperature}.')
-            self.com_queue.put((CMD_CAMERA_SET_TEMP, temperature))
-        except ValueError as e:
-            logging.info(f'{e}')
+        self._calibration_dirty = self.calibration_library is not None
 
-    def update_temperature(self, val):
+    def frame_origin(self) -> tuple:
+        """Top left corner of the frames in unbinned sensor pixels. """
 
-        logging.debug(f'{self} updates camera temperature display to {val}.')
+        start_x, start_y = self.camera.get_roi_start_position()
+        bins = self.camera.get_roi_format()[2]
+        return start_x * bins, start_y * bins
 
-        self.settings_window.update_temperature(val)
-        
+    def update_calibration(self):
+        """Look up the calibration for the current exposure time, temperature and frame format. """
 
-    def get_exp_time(self):
-        """Query the exposure time from the subprocess. """
+        self._calibration_dirty = False
+        if self.calibration_library is None:
+            calibration = None
+        else:
+            shape, dtype = self.frame_format()
+            key = self.calibration_library.make_key(
+                exp_time=self.camera.exp_time,
+                temperature=self.camera.temperature if self.camera.is_cooled else None,
+                origin=self.frame_origin(),
+                shape=shape,
+                binning=self.total_binning(),
+                bit_depth=8 * np.dtype(dtype).itemsize,
+            )
+            calibration = self.calibration_library.calibration(key)
+            if calibration is None:
+                logging.debug(f'{self} has no master frames for {key}.')
+
+        sources = calibration.sources if calibration is not None else None
+        previous = self.calibration.sources if self.calibration is not None else None
+        if sources != previous:
+            # The frames recorded so far were calibrated with the previous masters (or not at all)
+            self.split_recording()
+        self.calibration = calibration
+        if sources != previous:
+            # Only tell the main process when other master files are used (not for crops of the same masters)
+            logging.info(f'{self} uses {calibration}.')
+            self.send((CMD_CAMERA_SET_CALIBRATION, sources))
+            self.reset_stack()
+
+    def set_stacking(self, options: dict = None):
+        """Stack the frames in continuous mode and display the stack instead of the frames (see STACK_PREVIEW_RATE).
+        The stack is kept when continuous mode is stopped, so it can still be saved (see save_stack).
 
-        logging.debug(f'{self} querying exposure time.')
-        self.com_queue.put((CMD_CAMERA_GET_EXP, ))
+        # Arguments
+        * options::dict - Arguments of LiveStacker (None to stop stacking).
+        """
 
-    def set_exp_time(self):
-        """Set the exposure time of the camera. """
+        if options is None:
+            self.stacker = None
+        else:
+            try:
+                self.stacker = LiveStacker(**options)
+            except (TypeError, ValueError) as e:
+                logging.error(f'{self} cannot stack frames with {options}: {e}')
+                return
+        self._next_stack_preview = 0
+        self._stack_rendering = False
+        logging.info(f'{self} uses {self.stacker}.')
 
-        try:
-            exp_time = self.settings_window.get_exp_time()
-            logging.debug(f'{self} setting exposure time to {exp_time * 1e6} us.')
-            self.com_queue.put((CMD_CAMERA_SET_EXP, exp_time))
-        except ValueError as e:
-            logging.info(f'{e}')
-
-    def update_fps_dispaly(self, fps):
-        self.fps_display.setText(f'{fps:.0f} FPS')
-    
-    def set_roi(self):
-        """Set the ROI. 
+    def reset_stack(self):
+        """Start a new stack, e.g., after the ROI moved or the exposure time changed. """
+
+        if self.stacker is not None:
+            self.stacker.reset()
+
+    def save_stack(self, file_name: str = ''):
+        """Save the stack as float32 FITS file and send the file name back (None if nothing was saved).
 
         # Arguments
-        * offset_x::int - Offset from the sensor center in x.
-        * roi_width::int -  Width of the ROI.
-        * offset_y::int - Offset from the sensor center in y.
-        * roi_height::int - Height of the ROI.
+        * file_name::str - Name of the FITS file ('' for a name from the current time and the UID).
         """
-        try:
-            roi = self.settings_window.get_roi_values()
-            #print(roi)
 
-            self.com_queue.put((CMD_CAMERA_SET_ROI, roi))
-        except AssertionError as e:
-            print(e)
+        if self.stacker is None or self.stacker.added == 0:
+            logging.warning(f'{self} has no stack to save.')
+            self.send((CMD_CAMERA_SAVE_STACK, None))
+            return
 
-        self.get_roi()
+        end_time = datetime.utcnow()
+        if file_name == '':
+            file_name = f"{end_time.strftime('%Y-%m-%d_%H:%M:%S')}_{self.uid:x}_stack.fits"
 
-    def get_roi(self):
-        """Get the ROI. """
+        image_data = ImageData(self.stacker.stack(), n_combined=self.stacker.count, **self.frame_header(self._stack_start, end_time))
+        try:
+            image_data.write_fits_to_file(file_name)
+        except OSError as e:
+            logging.error(f'{self} cannot save the stack to {file_name}: {e}')
+            self.send((CMD_CAMERA_SAVE_STACK, None))
+            return
 
-        logging.debug(f'{self} getting ROI')
-        self.com_queue.put((CMD_CAMERA_GET_ROI, ))
+        logging.info(f'{self} saved a stack of {self.stacker.count} frames to {file_name}.')
+        self.send((CMD_CAMERA_SAVE_STACK, file_name))
+
+    def frame_header(self, start_time: datetime = None, end_time: datetime = None) -> dict:
+        """Header entries (arguments of ImageData) of frames taken with the current settings. """
+
+        return {
+            'exp_time': self.camera.exp_time,
+            'start_time': start_time,
+            'end_time': end_time,
+            'bit_depth': self.camera.bit_depth,
+            'binning': self.total_binning(),
+            'temperature': self.camera.temperature if self.camera.is_cooled else None,
+            'origin': self.frame_origin(),
+            'calibrated': self.calibration is not None,
+            'camera': self._camera_type,
+            'sync_id': self.sync_id,
+        }
+
+    def get_image_type(self):
+        """Send the image type and the bit depth of the camera to the main process. """
+
+        data = [CMD_CAMERA_GET_IMAGE_TYPE, (self._image_type, self.camera.bit_depth)]
+        self.send(data)
 
-    def stop_recording(self):
-        logging.info('Stopping all recording')
+    def set_image_type(self, image_type: int):
+        """Set the image type (ASI_IMG_RAW8 or ASI_IMG_RAW16) while keeping the ROI. """
 
-        # Stop camera
-        self._camera_state = CMD_CAMERA_MODE_STOP
-        self._update_state()
+        if image_type not in IMAGE_TYPE_DTYPES:
+            raise ValueError(f'Image type {image_type} not supported.')
 
-        # Reset buttons
-        self.streaming_button.setText('Start Stream')
-        self.recording_button.setText('Start Recording')
+        logging.info(f'{self} set image type to {IMAGE_TYPE_NAMES[image_type]}.')
 
-        # Reset FPS dispaly
-        self.update_fps_dispaly(0)
-        
-    def set_continuous_mode(self):
-
-        logging.info('Starting continuous video streaming')
-
-        # Start streaming
-        self._camera_state = CMD_CAMERA_CONTINOUS_MODE
-        self._update_state()
-
-        # Set buttons
-        self.streaming_button.setText('Stop Stream')
-        self.recording_button.setText('Start Recording')
-
-    def set_rec_mode(self):
-
-        logging.info('Starting recording')
-
-        # Get the height of the ROI
-        roi_h = self.settings_window.height_input.value()
-        # Show a warning when it is too large
-        if roi_h > 128 and self._warn_large_roi:
-            logging.info('Large ROI height. Showing warning dialog')
-            dialog_window = RoiWarningDialog(roi_h)
-            answer = dialog_window.exec()
-            dismiss = dialog_window.dismiss_state()
-            self._warn_large_roi = not dismiss
-            logging.debug(f'Dialog window continue: {answer}. Checkbox state {dismiss}.')
-            
-            if not answer:
-                logging.info('Aborting recording')
-                
-                return
+        width, height, bins, _ = self.camera.get_roi_format()
+        start_x, start_y = self.camera.get_roi_start_position()
 
-            logging.info('Continuing')
+        # The frame rate changes, so the timing of the following frames is reported separately
+        self.end_session()
+        self.restart_capture(start_x, start_y, width, height, bins, image_type)
 
-        # Start recording
-        self._camera_state = CMD_CAMERA_REC_MODE
-        self._update_state()
+        self.get_image_type()
 
-        # Set buttons
-        self.streaming_button.setText('Start Stream')
-        self.recording_button.setText('Stop Recording')
+    def get_sensor_size(self):
+        return (self._sensor_w, self._sensor_h)
+
+    def update_gui(self, update_rate):
+        """Get the state of the camera and update the GUI every few seconds. """
+
+        if time.time() - self._update_timer > update_rate:
+            self.get_temperature()
+            if self.camera.is_cooled:
+                # The sensor temperature may have drifted to the one of other master frames
+                self.invalidate_calibration()
+            self.report_display_skipped()
+            self._update_timer = time.time()
 
+    def report_display_skipped(self):
+        """Tell the main process how many frames were not displayed because a newer frame was available. """
 
-    def _update_state(self):
-        self.com_queue.put((self._camera_state, ))
+        if self.display.skipped != self._reported_skipped:
+            self._reported_skipped = self.display.skipped
+            self.send((CMD_CAMERA_DISPLAY_SKIPPED, (self.display.shown, self.display.skipped)))
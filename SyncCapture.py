@@ -0,0 +1,322 @@
+from ImageData import load_fits
+from Centroiding import CENTROID_DTYPE
+from datetime import datetime
+from astropy.io import fits
+import numpy as np
+import logging
+import time
+import glob
+import os
+
+
+# Time between sending the synchronized start to the cameras and the common start time, so every camera has handled
+# the command and started its capture before (in s)
+SYNC_START_DELAY = 0.5
+
+# Frames whose timestamp deviates from the fit of the timestamps against the sequence numbers by more than
+# TIMING_CLIP robust standard deviations keep their timestamp (e.g., after a stall of the camera)
+TIMING_CLIP = 5.0
+
+# Per-frame times of a recording (see frame_times): file and frame index, sequence number, timestamp of the readout and
+# mid-exposure time (time.perf_counter_ns)
+FRAME_TIME_DTYPE = np.dtype([
+    ('file', np.int32),
+    ('frame', np.int32),
+    ('seq', np.int64),
+    ('t_ns', np.int64),
+    ('t_mid_ns', np.int64),
+])
+
+
+class SyncCapture:
+    """Start and stop recordings of several cameras together.
+
+    All subprocesses time their frames with the same monotonic clock (time.perf_counter_ns). A synchronized recording
+    starts on all cameras with the first frame read out after a common start time, and the recordings are tagged with
+    the session (SYNCID), so their frames can be matched offline (see build_sync_index).
+    """
+
+    def __init__(self, *interfaces):
+        """Constructor.
+
+        # Arguments
+        * interfaces::CameraInterface - Interfaces of the cameras (with set_sync_rec_mode and stop_recording).
+        """
+
+        self.interfaces = list(interfaces)
+
+        # Session and common start time of the running recording (None if not recording)
+        self.sync_id = None
+        self.start_ns = None
+
+    def start(self, delay: float = SYNC_START_DELAY) -> str:
+        """Start recording on all cameras delay seconds from now and return the session. """
+
+        if self.sync_id is not None:
+            self.stop()
+
+        self.sync_id = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S.%f')
+        self.start_ns = time.perf_counter_ns() + int(delay * 1e9)
+        for interface in self.interfaces:
+            interface.set_sync_rec_mode(self.start_ns, self.sync_id)
+        logging.info(f'{self} starts session {self.sync_id}.')
+
+        return self.sync_id
+
+    def stop(self):
+        """Stop recording on all cameras (unfinished recordings are dropped). """
+
+        for interface in self.interfaces:
+            interface.stop_recording()
+        logging.info(f'{self} stopped session {self.sync_id}.')
+        self.sync_id = None
+        self.start_ns = None
+
+    def __repr__(self) -> str:
+        return f'SyncCapture({", ".join(f"{interface.uid:#x}" for interface in self.interfaces)})'
+
+
+def regularize_timestamps(seq: np.ndarray, t_ns: np.ndarray, clip: float = TIMING_CLIP) -> np.ndarray:
+    """Replace the timestamps by a linear fit against the sequence numbers.
+
+    The timestamps are taken when the host receives a frame, so they scatter with the USB transfer and the scheduling
+    of the threads, while the camera exposes at a fixed period. Outliers (see TIMING_CLIP) keep their timestamps.
+    """
+
+    if len(seq) < 3:
+        return t_ns.copy()
+
+    x = (seq - seq[0]).astype(np.float64)
+    y = (t_ns - t_ns[0]).astype(np.float64)
+    inliers = np.ones(len(x), dtype=bool)
+    for _ in range(3):
+        slope, offset = np.polyfit(x[inliers], y[inliers], 1)
+        residuals = y - (slope * x + offset)
+        scale = 1.4826 * np.median(np.abs(residuals[inliers]))
+        if scale == 0:
+            break
+        inliers = np.abs(residuals) <= clip * scale
+
+    fit = t_ns[0] + np.rint(slope * x + offset).astype(np.int64)
+    return np.where(inliers, fit, t_ns)
+
+
+def frame_times(file_names: list, readout_delay: float = 0.0, regularize: bool = True) -> np.ndarray:
+    """Mid-exposure times of the frames of recordings (see FRAME_TIME_DTYPE), ordered by sequence number.
+
+    # Arguments
+    * file_names::list - Recordings of one camera.
+    * readout_delay::float - Time from the end of an exposure until the frame was read out (in s).
+    * regularize::bool - Whether the timestamps are replaced by a fit per recording (see regularize_timestamps).
+    """
+
+    times = []
+    for i, file_name in enumerate(file_names):
+        with load_fits(file_name) as rec:
+            exp_time = rec.header['EXP_TIME']
+            meta = rec.metadata
+        if meta is None:
+            raise ValueError(f'{file_name} has no per-frame timestamps.')
+
+        order = np.argsort(meta['SEQ'], kind='stable')
+        record = np.empty(len(order), dtype=FRAME_TIME_DTYPE)
+        record['file'] = i
+        record['frame'] = order
+        record['seq'] = meta['SEQ'][order]
+        record['t_ns'] = meta['T_NS'][order]
+        t_ns = regularize_timestamps(record['seq'], record['t_ns']) if regularize else record['t_ns']
+        record['t_mid_ns'] = t_ns - int((readout_delay + exp_time / 2) * 1e9)
+        times.append(record)
+
+    times = np.concatenate(times) if times else np.empty(0, dtype=FRAME_TIME_DTYPE)
+    return times[np.argsort(times['seq'], kind='stable')]
+
+
+def match_frames(t_ref: np.ndarray, t_other: np.ndarray, tolerance: int) -> tuple:
+    """Match every reference frame to the frame of another camera closest in time.
+
+    Every frame is matched at most once (to the closest reference frame), and only within tolerance.
+
+    # Arguments
+    * t_ref::np.ndarray - Times of the reference frames (in ns).
+    * t_other::np.ndarray - Times of the frames of the other camera (in ns).
+    * tolerance::int - Largest time difference of a match (in ns).
+
+    # Returns
+    * i_ref::np.ndarray - Indices of the matched reference frames (ascending).
+    * i_other::np.ndarray - Indices of the matching frames of the other camera.
+    """
+
+    if not len(t_ref) or not len(t_other):
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    order = np.argsort(t_other, kind='stable')
+    sorted_other = t_other[order]
+    right = np.clip(np.searchsorted(sorted_other, t_ref), 0, len(order) - 1)
+    left = np.maximum(right - 1, 0)
+    use_left = np.abs(sorted_other[left] - t_ref) < np.abs(sorted_other[right] - t_ref)
+    nearest = np.where(use_left, left, right)
+    dt = np.abs(sorted_other[nearest] - t_ref)
+
+    i_ref = np.flatnonzero(dt <= tolerance)
+    nearest, dt = nearest[i_ref], dt[i_ref]
+    # Keep the closest reference frame of frames matched several times
+    closest = np.lexsort((dt, nearest))
+    first = np.ones(len(closest), dtype=bool)
+    first[1:] = nearest[closest][1:] != nearest[closest][:-1]
+    keep = np.sort(closest[first])
+
+    return i_ref[keep], order[nearest[keep]]
+
+
+def find_session(directory: str, sync_id: str) -> dict:
+    """Find the recordings of a synchronized session in directory. Returns the file names by camera. """
+
+    recordings = {}
+    for file_name in sorted(glob.glob(os.path.join(directory, '*.fits'))):
+        header = fits.getheader(file_name)
+        if header.get('SYNCID') == sync_id:
+            recordings.setdefault(header.get('INSTRUME', ''), []).append(file_name)
+
+    return recordings
+
+
+def build_sync_index(recordings: dict, out_file: str, reference: str = None, tolerance: float = None,
+                     readout_delay: dict = None, sync_id: str = None) -> np.ndarray:
+    """Match the frames of the recordings of several cameras and write them to a joint recording index.
+
+    Every row of the index (binary table MATCHES) is a frame of the reference camera together with the closest frame of
+    every other camera: the mid-exposure time T_NS of the reference frame and for every camera i the index of its file
+    (FILE<i>, see table FILES), the frame in the file (FRAME<i>), its sequence number (SEQ<i>) and its time relative to
+    the reference frame (DT<i>, in ns). Reference frames without a match in every camera are left out. The camera
+    models are stored as CAMERA<i> in the primary header.
+
+    # Arguments
+    * recordings::dict - File names of the recordings by camera (e.g., from find_session).
+    * out_file::str - File name of the index.
+    * reference::str - Camera whose frames are matched (the one with the fewest frames if None, e.g., the science
+                       camera with the longest exposures).
+    * tolerance::float - Largest time difference of a match (in s, half the median frame period of the other camera
+                         if None).
+    * readout_delay::dict - Time from the end of an exposure until the readout by camera (in s, see frame_times).
+    * sync_id::str - Session written to the header.
+
+    # Returns
+    * matches::np.ndarray - Rows of the index.
+    """
+
+    readout_delay = readout_delay or {}
+    cameras = list(recordings)
+    times = [frame_times(recordings[camera], readout_delay.get(camera, 0.0)) for camera in cameras]
+    if reference is None:
+        reference = cameras[int(np.argmin([len(t) for t in times]))]
+    # The reference camera comes first
+    i_reference = cameras.index(reference)
+    cameras.insert(0, cameras.pop(i_reference))
+    times.insert(0, times.pop(i_reference))
+
+    t_ref = times[0]['t_mid_ns']
+    rows = np.arange(len(t_ref))
+    others = []
+    for camera, t in zip(cameras[1:], times[1:]):
+        if tolerance is None:
+            limit = np.median(np.diff(t['t_mid_ns'])) / 2 if len(t) > 1 else 0
+        else:
+            limit = tolerance * 1e9
+        i_ref, i_other = match_frames(t_ref, t['t_mid_ns'], int(limit))
+        others.append(dict(zip(i_ref, i_other)))
+        rows = np.intersect1d(rows, i_ref)
+        logging.info(f'Matched {len(i_ref)} of {len(t_ref)} frames of {reference} with {camera} within {limit * 1e-6:.2f} ms.')
+
+    # Files of all cameras in one table
+    files = [(i, file_name) for i, camera in enumerate(cameras) for file_name in recordings[camera]]
+    file_offsets = np.cumsum([0] + [len(recordings[camera]) for camera in cameras])
+
+    dtype = [('T_NS', np.int64)]
+    for i in range(len(cameras)):
+        dtype += [(f'FILE{i}', np.int32), (f'FRAME{i}', np.int32), (f'SEQ{i}', np.int64), (f'DT{i}', np.int64)]
+    matches = np.zeros(len(rows), dtype=dtype)
+    matches['T_NS'] = t_ref[rows]
+    for i, t in enumerate(times):
+        index = rows if i == 0 else np.array([others[i - 1][row] for row in rows], dtype=np.intp)
+        matched = t[index]
+        matches[f'FILE{i}'] = matched['file'] + file_offsets[i]
+        matches[f'FRAME{i}'] = matched['frame']
+        matches[f'SEQ{i}'] = matched['seq']
+        matches[f'DT{i}'] = matched['t_mid_ns'] - matches['T_NS']
+
+    header = fits.Header()
+    header['SYNCID'] = sync_id
+    header['NCAMERA'] = len(cameras)
+    for i, camera in enumerate(cameras):
+        header[f'CAMERA{i}'] = camera
+    file_table = fits.BinTableHDU.from_columns([
+        fits.Column(name='CAMERA', format='J', array=np.array([camera for camera, _ in files], dtype=np.int32)),
+        fits.Column(name='FILE', format=f'{max([len(name) for _, name in files] + [1])}A', array=np.array([name for _, name in files])),
+    ], name='FILES')
+    fits.HDUList([fits.PrimaryHDU(header=header), file_table, fits.BinTableHDU(matches, name='MATCHES')]).writeto(out_file, overwrite=True)
+    logging.info(f'Wrote {len(matches)} matched frames of {len(cameras)} cameras to {out_file}.')
+
+    return matches
+
+
+def load_sync_index(file_name: str) -> tuple:
+    """Read a joint recording index written by build_sync_index.
+
+    # Returns
+    * cameras::list - Camera models (camera i of the columns).
+    * files::list - File names (indexed by FILE<i>).
+    * matches::np.ndarray - Rows of the index.
+    """
+
+    with fits.open(file_name) as hdul:
+        header = hdul[0].header
+        cameras = [header[f'CAMERA{i}'] for i in range(header['NCAMERA'])]
+        files = [str(name) for name in hdul['FILES'].data['FILE']]
+        matches = np.array(hdul['MATCHES'].data)
+
+    return cameras, files, matches
+
+
+def match_centroids(matches: np.ndarray, records: np.ndarray, camera: int = 1) -> tuple:
+    """Assign star centroids measured on the frames of a camera (e.g., the star camera) to the rows of an index.
+
+    # Arguments
+    * matches::np.ndarray - Rows of a joint recording index (see build_sync_index).
+    * records::np.ndarray - Centroid records (see Centroiding.CENTROID_DTYPE) of camera.
+    * camera::int - Camera of the records in the index.
+
+    # Returns
+    * rows::np.ndarray - Row of the index of every record (ascending).
+    * records::np.ndarray - Records of the frames in the index.
+    """
+
+    records = np.asarray(records, dtype=CENTROID_DTYPE)
+    records = records[np.argsort(records['seq'], kind='stable')]
+    seq = matches[f'SEQ{camera}']
+    start = np.searchsorted(records['seq'], seq, side='left')
+    counts = np.searchsorted(records['seq'], seq, side='right') - start
+
+    rows = np.repeat(np.arange(len(matches)), counts)
+    index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+
+    return rows, records[index]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Match the frames of the recordings of a synchronized session.')
+    parser.add_argument('directory', help='Directory of the recordings')
+    parser.add_argument('sync_id', help='Session (SYNCID of the recordings)')
+    parser.add_argument('--reference', help='Camera whose frames are matched')
+    parser.add_argument('--tolerance', type=float, help='Largest time difference of a match (in s)')
+    parser.add_argument('--out', help='File name of the index')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    recordings = find_session(args.directory, args.sync_id)
+    if not recordings:
+        parser.error(f'No recordings of session {args.sync_id} in {args.directory}.')
+    out_file = args.out or os.path.join(args.directory, f'{args.sync_id}_sync.fits')
+    build_sync_index(recordings, out_file, args.reference, args.tolerance, sync_id=args.sync_id)
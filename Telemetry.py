@@ -0,0 +1,304 @@
+from collections import deque
+from threading import Lock
+from bisect import bisect_right
+import numpy as np
+import logging
+import time
+import json
+import csv
+import os
+
+
+# Edges of the latency histograms (in s): 10 bins per decade from 1 us to 10 s
+_LATENCY_EDGES = [10 ** (e / 10) for e in range(-60, 11)]
+
+
+class RateMeter:
+    """Rate of events (e.g., frames per second) over a sliding time window. """
+
+    def __init__(self, window: float = 2.0):
+        self.window_ns = int(window * 1e9)
+        self.count = 0
+        self._events = deque()
+
+    def add(self, t_ns: int = None):
+        """Count an event (at time.perf_counter_ns() if no time is given). """
+
+        if t_ns is None:
+            t_ns = time.perf_counter_ns()
+        self._events.append(t_ns)
+        self.count += 1
+        self._prune(t_ns)
+
+    def _prune(self, now_ns: int):
+        while self._events and now_ns - self._events[0] > self.window_ns:
+            self._events.popleft()
+
+    def rate(self) -> float:
+        """Events per second in the window. """
+
+        self._prune(time.perf_counter_ns())
+        if len(self._events) < 2:
+            return 0.0
+        return (len(self._events) - 1) / ((self._events[-1] - self._events[0]) * 1e-9)
+
+    def snapshot(self) -> dict:
+        return {'rate': self.rate(), 'count': self.count}
+
+
+class LatencyHistogram:
+    """Histogram of latencies with logarithmic bins (1 us to 10 s). """
+
+    def __init__(self):
+        self.counts = [0] * (len(_LATENCY_EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, latency: float):
+        """Add a latency (in s). """
+
+        self.counts[bisect_right(_LATENCY_EDGES, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.min = latency if self.min is None else min(self.min, latency)
+        self.max = latency if self.max is None else max(self.max, latency)
+
+    def add_many(self, latencies: np.ndarray):
+        """Add an array of latencies (in s). """
+
+        latencies = np.asarray(latencies, dtype=np.float64).ravel()
+        if len(latencies) == 0:
+            return
+
+        for i, n in zip(*np.unique(np.searchsorted(_LATENCY_EDGES, latencies, side='right'), return_counts=True)):
+            self.counts[i] += int(n)
+        self.count += len(latencies)
+        self.total += float(latencies.sum())
+        self.min = float(latencies.min()) if self.min is None else min(self.min, float(latencies.min()))
+        self.max = float(latencies.max()) if self.max is None else max(self.max, float(latencies.max()))
+
+    def percentile(self, q: float) -> float:
+        """Upper edge of the bin containing the q-th percentile (in s). """
+
+        if self.count == 0:
+            return None
+        target = q / 100 * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= target and n:
+                return _LATENCY_EDGES[i] if i < len(_LATENCY_EDGES) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        snapshot = {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+        # Only the occupied bins, keyed by their upper edge
+        snapshot['bins'] = {f'{_LATENCY_EDGES[i] if i < len(_LATENCY_EDGES) else float("inf"):.3g}': n for i, n in enumerate(self.counts) if n}
+        return snapshot
+
+
+class Gauge:
+    """Sampled value (e.g., a queue depth). """
+
+    def __init__(self):
+        self.last = None
+        self.max = None
+        self.count = 0
+        self.total = 0.0
+
+    def set(self, value: float):
+        self.last = value
+        self.max = value if self.max is None else max(self.max, value)
+        self.count += 1
+        self.total += value
+
+    def snapshot(self) -> dict:
+        return {'last': self.last, 'max': self.max, 'mean': self.total / self.count if self.count else None}
+
+
+class StageTimer:
+    """Wall and CPU time spent in a stage of the pipeline (CPU time of the thread running the stage). """
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_ns = 0
+        self.cpu_ns = 0
+        self._started = time.perf_counter_ns()
+
+    def add(self, wall_ns: int, cpu_ns: int):
+        self.calls += 1
+        self.wall_ns += wall_ns
+        self.cpu_ns += cpu_ns
+
+    def snapshot(self) -> dict:
+        elapsed = (time.perf_counter_ns() - self._started) * 1e-9
+        return {
+            'calls': self.calls,
+            'wall': self.wall_ns * 1e-9,
+            'cpu': self.cpu_ns * 1e-9,
+            'cpu_per_call': self.cpu_ns * 1e-9 / self.calls if self.calls else None,
+            # Fraction of a core used by the stage
+            'load': self.cpu_ns * 1e-9 / elapsed if elapsed else None,
+        }
+
+
+class _Stage:
+    """Context manager measuring a stage. """
+
+    def __init__(self, timer: StageTimer, lock: Lock):
+        self._timer = timer
+        self._lock = lock
+
+    def __enter__(self):
+        self._wall = time.perf_counter_ns()
+        self._cpu = time.thread_time_ns()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.perf_counter_ns() - self._wall
+        cpu = time.thread_time_ns() - self._cpu
+        with self._lock:
+            self._timer.add(wall, cpu)
+
+
+class Telemetry:
+    """Registry of the metrics of a process.
+
+    Metrics are created on first use by name:
+
+        telemetry.count('capture')
+        telemetry.latency('capture_to_display', dt)
+        telemetry.gauge('ring_occupancy', n)
+        with telemetry.stage('capture'):
+            ...
+
+    Updates and snapshots may come from different threads.
+    """
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self._lock = Lock()
+        self._metrics = {'rate': {}, 'latency': {}, 'gauge': {}, 'stage': {}}
+
+    def _get(self, kind: str, name: str, factory):
+        metrics = self._metrics[kind]
+        metric = metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = metrics.setdefault(name, factory())
+        return metric
+
+    def count(self, name: str, t_ns: int = None):
+        """Count an event for the windowed rate name. """
+
+        meter = self._get('rate', name, RateMeter)
+        with self._lock:
+            meter.add(t_ns)
+
+    def rate(self, name: str) -> float:
+        """Get the windowed rate name (events per second). """
+
+        meter = self._get('rate', name, RateMeter)
+        with self._lock:
+            return meter.rate()
+
+    def latency(self, name: str, latency: float):
+        """Add a latency (in s) to the histogram name. An array adds several latencies at once. """
+
+        histogram = self._get('latency', name, LatencyHistogram)
+        with self._lock:
+            if np.ndim(latency):
+                histogram.add_many(latency)
+            else:
+                histogram.add(latency)
+
+    def gauge(self, name: str, value: float):
+        """Sample the gauge name. """
+
+        gauge = self._get('gauge', name, Gauge)
+        with self._lock:
+            gauge.set(value)
+
+    def stage(self, name: str) -> _Stage:
+        """Context manager measuring the wall and CPU time of the stage name. """
+
+        return _Stage(self._get('stage', name, StageTimer), self._lock)
+
+    def reset(self):
+        """Remove all metrics. """
+
+        with self._lock:
+            self._metrics = {kind: {} for kind in self._metrics}
+
+    def snapshot(self) -> dict:
+        """Get the current values of all metrics. """
+
+        with self._lock:
+            snapshot = {kind: {name: metric.snapshot() for name, metric in metrics.items()} for kind, metrics in self._metrics.items()}
+        snapshot['name'] = self.name
+        snapshot['time'] = time.time()
+        return snapshot
+
+    def __repr__(self) -> str:
+        return f'Telemetry({self.name})'
+
+
+# Telemetry of the current process (see get_telemetry)
+_telemetry = None
+_telemetry_pid = None
+
+
+def get_telemetry(name: str = None) -> Telemetry:
+    """Get the telemetry of the current process. A subprocess gets its own (empty) telemetry, even if it was forked. """
+
+    global _telemetry, _telemetry_pid
+
+    if _telemetry is None or _telemetry_pid != os.getpid():
+        _telemetry = Telemetry(name if name is not None else str(os.getpid()))
+        _telemetry_pid = os.getpid()
+    elif name is not None:
+        _telemetry.name = name
+
+    return _telemetry
+
+
+def flatten_snapshot(snapshot: dict, prefix: str = '') -> list:
+    """Flatten a (nested) snapshot into rows (metric, value), e.g., ('camera.latency.capture_to_display.p99', 0.01). """
+
+    rows = []
+    for key, value in snapshot.items():
+        name = f'{prefix}.{key}' if prefix else str(key)
+        if isinstance(value, dict):
+            rows += flatten_snapshot(value, name)
+        else:
+            rows.append((name, value))
+
+    return rows
+
+
+def export_json(snapshot: dict, file_name: str):
+    """Save a snapshot as JSON. """
+
+    with open(file_name, 'w') as f:
+        json.dump(snapshot, f, indent=2, default=float)
+    logging.info(f'Saved telemetry to {file_name}')
+
+
+def export_csv(snapshot: dict, file_name: str):
+    """Save a snapshot as CSV with the columns metric and value. """
+
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('metric', 'value'))
+        writer.writerows(flatten_snapshot(snapshot))
+    logging.info(f'Saved telemetry to {file_name}')
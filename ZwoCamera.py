@@ -0,0 +1,379 @@
+from sys import platform
+from ctypes import POINTER, c_char
+from collections import namedtuple, Counter
+import numpy as np
+import logging
+import time
+
+try:
+    import zwoasi
+    from zwoasi import init, Camera, ZWO_Error, ZWO_IOError
+    from zwoasi import ASI_GAIN, ASI_EXPOSURE, ASI_BANDWIDTHOVERLOAD, ASI_TEMPERATURE, ASI_HARDWARE_BIN, ASI_HIGH_SPEED_MODE
+    from zwoasi import ASI_COOLER_POWER_PERC, ASI_TARGET_TEMP, ASI_COOLER_ON, ASI_FAN_ON, ASI_IMG_RAW8, ASI_IMG_RAW16
+except ImportError:
+    # zwoasi is only needed for real hardware. Without it, only the simulated backend (SimulatedCamera) can be used,
+    # so mirror the SDK definitions it relies on (see ASICamera2.h).
+    zwoasi = None
+    init = None
+    Camera = object
+
+    class ZWO_Error(Exception):
+        def __init__(self, message, error_code=None):
+            super(ZWO_Error, self).__init__(message)
+            self.error_code = error_code
+
+    class ZWO_IOError(ZWO_Error):
+        pass
+
+    ASI_GAIN = 0
+    ASI_EXPOSURE = 1
+    ASI_BANDWIDTHOVERLOAD = 6
+    ASI_TEMPERATURE = 8
+    ASI_HARDWARE_BIN = 13
+    ASI_HIGH_SPEED_MODE = 14
+    ASI_COOLER_POWER_PERC = 15
+    ASI_TARGET_TEMP = 16
+    ASI_COOLER_ON = 17
+    ASI_FAN_ON = 19
+
+    ASI_IMG_RAW8 = 0
+    ASI_IMG_RAW16 = 2
+
+
+# Sequence number (counting from 1), time when it was read out (time.perf_counter_ns) and number of frames dropped by
+# the SDK since the video mode was started for every captured frame
+FrameInfo = namedtuple('FrameInfo', ['seq', 't_ns', 'dropped'])
+
+# Error code of the SDK when a frame did not arrive in time
+ASI_ERROR_TIMEOUT = 11
+
+# Data type of the pixels for each image type
+IMAGE_TYPE_DTYPES = {ASI_IMG_RAW8: np.dtype(np.uint8), ASI_IMG_RAW16: np.dtype(np.uint16)}
+
+# Time for which control values read from the camera are reused (in s)
+CONTROL_CACHE_TTL = 0.5
+
+
+class ZwoCameraBase:
+    """Extension of the zwoasi.Camera interface.
+
+    Shared by the hardware camera (ZwoCamera) and the simulated camera (SimulatedZwoCamera). Child classes have to
+    inherit from this class first and from a class providing the zwoasi.Camera interface second, and have to provide
+    _read_video_data(out, timeout) for reading a frame into the memory of an array.
+
+    Every call into the SDK goes over USB, so the camera properties and the ranges of the controls are read once when
+    the camera is opened. The ROI is cached until it is set again, and control values are reused for control_ttl
+    seconds and updated when a control is set. The SDK calls made are counted by function in sdk_calls.
+    """
+
+    def __init__(self, camera_name: str, *args, **kwargs):
+        # Number of SDK calls by function
+        self.sdk_calls = Counter()
+        # Cached properties, controls and ROI (None if not read yet) and control values with the time they were read
+        self._properties = None
+        self._control_info = None
+        self._control_types = {}
+        self._roi_format = None
+        self._roi_start = None
+        self._control_values = {}
+        self.control_ttl = CONTROL_CACHE_TTL
+
+        # Initialize the camera
+        super(ZwoCameraBase, self).__init__(camera_name, *args, **kwargs)
+
+        # Read the static information once
+        self.get_camera_property()
+        self.get_controls()
+
+        self._exp_time = None
+        self._highspeed = False
+
+        # Shape and data type of the frames in the current ROI format
+        self.frame_shape = None
+        self.frame_dtype = None
+        self._update_frame_format()
+
+        # Timeout for reading video frames (in ms)
+        self._video_timeout = self.get_control_value(ASI_EXPOSURE)[0] * 2e-3 + 500
+
+        # Frames read into pre-allocated buffers and frames for which a new buffer had to be allocated
+        self.frames_captured = 0
+        self.frames_allocated = 0
+
+        # FrameInfo of the last captured frame
+        self.last_frame = None
+
+    @property
+    def exp_time(self) -> float:
+        """Get the exposure time (in seconds). """
+
+        self._exp_time = self.get_control_value(ASI_EXPOSURE)[0] * 1e-6
+        logging.debug(f'{self} read out exposure time of {self._exp_time * 1e6} us')
+        return self._exp_time
+
+    @exp_time.setter
+    def exp_time(self, exp_time: float):
+        """Set the exposuer time (in seconds). """
+
+        # Calculate the exposure time in us
+        exp_time_us = int(exp_time * 1e6)
+        # Set the exposure time
+        logging.debug(f'{self} set exposure time to {exp_time_us} us')
+        self.set_control_value(ASI_EXPOSURE, exp_time_us)
+        # Wait at most twice the exposure time (plus the readout) for a frame
+        self._video_timeout = exp_time_us * 2e-3 + 500
+
+    @property
+    def highspeed(self) -> bool:
+        """Get whether highspeed mode is enabled. """
+
+        self._highspeed = bool(self.get_control_value(ASI_HIGH_SPEED_MODE)[0])
+        return self._highspeed
+
+    @highspeed.setter
+    def highspeed(self, highspeed: bool):
+        """Enable/disable highspeed mode. """
+
+        self.set_control_value(ASI_HIGH_SPEED_MODE, bool(highspeed))
+
+    @property
+    def n_sdk_calls(self) -> int:
+        """Total number of SDK calls. """
+
+        return sum(self.sdk_calls.values())
+
+    def _sdk(self, function: str, *args):
+        """Call the SDK function of the parent class and count the call. """
+
+        self.sdk_calls[function] += 1
+        return getattr(super(ZwoCameraBase, self), function)(*args)
+
+    def get_camera_property(self) -> dict:
+        """Get the properties of the camera (read once). """
+
+        if self._properties is None:
+            self._properties = self._sdk('get_camera_property')
+        return self._properties
+
+    def get_controls(self) -> dict:
+        """Get the available controls and their ranges (read once). """
+
+        if self._control_info is None:
+            self._control_info = self._sdk('get_controls')
+            # Index the controls by their type
+            self._control_types = {c['ControlType']: c for c in self._control_info.values()}
+        return self._control_info
+
+    def get_control_value(self, control_type: int, max_age: float = None) -> tuple:
+        """Get the value of a control and whether it is set automatically.
+
+        # Arguments
+        * control_type::int - Control (e.g., ASI_EXPOSURE).
+        * max_age::float - Maximum age (in s) of a cached value (default: control_ttl, 0 to always read the camera).
+        """
+
+        if max_age is None:
+            max_age = self.control_ttl
+
+        cached = self._control_values.get(control_type)
+        if cached is not None and time.perf_counter() - cached[2] <= max_age:
+            return cached[0], cached[1]
+
+        value, auto = self._sdk('get_control_value', control_type)[:2]
+        self._control_values[control_type] = (value, auto, time.perf_counter())
+        return value, auto
+
+    def set_control_value(self, control_type: int, value, auto=False):
+        """Set the value of a control and cache it (clipped to the range of the control). """
+
+        self._sdk('set_control_value', control_type, value, auto)
+
+        control = self._control_types.get(control_type)
+        if control is not None:
+            value = min(max(int(value), control['MinValue']), control['MaxValue'])
+        self._control_values[control_type] = (int(value), auto, time.perf_counter())
+
+    def get_roi_format(self) -> tuple:
+        """Get width, height, bins and image type of the ROI (cached until it is set). """
+
+        if self._roi_format is None:
+            self._roi_format = tuple(self._sdk('get_roi_format'))
+        return self._roi_format
+
+    def set_roi_format(self, width: int, height: int, bins: int, image_type: int):
+        """Set width, height, bins and image type of the ROI. """
+
+        # The camera may adjust the format and moves the start position, so both are read again when needed
+        self._roi_format = None
+        self._roi_start = None
+        self._sdk('set_roi_format', width, height, bins, image_type)
+
+    def get_roi_start_position(self) -> tuple:
+        """Get the start position of the ROI (cached until it is set). """
+
+        if self._roi_start is None:
+            self._roi_start = tuple(self._sdk('get_roi_start_position'))
+        return self._roi_start
+
+    def set_roi_start_position(self, start_x: int, start_y: int):
+        """Set the start position of the ROI. """
+
+        self._roi_start = None
+        self._sdk('set_roi_start_position', start_x, start_y)
+        self._roi_start = (start_x, start_y)
+
+    def get_dropped_frames(self) -> int:
+        """Get the number of frames dropped since the video mode was started. """
+
+        return self._sdk('get_dropped_frames')
+
+    def start_video_capture(self):
+        self._sdk('start_video_capture')
+
+    def stop_video_capture(self):
+        self._sdk('stop_video_capture')
+
+    def set_roi(self, start_x=None, start_y=None, width=None, height=None, bins=None, image_type=None):
+        """Extend setting the ROI by updating the frame format. """
+
+        super(ZwoCameraBase, self).set_roi(start_x, start_y, width, height, bins, image_type)
+        self._update_frame_format()
+
+    def _update_frame_format(self):
+        """Read out shape and data type of the frames in the current ROI format. """
+
+        width, height, _, image_type = self.get_roi_format()
+        self.frame_shape = (height, width)
+        self.frame_dtype = IMAGE_TYPE_DTYPES.get(image_type, np.dtype(np.uint8))
+
+    def capture_video_frame(self, *args, **kwargs):
+        """Extend capturing a video frame into a newly allocated array by counting the allocations. """
+
+        self.frames_allocated += 1
+        self.sdk_calls['get_video_data'] += 1
+        frame = super(ZwoCameraBase, self).capture_video_frame(*args, **kwargs)
+        self._tag_frame()
+        return frame
+
+    def _tag_frame(self):
+        """Record the FrameInfo of a frame which was just read out. """
+
+        t_ns = time.perf_counter_ns()
+        seq = self.frames_captured + self.frames_allocated
+        self.last_frame = FrameInfo(seq, t_ns, self.get_dropped_frames())
+
+    def capture_video_frame_into(self, out: np.ndarray, timeout=None) -> np.ndarray:
+        """Read the next video frame directly into a pre-allocated array.
+
+        Unlike capture_video_frame and get_video_data no buffer is allocated and the data is not copied.
+
+        # Arguments
+        * out::np.ndarray - C-contiguous array with the shape and data type of the current ROI format, e.g., a slot
+                            of the frame ring or a frame of a pre-allocated cube.
+        * timeout::int - Timeout in ms (default: twice the exposure time plus 500 ms).
+
+        # Returns
+        * out::np.ndarray - The filled array. Its FrameInfo is available as last_frame.
+        """
+
+        if out.shape != self.frame_shape or out.dtype != self.frame_dtype:
+            raise ValueError(f'Buffer of shape {out.shape} ({out.dtype}) does not match the ROI format {self.frame_shape} ({self.frame_dtype}).')
+        if not out.flags.c_contiguous or not out.flags.writeable:
+            raise ValueError('Buffer must be C-contiguous and writeable.')
+
+        if timeout is None:
+            timeout = self._video_timeout
+
+        self.sdk_calls['get_video_data'] += 1
+        self._read_video_data(out, int(timeout))
+
+        self.frames_captured += 1
+        self._tag_frame()
+        return out
+
+    @property
+    def bit_depth(self) -> int:
+        """Number of bits of the ADC. RAW16 frames contain them in the highest bits. """
+
+        return self.get_camera_property()['BitDepth']
+
+    @property
+    def is_cooled(self) -> bool:
+        """Whether the camera has a cooler (from the cached properties). """
+
+        return self.get_camera_property()['IsCoolerCam']
+
+    def enable_cooler(self):
+        if self.is_cooled:
+            self.set_control_value(ASI_COOLER_ON, 1)
+            self.set_control_value(ASI_FAN_ON, 1)
+            logging.debug(f'{self}: Enabeling cooler')
+        else:
+            logging.info(f'{self} is not cooled')
+
+    def disable_cooler(self):
+        if self.is_cooled:
+            self.set_control_value(ASI_COOLER_ON, 0)
+            self.set_control_value(ASI_FAN_ON, 0)
+            logging.debug(f'{self}: Disabeling cooler')
+        else:
+            logging.info(f'{self} is not cooled')
+
+    @property
+    def temperature(self):
+        if self.is_cooled:
+            # Get the temperature (x10)
+            t = self.get_control_value(ASI_TEMPERATURE)[0]
+            logging.debug(f'Getting temperature')
+            return t / 10
+        else:
+            logging.info(f'{self} is not cooled')
+
+    @temperature.setter
+    def temperature(self, t: float):
+        if self.is_cooled:
+            assert t > -40 and t < 20, 'Temperature out of range'
+            self.set_control_value(ASI_TARGET_TEMP, t)
+            logging.debug(f'Setting temperature to {t}')
+        else:
+            logging.info(f'{self} is not cooled')
+
+
+class ZwoCamera(ZwoCameraBase, Camera):
+    """Extension of zwoasi.Camera class. """
+
+    def __init__(self, camera_name: str):
+        # Load the DLL
+        self.load_lib()
+
+        # Initialize the camera
+        super(ZwoCamera, self).__init__(camera_name)
+
+    def __del__(self):
+        """Overwrite destructor to handle exceptions during closing. """
+
+        try:
+            self.close()
+        except Exception:
+            # Handle exceptions during closing (i.e., when no camera was connected)
+            pass
+
+    def load_lib(self):
+        """Initialize the camera. """
+
+        if zwoasi is None:
+            raise ImportError('zwoasi is required for using ZWO cameras.')
+
+        if platform == 'linux' or platform == 'linux2':
+            init('libASICamera2.so')
+        elif platform == 'win32':
+            init('ASICamera2.dll')
+        else:
+            raise NotImplementedError('Platform not implemented.')
+
+    def _read_video_data(self, out: np.ndarray, timeout: int):
+        """Let the SDK write the next video frame directly into the memory of out. """
+
+        r = zwoasi.zwolib.ASIGetVideoData(self.id, out.ctypes.data_as(POINTER(c_char)), out.nbytes, timeout)
+        if r:
+            raise zwoasi.zwo_errors[r]
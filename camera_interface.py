@@ -14,35 +14,42 @@ from camera_settings import CameraSettingsWindow
 from Subprocess import *
 from SubprocessHeader import *
 from SubprocessZwoMini import *
+from CameraInterface import CameraInterface
+from SubprocessImageProcessing import ImageInterface
+from SyncCapture import SyncCapture
+from Telemetry import get_telemetry
 
 import logging
 logging.basicConfig(filename='camera.log', level=logging.DEBUG)
 
+# Compression of the recordings (arguments of ImageData.FitsCompressedWriter, e.g., {'compression_type': 'RICE_1'}, or
+# None for uncompressed files)
+RECORDING_COMPRESSION = None
+
+# Directory of the master frames the cameras calibrate every frame with (see Calibration.CalibrationLibrary, None for no
+# calibration)
+CALIBRATION_DIRECTORY = None
+
 
 
 class CommunicationWorker(QObject):
     # Signal for starting the communication thread. Required by Qt
     start_communication_signal = pyqtSignal()
 
-    def __init__(self, res_queue: Queue, interface_manager: InterfaceManager):
+    def __init__(self, interface_manager: InterfaceManager):
         """Constructor of the communication thread. 
         
         # Arguments
-        * counterLabel1::QLabel - Label for displaying the value of counter 1.
-        * counterLabel2::QLabel - Label for displaying the value of counter 2.
-        * com_queue1::Queue - Communication queue for stopping counter1.
-        * com_queue2::Queue - Communication queue for stopping counter2.
-        * res_queue::Queue - Communication queue for getting back the counter values.
+        * interface_manager::InterfaceManager - Interfaces of all subprocesses, whose result channels are received
+                                                from.
         """
 
         # Call constructor of parent object
         super(CommunicationWorker, self).__init__()
 
-        # Store the result queue
-        self.res_queue = res_queue
-
-        # Store the command queues for both counters
+        # Wait on the result channels of all subprocesses at once
         self.interface_manager = interface_manager
+        self.multiplexer = ResultMultiplexer(interface_manager)
         #self.camera_interface = camera_interface
         
         # Connect start signal for starting the thread
@@ -51,6 +58,9 @@ class CommunicationWorker(QObject):
         # Set state
         self.running = False
 
+        # Telemetry of the main process
+        self.telemetry = get_telemetry('main')
+
     @pyqtSlot()
     def run_thread(self):
         """Code that runs when the subprocess is started. """
@@ -60,15 +70,12 @@ class CommunicationWorker(QObject):
         self.running = True
 
         while self.running:
-            # Check for results
-            if not self.res_queue.empty():
-                # Get data sent back from subprocess
-                uid, data = self.res_queue.get()
+            # Wait for data sent back from the subprocesses (nothing if woken up by stop_thread)
+            for interface, data in self.multiplexer.receive():
                 # Handle the data correctly
-                self.interface_manager[uid].handle_data(data)
-            else:
-                # Idle
-                time.sleep(0.01)
+                with self.telemetry.stage('dispatch'):
+                    interface.handle_data(data)
+                self.telemetry.count('results')
 
         logging.info(f'Stopped event loop of {self}')
             
@@ -76,6 +83,8 @@ class CommunicationWorker(QObject):
         """Function that is called to stop the communication thread. """
 
         self.running = False
+        # Wake up the thread waiting for data
+        self.multiplexer.wakeup()
   
 
 class MainWindow(QMainWindow):
@@ -99,20 +108,24 @@ class MainWindow(QMainWindow):
 
 
         ### Initialize subprocesses ###
-        # Create result queue which is shared by all subprocesses
-        self.res_queue = Queue()
+        # Every interface has its own result channel (see Subprocess.ResultChannel)
+        # Initialize the interface of the image processing which saves the recordings of both cameras
+        self.image_interface = ImageInterface(compression=RECORDING_COMPRESSION)
 
         # Initialize the camera interfaces
-        self.mini_camera_interface = CameraInterface(star_camera_name, self.imageLabelMini, self.res_queue, self.asi_mini_settings, self.miniStreamingButton, self.miniRecordingButton, self.miniSettingsButton, self.miniFpsDispaly)
-        self.cool_camera_interface = CameraInterface(science_camera_name, self.imageLabelCool, self.res_queue, self.asi_cool_settings, self.coolStreamingButton, self.coolRecordingButton, self.coolSettingsButton, self.coolFpsDisplay)
+        self.mini_camera_interface = CameraInterface(star_camera_name, self.imageLabelMini, self.asi_mini_settings, self.miniStreamingButton, self.miniRecordingButton, self.miniSettingsButton, self.miniFpsDispaly, self.image_interface)
+        self.cool_camera_interface = CameraInterface(science_camera_name, self.imageLabelCool, self.asi_cool_settings, self.coolStreamingButton, self.coolRecordingButton, self.coolSettingsButton, self.coolFpsDisplay, self.image_interface)
+
+        # Records with both cameras from a common start time, so their frames can be matched offline
+        self.sync_capture = SyncCapture(self.mini_camera_interface, self.cool_camera_interface)
 
-        # Create the interface manager
-        self.interface_manager = InterfaceManager(self.mini_camera_interface, self.cool_camera_interface)
+        # Create the interface manager (the cameras are stopped first, so their last recordings are still processed)
+        self.interface_manager = InterfaceManager(self.mini_camera_interface, self.cool_camera_interface, self.image_interface)
 
 
         ### Initialize the communication between the main window and the subprocesses ###
         # Create the communication worker
-        self.communication_worker = CommunicationWorker(self.res_queue, self.interface_manager)
+        self.communication_worker = CommunicationWorker(self.interface_manager)
 
         # Create a new thread for the communicaiton worker
         self.communication_thread = QThread(self)
@@ -125,15 +138,22 @@ class MainWindow(QMainWindow):
 
 
         ### Start subprocesses ###
+        # Start the image processing before the cameras send recordings
+        self.start_subprocess(IMG_PROCESS_ID)
+
         # Start Mini camera process
         self.start_subprocess(CAMERA_ID)
         self.mini_camera_interface.load_camera_settings()
         self.mini_camera_interface.stop_recording()
+        if CALIBRATION_DIRECTORY is not None:
+            self.mini_camera_interface.set_calibration(CALIBRATION_DIRECTORY)
 
         # Start Cool camera process
         self.start_subprocess(COOL_CAMERA_ID)
         self.cool_camera_interface.load_camera_settings()
         self.cool_camera_interface.stop_recording()
+        if CALIBRATION_DIRECTORY is not None:
+            self.cool_camera_interface.set_calibration(CALIBRATION_DIRECTORY)
 
 
     ### Handling starting and stopping of subprocesses ###
@@ -23,7 +23,7 @@ class CameraSettingsWindow(QWidget):
         self.exp_time_input = self.exp_time 
 
 
-    def connect_signals(self, f_exp_time_change, f_roi_change, f_temperature_change):
+    def connect_signals(self, f_exp_time_change, f_roi_change, f_temperature_change, f_stretch_change=None, f_image_type_change=None, f_binning_change=None):
         self.exp_time_input.editingFinished.connect(f_exp_time_change)
 
         self.offset_x_input.editingFinished.connect(f_roi_change)
@@ -33,6 +33,16 @@ class CameraSettingsWindow(QWidget):
 
         self.temperature_input.editingFinished.connect(f_temperature_change)
 
+        if f_stretch_change is not None:
+            self.stretch_input.currentTextChanged.connect(f_stretch_change)
+
+        if f_image_type_change is not None:
+            self.image_type_input.currentTextChanged.connect(f_image_type_change)
+
+        if f_binning_change is not None:
+            self.binning_input.currentTextChanged.connect(f_binning_change)
+            self.binning_mode_input.currentTextChanged.connect(f_binning_change)
+
     def get_exp_time(self):
 
         exp_time = self.exp_time_input.value() / 1e3 # exp_time in seconds
@@ -109,6 +119,36 @@ class CameraSettingsWindow(QWidget):
         logging.debug(f'{self} maximum size values x: ({min_width}, {max_width}) y: ({min_height}, {max_height})')
         logging.debug(f'{self} maximum offset values x: ({min_offset_x}, {max_offset_x}) y: ({min_offset_y}, {max_offset_y})')
 
+    def get_image_type(self):
+        return self.image_type_input.currentText()
+
+    def set_image_type(self, name):
+        self.image_type_input.setCurrentText(name)
+
+    def get_binning(self):
+        """Get the binning factor and mode ('camera', 'sum' or 'mean'). """
+
+        factor = int(self.binning_input.currentText().split('x')[0])
+        mode = self.binning_mode_input.currentText()
+        if mode.startswith('Software'):
+            return factor, mode[mode.index('(') + 1:-1]
+        return factor, 'camera'
+
+    def set_binning(self, factor, mode, supported_bins=None):
+        # Only offer the binnings supported by the camera
+        items = [self.binning_input.itemText(i) for i in range(self.binning_input.count())]
+        if supported_bins is not None and items != [f'{b}x{b}' for b in supported_bins]:
+            self.binning_input.blockSignals(True)
+            self.binning_input.clear()
+            self.binning_input.addItems([f'{b}x{b}' for b in supported_bins])
+            self.binning_input.blockSignals(False)
+
+        self.binning_input.setCurrentText(f'{factor}x{factor}')
+        self.binning_mode_input.setCurrentText('Camera' if mode == 'camera' else f'Software ({mode})')
+
+    def get_stretch(self):
+        return self.stretch_input.currentText()
+
     def get_temperature(self):
         temperature = self.temperature_input.value()
         return temperature
@@ -0,0 +1,438 @@
+"""Headless capture daemon: record frames of one or more cameras to FITS files without Qt or a display.
+
+The cameras are driven by their CameraSubprocess directly and the recordings are written by the ImageSubprocess, like
+in the GUI. Several cameras record a synchronized session (see SyncCapture). While recording, a line of statistics is
+written to stdout every interval (JSON lines with --json), the log goes to stderr. Only the modules of the capture path
+are imported, so the daemon starts fast and runs on machines without X.
+
+Usage: python capture_daemon.py --camera "ZWO ASI174MM-Cool" --exp 5 --roi 0 640 0 128 --frames 5000 --directory data
+
+SIGINT and SIGTERM stop the recording. The frames recorded so far are still written.
+"""
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessHeader import *
+from SubprocessZwoMini import CameraSubprocess, CAMERA_UIDS, IMAGE_TYPE_NAMES
+from SubprocessImageProcessing import ImageInterface
+from FrameBuffer import FrameRingReader
+from SyncCapture import SyncCapture, SYNC_START_DELAY
+import argparse
+import signal
+import json
+import time
+import sys
+
+
+# Maximum number of previews per second the cameras send (the daemon does not display them)
+PREVIEW_RATE = 1
+
+# Time to wait for the cameras to apply the settings and for the end of the recording (in s)
+SETUP_TIMEOUT = 30
+STOP_TIMEOUT = 30
+
+
+class HeadlessCameraInterface(Interface):
+    """Interface to a camera subprocess without GUI, which passes the recordings on to the image processing. """
+
+    def __init__(self, camera_type: str, image_interface: ImageInterface, backend: str = None, image_type: int = None):
+        """Constructor. camera_type: ZWO ASI120MM Mini or ZWO ASI174MM-Cool. Backend: 'zwo', 'sim' or None (see
+        SubprocessZwoMini.open_camera).
+        """
+
+        if camera_type not in CAMERA_UIDS:
+            raise NotImplementedError(f'{camera_type} not known.')
+
+        super().__init__(CAMERA_UIDS[camera_type])
+
+        self.camera_type = camera_type
+        self.image_interface = image_interface
+        self._backend = backend
+        self._image_type = image_type
+
+        # Access to the previews, which are released right away
+        self.frame_reader = FrameRingReader()
+
+        # Settings reported by the subprocess (see CameraSubprocess.get_config)
+        self.config = None
+        # Number of frames to record (None until stopped), see set_sync_rec_mode
+        self.n_frames = None
+        # Whether the camera records, and the recordings and frames passed on to the image processing
+        self.recording = False
+        self.recordings = 0
+        self.frames = 0
+        # Last frame timing report of the recording and the capture counters (see stop_recording)
+        self.timing = None
+        self.capture_stats = None
+        # Whether the subprocess stopped unexpectedly
+        self.crashed = False
+
+    def __str__(self) -> str:
+        return self.camera_type
+
+    def init_subprocess(self):
+        """Overwrite the parent function for initializing the subprocess. """
+
+        return CameraSubprocess(self.uid, self.camera_type, self.com_queue, self.res_queue, self._backend, PREVIEW_RATE, self._image_type)
+
+    def stop_subprocess(self, timeout=0.05):
+        """Extend stopping the subprocess by detaching from its frame ring. """
+
+        super().stop_subprocess(timeout)
+        self.frame_reader.close()
+
+    def apply_config(self, config: dict):
+        """Apply several settings at once (see SubprocessZwoMini.CONFIG_KEYS, None keeps a setting). """
+
+        self.config = None
+        self.com_queue.put((CMD_CAMERA_APPLY_CONFIG, config))
+
+    def start_recording(self, n_frames: int = None):
+        """Record n_frames frames (until stopped for None). """
+
+        self.set_sync_rec_mode(None, None, n_frames)
+
+    def set_sync_rec_mode(self, start_ns: int, sync_id: str, n_frames: int = None):
+        """Start recording together with other cameras (see SyncCapture). The camera stops by itself after n_frames
+        frames (defaults to the attribute n_frames).
+        """
+
+        if n_frames is None:
+            n_frames = self.n_frames
+        logging.info(f'{self} starts recording {n_frames or "unlimited"} frames.')
+        self.recording = True
+        self.com_queue.put((CMD_CAMERA_REC_MODE, start_ns, sync_id, n_frames))
+
+    def stop_recording(self):
+        """Stop recording and keep the frames recorded so far. The frame timing and the capture counters are sent
+        back, the latter after the last recording.
+        """
+
+        self.com_queue.put((CMD_CAMERA_MODE_STOP, True))
+        self.capture_stats = None
+        self.com_queue.put((CMD_CAMERA_GET_CAPTURE_STATS, ))
+
+    def get_timing(self):
+        """Query the frame timing report of the recording. """
+
+        self.com_queue.put((CMD_CAMERA_GET_TIMING, ))
+
+    def handle_data(self, data):
+        """Handle data sent back from the camera subprocess. """
+
+        cmd = data[0]
+
+        if cmd == CMD_DISPLAY_IMAGE:
+            self.frame_reader.release(data[1])
+        elif cmd == CMD_RETURN_REC:
+            self.receive_recording(*data[1:])
+        elif cmd == CMD_CAMERA_GET_CONFIG:
+            self.config = data[1]
+        elif cmd == CMD_CAMERA_GET_TIMING:
+            # The report of a stopped camera is empty
+            if data[1]['frames'] or self.recording:
+                self.timing = data[1]
+        elif cmd == CMD_CAMERA_GET_CAPTURE_STATS:
+            self.capture_stats = data[1]
+        elif cmd == CMD_CAMERA_MODE_STOP:
+            logging.info(f'{self} recorded all frames.')
+            self.recording = False
+        elif cmd == CMD_STOP_SUBPROCESS:
+            self.crash_cleanup()
+        else:
+            logging.debug(f'{self} ignores {cmd:#x}.')
+
+    def check_alive(self) -> bool:
+        """Check whether the subprocess is still running (e.g., it may have been killed). """
+
+        if self.subprocess and not self.crashed and not self.subprocess.is_alive():
+            self.crash_cleanup()
+
+        return not self.crashed
+
+    def crash_cleanup(self):
+        """Handle a crashed subprocess. Its frame timing is outdated, so it is not reported anymore. """
+
+        if not self.crashed:
+            logging.error(f'{self} subprocess {self.subprocess} crashed.')
+        self.crashed = True
+        self.recording = False
+        self.timing = None
+
+    def receive_recording(self, ref, header: dict, meta: dict):
+        """Pass a recording in the shared memory of the subprocess on to the image processing. """
+
+        self.recordings += 1
+        self.frames += len(meta['T_NS'])
+        self.image_interface.process_recording(self.uid, ref, header, meta)
+
+
+class CaptureDaemon:
+    """Records with one or more cameras and writes statistics to stdout. """
+
+    def __init__(self, camera_types: list, backend: str = None, image_type: int = None, directory: str = '.', n_workers: int = None,
+                 compression: dict = None, json_lines: bool = False):
+        """Constructor.
+
+        # Arguments
+        * camera_types::list(str) - Names of the cameras.
+        * backend::str - 'zwo', 'sim' or None (see SubprocessZwoMini.open_camera).
+        * image_type::int - ASI_IMG_RAW8 or ASI_IMG_RAW16 (None for the default of every camera).
+        * directory::str - Directory of the recordings.
+        * n_workers::int - Number of processes writing the recordings (see ImageSubprocess).
+        * compression::dict - Compression of the recordings (see ImageSubprocess).
+        * json_lines::bool - Write the statistics as JSON lines instead of text.
+        """
+
+        self.image_interface = ImageInterface(directory, n_workers, compression)
+        self.cameras = [HeadlessCameraInterface(camera_type, self.image_interface, backend, image_type) for camera_type in camera_types]
+        self.multiplexer = ResultMultiplexer(InterfaceManager(self.image_interface, *self.cameras))
+        self.json_lines = json_lines
+
+        # Set by SIGINT or SIGTERM
+        self._stop_requested = False
+        self._t_start = None
+
+    def request_stop(self, signum=None, frame=None):
+        """Stop the recording (signal handler). """
+
+        logging.info(f'{self} stops (signal {signum}).')
+        self._stop_requested = True
+        self.multiplexer.wakeup()
+
+    def handle_results(self, timeout: float = None):
+        """Wait at most timeout seconds for results of the subprocesses and handle them. Returns whether a result was
+        handled.
+        """
+
+        results = self.multiplexer.receive(timeout)
+        for interface, data in results:
+            interface.handle_data(data)
+        self.check_subprocesses()
+
+        return bool(results)
+
+    def check_subprocesses(self):
+        """Mark cameras whose subprocess died as crashed. Raises RuntimeError if the image processing died, since the
+        recordings cannot be written anymore.
+        """
+
+        for camera in self.cameras:
+            camera.check_alive()
+        if self.image_interface.subprocess and not self.image_interface.subprocess.is_alive():
+            raise RuntimeError('The image processing subprocess stopped.')
+
+    def wait_for(self, condition, timeout: float) -> bool:
+        """Handle results until condition() is true, at most timeout seconds. Returns the final condition(). """
+
+        t_end = time.perf_counter() + timeout
+        while not condition() and time.perf_counter() < t_end:
+            self.handle_results(0.1)
+
+        return condition()
+
+    def start(self, config: dict):
+        """Start the subprocesses and apply the settings (see HeadlessCameraInterface.apply_config) to all cameras. """
+
+        # The subprocesses ignore SIGINT and SIGTERM (e.g., Ctrl+C in the terminal) and are stopped by the daemon
+        handlers = {signum: signal.signal(signum, signal.SIG_IGN) for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            self.image_interface.start_subprocess()
+            for camera in self.cameras:
+                camera.start_subprocess()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        for signum in handlers:
+            signal.signal(signum, self.request_stop)
+
+        for camera in self.cameras:
+            camera.apply_config(config)
+        if not self.wait_for(lambda: all(camera.config is not None or camera.crashed for camera in self.cameras), SETUP_TIMEOUT):
+            raise TimeoutError('The cameras did not apply the settings.')
+        if any(camera.crashed for camera in self.cameras):
+            raise RuntimeError('A camera subprocess crashed.')
+
+        for camera in self.cameras:
+            roi = camera.config['camera_roi']
+            logging.info(f'{camera}: {camera.config}')
+            self.write({'event': 'configured', 'camera': camera.camera_type, 'exp_time': camera.config['exp_time'], 'roi': roi,
+                        'image_type': IMAGE_TYPE_NAMES.get(camera.config['image_type'], camera.config['image_type'])},
+                       f'{camera}: exposure {camera.config["exp_time"] * 1e3:g} ms, ROI {roi}, '
+                       f'{IMAGE_TYPE_NAMES.get(camera.config["image_type"])}')
+
+    def record(self, n_frames: int = None, seconds: float = None, interval: float = 1, sync_delay: float = SYNC_START_DELAY) -> bool:
+        """Record n_frames frames with every camera, for seconds, or until stopped (for None), and write the statistics
+        every interval seconds. Several cameras start together sync_delay seconds after the call.
+
+        # Returns
+        * ok::bool - Whether all recordings were written.
+        """
+
+        self._t_start = time.perf_counter()
+        sync_id = None
+        if len(self.cameras) > 1:
+            for camera in self.cameras:
+                camera.n_frames = n_frames
+            sync = SyncCapture(*self.cameras)
+            sync_id = sync.start(sync_delay)
+            # The time is counted from the common start
+            t_end = None if seconds is None else sync.start_ns * 1e-9 + seconds
+        else:
+            self.cameras[0].start_recording(n_frames)
+            t_end = None if seconds is None else self._t_start + seconds
+        next_report = self._t_start + interval
+        while not self._stop_requested and any(camera.recording for camera in self.cameras):
+            now = time.perf_counter()
+            if t_end is not None and now >= t_end:
+                break
+            if now >= next_report:
+                self.report()
+                next_report += interval
+            self.handle_results(max(min(next_report, t_end or next_report) - now, 0))
+
+        return self.finish(sync_id)
+
+    def report(self):
+        """Write the statistics received since the last call and query new ones. """
+
+        t = time.perf_counter() - self._t_start
+        cameras = {camera.camera_type: {'recorded': camera.frames, 'crashed': camera.crashed, **(camera.timing or {})} for camera in self.cameras}
+        progress = {key: value for key, value in (self.image_interface.progress or {}).items() if key != 'result'}
+
+        text = [f'{t:7.1f} s']
+        for camera in self.cameras:
+            timing = camera.timing or {}
+            if camera.crashed:
+                text.append(f'{camera}: {camera.frames} frames, crashed')
+            else:
+                text.append(f'{camera}: {camera.frames} frames, {timing.get("rate", 0):.1f} fps, '
+                            f'{timing.get("missed", 0)} missed, {timing.get("dropped", 0)} dropped')
+        if progress:
+            text.append(f'{progress["recorded"]} frames written, {progress["pending"]} recordings pending, '
+                        f'{progress["throughput"] / 2**20:.1f} MiB/s')
+        self.write({'event': 'stats', 't': t, 'cameras': cameras, 'images': progress}, ' | '.join(text))
+
+        for camera in self.cameras:
+            if not camera.crashed:
+                camera.get_timing()
+        self.image_interface.get_progress()
+
+    def finish(self, sync_id: str = None) -> bool:
+        """Stop the cameras and wait until all recordings were written (as long as the image processing makes progress,
+        see STOP_TIMEOUT). Returns whether all recordings were written.
+        """
+
+        for camera in self.cameras:
+            if not camera.crashed:
+                camera.stop_recording()
+        # The capture counters are sent after the last recording of a camera
+        if not self.wait_for(lambda: all(camera.capture_stats is not None or camera.crashed for camera in self.cameras), STOP_TIMEOUT):
+            logging.error(f'{self} cameras did not stop.')
+        while self.handle_results(0):
+            pass
+
+        # The image processing reports the progress by itself, too, so wait until all recordings were counted
+        recordings = sum(camera.recordings for camera in self.cameras)
+
+        def written():
+            progress = self.image_interface.progress
+            return progress is not None and progress['done'] + progress['failed'] >= recordings
+
+        # Give up once the image processing made no progress for STOP_TIMEOUT seconds
+        t_end, handled = time.perf_counter() + STOP_TIMEOUT, None
+        while not written():
+            progress = self.image_interface.progress
+            if progress is not None and progress['done'] + progress['failed'] != handled:
+                t_end, handled = time.perf_counter() + STOP_TIMEOUT, progress['done'] + progress['failed']
+            elif time.perf_counter() > t_end:
+                logging.error(f'{self} image processing did not write {recordings - (handled or 0)} of {recordings} recordings.')
+                return False
+            self.image_interface.get_progress()
+            self.wait_for(written, 0.5)
+        progress = self.image_interface.progress
+
+        t = time.perf_counter() - self._t_start
+        summary = {
+            'event': 'done',
+            't': t,
+            'sync_id': sync_id,
+            'cameras': {camera.camera_type: {'recorded': camera.frames, 'recordings': camera.recordings, 'crashed': camera.crashed,
+                                             'timing': camera.timing, 'capture': camera.capture_stats} for camera in self.cameras},
+            'images': {key: value for key, value in progress.items() if key != 'result'},
+        }
+        self.write(summary, f'{t:7.1f} s | done: {progress["recorded"]} frames in {progress["done"]} recordings written '
+                            f'({progress["file_bytes"] / 2**20:.1f} MiB), {progress["failed"]} failed'
+                            + (f', session {sync_id}' if sync_id else '')
+                            + ''.join(f', {camera} crashed' for camera in self.cameras if camera.crashed))
+
+        return not progress['failed'] and not any(camera.crashed for camera in self.cameras)
+
+    def close(self):
+        """Stop all subprocesses. """
+
+        for camera in self.cameras:
+            camera.stop_subprocess()
+        self.image_interface.stop_subprocess()
+
+    def write(self, record: dict, text: str):
+        """Write a line of statistics to stdout. """
+
+        print(json.dumps(record, default=str) if self.json_lines else text, flush=True)
+
+
+def parse_args(args: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Record frames of one or more cameras to FITS files without GUI.')
+    parser.add_argument('--camera', action='append', choices=list(CAMERA_UIDS), help='Camera to record with (repeat for a synchronized recording of several cameras, default: ZWO ASI174MM-Cool).')
+    parser.add_argument('--backend', choices=('zwo', 'sim'), help='Camera hardware or simulated cameras (default: ZWO_CAMERA_BACKEND or zwo).')
+    parser.add_argument('--exp', type=float, help='Exposure time in ms (default: keep the camera setting).')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('OFFSET_X', 'WIDTH', 'OFFSET_Y', 'HEIGHT'), help='ROI in sensor pixels with the offset from the sensor center.')
+    parser.add_argument('--image-type', choices=list(IMAGE_TYPE_NAMES.values()), help='Image type (default: RAW8 for the Mini, RAW16 for the ASI174).')
+    parser.add_argument('--bins', type=int, help='Binning of the camera.')
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument('--frames', type=int, help='Number of frames to record with every camera.')
+    length.add_argument('--seconds', type=float, help='Time to record (in s).')
+    parser.add_argument('--directory', default='.', help='Directory of the recordings.')
+    parser.add_argument('--compression', help='Compression of the recordings, e.g., RICE_1 (default: uncompressed).')
+    parser.add_argument('--workers', type=int, help='Number of processes writing the recordings.')
+    parser.add_argument('--interval', type=float, default=1, help='Time between the lines of statistics (in s).')
+    parser.add_argument('--sync-delay', type=float, default=SYNC_START_DELAY, help='Time until several cameras start recording (in s).')
+    parser.add_argument('--json', action='store_true', help='Write the statistics as JSON lines.')
+    parser.add_argument('--log-level', default='WARNING', help='Level of the log written to stderr.')
+
+    args = parser.parse_args(args)
+    if args.camera is None:
+        args.camera = ['ZWO ASI174MM-Cool']
+    if len(set(args.camera)) < len(args.camera):
+        parser.error('Every camera can only be given once.')
+    if args.frames is not None and args.frames < 1:
+        parser.error('--frames must be positive.')
+
+    return args
+
+
+def main(args: list = None) -> int:
+    args = parse_args(args)
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr, format='%(asctime)s %(levelname)s %(message)s')
+
+    image_type = None
+    if args.image_type is not None:
+        image_type = {v: k for k, v in IMAGE_TYPE_NAMES.items()}[args.image_type]
+    config = {
+        'exp_time': None if args.exp is None else args.exp * 1e-3,
+        'roi': args.roi,
+        'image_type': image_type,
+        'bins': args.bins,
+    }
+    compression = None if args.compression is None else {'compression_type': args.compression}
+
+    daemon = CaptureDaemon(args.camera, args.backend, image_type, args.directory, args.workers, compression, args.json)
+    try:
+        daemon.start(config)
+        ok = daemon.record(args.frames, args.seconds, args.interval, args.sync_delay)
+    finally:
+        daemon.close()
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
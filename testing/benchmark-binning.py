@@ -0,0 +1,135 @@
+"""Throughput of the binning modes with the simulated camera (no camera or ZWO SDK required).
+
+1. Software binning (FrameProcessing.SoftwareBinning) of single frames compared to a reshape and sum.
+2. Frame rate and frame size of a streaming CameraSubprocess for camera binning and software binning.
+
+Usage: python testing/benchmark-binning.py [camera name] [seconds per mode]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+from FrameProcessing import SoftwareBinning
+from SimulatedCamera import CAMERA_MODELS
+
+
+def time_per_call(function, n=50):
+    """Median time of a call (in s). """
+
+    times = np.empty(n)
+    for i in range(n):
+        t_s = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - t_s
+
+    return np.median(times)
+
+
+def benchmark_software_binning(width, height):
+    print(f'Software binning of {width}x{height} frames (ms per frame, MPix/s)')
+    print(f'{"type":>8} {"bins":>6} {"method":>8} {"binning":>10} {"MPix/s":>10} {"reshape":>10}')
+
+    rng = np.random.default_rng(0)
+    for dtype in (np.uint8, np.uint16):
+        frame = rng.integers(0, np.iinfo(dtype).max, (height, width), dtype=dtype)
+        for factor in (2, 3, 4):
+            h, w = height // factor * factor, width // factor * factor
+            reshape = time_per_call(lambda: frame[:h, :w].reshape(h // factor, factor, w // factor, factor).sum(axis=(1, 3)))
+            for method in ('sum', 'mean'):
+                binning = SoftwareBinning(factor, method)
+                out = binning(frame)
+                t = time_per_call(lambda: binning(frame, out))
+                print(f'{np.dtype(dtype).name:>8} {factor:>4}x{factor} {method:>8} {t * 1e3:>10.2f} {frame.size / t * 1e-6:>10.0f} {reshape * 1e3:>10.2f}')
+
+
+def receive(multiplexer):
+    """Data of all results in the order the multiplexer hands them out. """
+
+    while True:
+        for interface, data in multiplexer.receive():
+            yield data
+
+
+def wait_for(results, reader, cmd):
+    """Wait for a reply, releasing all frames which arrive in the meantime. """
+
+    while True:
+        data = next(results)
+        if data[0] == CMD_DISPLAY_IMAGE:
+            reader.get(data[1])
+            reader.release(data[1])
+        elif data[0] == cmd:
+            return data
+
+
+def benchmark_pipeline(camera_name, duration):
+    interface = Interface(CAMERA_ID)
+    com_queue = interface.com_queue
+    results = receive(ResultMultiplexer(InterfaceManager(interface)))
+    subprocess = CameraSubprocess(CAMERA_ID, camera_name, com_queue, interface.res_queue, backend='sim')
+    subprocess.start()
+    reader = FrameRingReader()
+
+    modes = [('1x1', {'bins': 1, 'soft_bins': 1})]
+    for factor in CAMERA_MODELS[camera_name]['SupportedBins'][1:]:
+        modes.append((f'{factor}x{factor} camera', {'bins': factor, 'soft_bins': 1}))
+    for factor in (2, 4):
+        for method in ('sum', 'mean'):
+            modes.append((f'{factor}x{factor} {method}', {'bins': 1, 'soft_bins': factor, 'soft_bin_method': method}))
+
+    print(f'\nStreaming a simulated {camera_name} (full sensor, 1 ms exposure)')
+    print(f'{"mode":>14} {"frame":>12} {"type":>8} {"FPS":>8} {"MB/s":>8} {"binning CPU (ms)":>18}')
+
+    com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+    for label, config in modes:
+        config.update(exp_time=1e-3, roi=(0, CAMERA_MODELS[camera_name]['MaxWidth'], 0, CAMERA_MODELS[camera_name]['MaxHeight']))
+        com_queue.put((CMD_CAMERA_APPLY_CONFIG, config))
+        wait_for(results, reader, CMD_CAMERA_GET_CONFIG)
+        # Measure the frames of the new mode only
+        time.sleep(0.5)
+        com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+        com_queue.put((CMD_GET_STATS, ))
+        before = wait_for(results, reader, CMD_GET_STATS)[1]
+        time.sleep(duration)
+        com_queue.put((CMD_GET_STATS, ))
+        stats = wait_for(results, reader, CMD_GET_STATS)[1]
+
+        data = None
+        while data is None or data[0] != CMD_DISPLAY_IMAGE:
+            data = next(results)
+        ref = data[1]
+        reader.get(ref)
+        reader.release(ref)
+
+        rate = stats['timing'].get('rate', 0)
+        frame_bytes = int(np.prod(ref.shape)) * np.dtype(ref.dtype).itemsize
+        stage = stats['stage'].get('binning')
+        stage_before = before['stage'].get('binning', {'calls': 0, 'cpu': 0})
+        if stage is not None and stage['calls'] > stage_before['calls']:
+            cpu = (stage['cpu'] - stage_before['cpu']) / (stage['calls'] - stage_before['calls']) * 1e3
+            cpu = f'{cpu:.2f}'
+        else:
+            cpu = '-'
+        shape = f'{ref.shape[1]}x{ref.shape[0]}'
+        print(f'{label:>14} {shape:>12} {np.dtype(ref.dtype).name:>8} {rate:>8.1f} {rate * frame_bytes * 1e-6:>8.1f} {cpu:>18}')
+
+    com_queue.put((CMD_STOP_SUBPROCESS, ))
+    wait_for(results, reader, CMD_STOP_SUBPROCESS)
+    subprocess.join()
+    reader.close()
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI174MM-Cool'
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    model = CAMERA_MODELS[camera_name]
+    benchmark_software_binning(model['MaxWidth'], model['MaxHeight'])
+    benchmark_pipeline(camera_name, duration)
@@ -0,0 +1,118 @@
+"""Accuracy and cost of the dark/flat calibration (no camera or ZWO SDK required).
+
+Frames of a simulated sensor with bias, dark current, hot pixels and vignetting are recorded to FITS files, the master
+frames are built from them with a CalibrationLibrary (a second library has to find them on disk instead of rebuilding
+them), and calibrated frames are compared to the true signal. The time per frame is measured for the full sensor and
+for a ROI cropped from the full sensor masters.
+
+Usage: python testing/benchmark-calibration.py [width] [height] [frames per master] [band MB]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ImageData import ImageData, load_fits
+from Calibration import CalibrationLibrary, calibrate_recording
+
+
+EXP_TIME = 0.5
+TEMPERATURE = -10.0
+
+
+class Sensor:
+    """Sensor with a fixed bias and dark current pattern, hot pixels and a vignetted flat field. """
+
+    def __init__(self, width, height, seed=1):
+        rng = np.random.default_rng(seed)
+        self.rng = rng
+        self.bias = 800 + rng.normal(0, 5, (height, width))
+        self.dark_rate = rng.gamma(16, 1.25, (height, width))
+        self.hot = rng.random((height, width)) < 1e-3
+        self.dark_rate[self.hot] += 20000
+        y, x = np.mgrid[:height, :width]
+        r2 = ((x - width / 2)**2 + (y - height / 2)**2) / (width**2 + height**2) * 4
+        self.flat = (1 - 0.3 * r2) * rng.normal(1, 0.01, (height, width))
+
+    def frames(self, n, signal=0.0, exp_time=EXP_TIME):
+        """Frames with a uniform signal (in ADU before vignetting) and read noise. """
+
+        mean = self.bias + self.dark_rate * exp_time + signal * self.flat
+        frames = mean + self.rng.normal(0, 4, (n, ) + mean.shape)
+        return np.clip(np.rint(frames), 0, 65535).astype(np.uint16)
+
+
+def record(file_name, frames, compression=None):
+    ImageData(frames, EXP_TIME, bit_depth=16, temperature=TEMPERATURE, origin=(0, 0)).write_fits_to_file(file_name, compression=compression)
+
+
+if __name__ == '__main__':
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 1936
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 1216
+    n_frames = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    band_bytes = int(float(sys.argv[4]) * 2**20) if len(sys.argv) > 4 else 2**25
+
+    directory = tempfile.mkdtemp(prefix='calibration_')
+    sensor = Sensor(width, height)
+
+    record(os.path.join(directory, 'darks.fits'), sensor.frames(n_frames))
+    # Flats are compressed to also read bands of compressed chunks
+    record(os.path.join(directory, 'flats.fits'), sensor.frames(n_frames, signal=20000), {'compression_type': 'RICE_1'})
+
+    masters = os.path.join(directory, 'masters')
+    library = CalibrationLibrary(masters)
+    for kind, name in (('dark', 'darks.fits'), ('flat', 'flats.fits')):
+        with load_fits(os.path.join(directory, name)) as rec:
+            for method in ('median', 'clipped_mean'):
+                t = time.perf_counter()
+                library.build(kind, rec, method=method, rebuild=True, max_bytes=band_bytes)
+                print(f'{kind} master ({method}) of {n_frames}x{width}x{height}: {time.perf_counter() - t:.2f} s in bands of {band_bytes / 2**20:.0f} MB')
+
+    # A new library has to use the masters on disk
+    library = CalibrationLibrary(masters)
+    with load_fits(os.path.join(directory, 'darks.fits')) as rec:
+        library.build('dark', rec)
+    print(f'Second library: {library.built} masters built, {library.reused} reused')
+
+    key = library.make_key(EXP_TIME, TEMPERATURE, (0, 0), (height, width), 1, 16)
+    calibration = library.calibration(key)
+    print(f'{calibration}, {np.count_nonzero(sensor.hot)} hot pixels simulated')
+
+    # Accuracy of calibrated frames with a uniform signal (the flat is normalized to its median)
+    signal = 5000.0
+    lights = sensor.frames(10, signal)
+    calibrated = calibration(lights)
+    expected = signal * np.median(sensor.flat)
+    hot_error = np.abs(calibrated[:, sensor.hot] - expected).mean()
+    error = np.abs(calibrated[:, ~sensor.hot] - expected)
+    raw_spread = lights[:, ~sensor.hot].std()
+    print(f'Calibrated signal: {calibrated.mean():.1f} (expected {expected:.1f}), mean error {error.mean():.1f} ADU '
+          f'(raw spread {raw_spread:.0f} ADU), hot pixels off by {hot_error:.1f} ADU')
+
+    # Cost per frame for the full sensor and a ROI cropped from the masters
+    for origin, shape in (((0, 0), (height, width)), ((width // 4, height // 2), (128, width // 2))):
+        roi_key = library.make_key(EXP_TIME, TEMPERATURE, origin, shape, 1, 16)
+        roi_calibration = library.calibration(roi_key)
+        frame = lights[0, origin[1]:origin[1] + shape[0], origin[0]:origin[0] + shape[1]].copy()
+        expected = calibrated[0, origin[1]:origin[1] + shape[0], origin[0]:origin[0] + shape[1]]
+        n = 50
+        t = time.perf_counter()
+        for _ in range(n):
+            out = roi_calibration(frame)
+        t = (time.perf_counter() - t) / n
+        ok = np.array_equal(out, expected) or np.abs(out.astype(int) - expected).max() <= 1
+        print(f'{shape[1]}x{shape[0]} at {origin}: {t * 1e3:.2f} ms per frame ({frame.nbytes / t / 2**20:.0f} MiB/s), '
+              f'{"matches" if ok else "differs from"} the full frame')
+
+    # Offline calibration of a recording
+    record(os.path.join(directory, 'lights.fits'), lights)
+    t = time.perf_counter()
+    calibrate_recording(os.path.join(directory, 'lights.fits'), library, os.path.join(directory, 'lights_cal.fits'))
+    with load_fits(os.path.join(directory, 'lights_cal.fits')) as rec:
+        ok = rec.header['CALIBRAT'] and np.array_equal(rec[:], calibrated)
+    print(f'Offline calibration: {time.perf_counter() - t:.2f} s, {"matches" if ok else "differs"}')
+
+    print(f'Files in {directory}')
@@ -0,0 +1,148 @@
+"""Accuracy and cost of the star centroiding (no camera or ZWO SDK required).
+
+1. Position error of Centroiding.Centroider on synthetic Gaussian stars with noise for both methods.
+2. Time per frame for small ROIs and full frames.
+3. Rate of centroids streamed by a CameraSubprocess with the simulated camera.
+
+Usage: python testing/benchmark-centroid.py [camera name] [seconds]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+from Centroiding import Centroider, CENTROID_METHODS
+from SimulatedCamera import CAMERA_MODELS
+
+
+def star_frame(rng, shape, x, y, sigma=1.5, flux=2e4, level=200, noise=5):
+    """Frame with a Gaussian star, Poisson noise and read noise (uint16). """
+
+    rows, cols = np.indices(shape)
+    spot = flux / (2 * np.pi * sigma ** 2) * np.exp(-((cols - x) ** 2 + (rows - y) ** 2) / (2 * sigma ** 2))
+    frame = rng.poisson(spot) + rng.normal(level, noise, shape)
+
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+def time_per_call(function, n=200):
+    """Median time of a call (in s). """
+
+    times = np.empty(n)
+    for i in range(n):
+        t_s = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - t_s
+
+    return np.median(times)
+
+
+def benchmark_accuracy(n=200):
+    print('Position error on 64x64 frames with a single star (sigma 1.5 px)')
+    print(f'{"method":>8} {"flux":>10} {"RMS error (px)":>16} {"FWHM (px)":>10}')
+
+    rng = np.random.default_rng(0)
+    for flux in (2e3, 2e4, 2e5):
+        positions = rng.uniform(20, 44, (n, 2))
+        frames = [star_frame(rng, (64, 64), x, y, flux=flux) for x, y in positions]
+        for method in CENTROID_METHODS:
+            centroider = Centroider(window=11, method=method)
+            errors, fwhm = [], []
+            for (x, y), frame in zip(positions, frames):
+                centroider.reset()
+                records = centroider(frame)
+                if len(records):
+                    errors.append(np.hypot(records['x'][0] - x, records['y'][0] - y))
+                    fwhm.append(records['fwhm'][0])
+            rms = np.sqrt(np.mean(np.square(errors)))
+            print(f'{method:>8} {flux:>10.0f} {rms:>16.3f} {np.median(fwhm):>10.2f}')
+
+
+def benchmark_cost(camera_name):
+    model = CAMERA_MODELS[camera_name]
+    print(f'\nTime per frame (us, tracking a star)')
+    print(f'{"frame":>12} {"method":>8} {"stars":>6} {"time":>10}')
+
+    rng = np.random.default_rng(1)
+    for shape in ((64, 64), (256, 256), (model['MaxHeight'], model['MaxWidth'])):
+        frame = star_frame(rng, shape, shape[1] / 2, shape[0] / 2)
+        for method in CENTROID_METHODS:
+            for max_stars in (1, 10):
+                centroider = Centroider(window=11, method=method, max_stars=max_stars)
+                centroider(frame)
+                t = time_per_call(lambda: centroider(frame))
+                print(f'{shape[1]:>6}x{shape[0]:<5} {method:>8} {max_stars:>6} {t * 1e6:>10.0f}')
+
+
+def benchmark_stream(camera_name, duration):
+    camera_interface = Interface(CAMERA_ID)
+    com_queue = camera_interface.com_queue
+    multiplexer = ResultMultiplexer(InterfaceManager(camera_interface))
+    subprocess = CameraSubprocess(CAMERA_ID, camera_name, com_queue, camera_interface.res_queue, backend='sim')
+    subprocess.start()
+    reader = FrameRingReader()
+
+    model = CAMERA_MODELS[camera_name]
+    print(f'\nStreaming centroids of a simulated {camera_name} (1 ms exposure)')
+    print(f'{"ROI":>12} {"FPS":>8} {"centroids/s":>12} {"batches/s":>10} {"latency (ms)":>14} {"previews/s":>12}')
+
+    com_queue.put((CMD_CAMERA_SET_CENTROIDING, {'window': 11, 'max_stars': 5}))
+    for w, h in ((128, 128), (512, 512), (model['MaxWidth'], model['MaxHeight'])):
+        com_queue.put((CMD_CAMERA_APPLY_CONFIG, {'exp_time': 1e-3, 'roi': (0, w, 0, h)}))
+        com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+        time.sleep(0.5)
+
+        # Drain the result channel before measuring
+        results = multiplexer.receive(0)
+        while results:
+            for interface, data in results:
+                if data[0] == CMD_DISPLAY_IMAGE:
+                    reader.get(data[1])
+                    reader.release(data[1])
+            results = multiplexer.receive(0)
+
+        frames, centroids, batches, previews, latency = set(), 0, 0, 0, []
+        t_end = time.perf_counter() + duration
+        while time.perf_counter() < t_end:
+            for interface, data in multiplexer.receive(t_end - time.perf_counter()):
+                if data[0] == CMD_CAMERA_CENTROIDS:
+                    records = data[1]
+                    latency.append((time.perf_counter_ns() - records['t_ns'][-1]) * 1e-6)
+                    frames.update(records['seq'].tolist())
+                    centroids += len(records)
+                    batches += 1
+                elif data[0] == CMD_DISPLAY_IMAGE:
+                    reader.get(data[1])
+                    reader.release(data[1])
+                    previews += 1
+
+        com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+        roi = f'{w}x{h}'
+        print(f'{roi:>12} {len(frames) / duration:>8.1f} {centroids / duration:>12.1f} {batches / duration:>10.1f} '
+              f'{np.median(latency) if latency else float("nan"):>14.1f} {previews / duration:>12.1f}')
+        time.sleep(0.5)
+
+    com_queue.put((CMD_STOP_SUBPROCESS, ))
+    stopped = False
+    while not stopped:
+        for interface, data in multiplexer.receive():
+            if data[0] == CMD_DISPLAY_IMAGE:
+                reader.release(data[1])
+            stopped |= data[0] == CMD_STOP_SUBPROCESS
+    subprocess.join()
+    reader.close()
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI174MM-Cool'
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    benchmark_accuracy()
+    benchmark_cost(camera_name)
+    benchmark_stream(camera_name, duration)
@@ -0,0 +1,79 @@
+"""Throughput and compression ratio of tile-compressed FITS recordings compared to uncompressed files.
+
+Recordings of a simulated star field (SimulatedCamera) are written with FitsStreamWriter and with FitsCompressedWriter
+for each compression type, compressing in this process and in a process pool. Every file is read back and compared to
+the frames.
+
+Usage: python testing/benchmark-compression.py [camera name] [frames] [ROI height] [workers]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ImageData import ImageData, load_fits
+from SimulatedCamera import SimulatedZwoCamera
+from ZwoCamera import ASI_IMG_RAW8, ASI_IMG_RAW16
+
+
+def record(camera_name, image_type, n_frames, roi_h):
+    """Capture a recording of the simulated camera. """
+
+    camera = SimulatedZwoCamera(camera_name)
+    width = camera.get_camera_property()['MaxWidth']
+    camera.set_roi_format(width, roi_h, 1, image_type)
+    camera.start_video_capture()
+    frames = np.stack([camera.capture_video_frame() for _ in range(n_frames)])
+    camera.stop_video_capture()
+
+    return frames
+
+
+def write(frames, file_name, compression=None, pool=None) -> float:
+    """Write frames to file_name and return the time it took (in s). """
+
+    image_data = ImageData(frames, 1e-3, bit_depth=16, frame_meta={'SEQ': np.arange(len(frames))})
+    t_start = time.perf_counter()
+    image_data.write_fits_to_file(file_name, compression=compression, pool=pool)
+
+    return time.perf_counter() - t_start
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI174MM-Cool'
+    n_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    roi_h = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+    n_workers = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+
+    directory = tempfile.mkdtemp(prefix='compression_')
+    pool = ProcessPoolExecutor(n_workers)
+    # Start the workers before measuring
+    list(pool.map(abs, range(n_workers)))
+
+    print(f'Writing {n_frames} frames of a simulated {camera_name} ({n_workers} workers for the pool)')
+    print(f'{"type":>6} {"compression":>14} {"pool":>6} {"MB/s":>8} {"ratio":>7} {"read back":>10}')
+
+    for image_type, name in ((ASI_IMG_RAW8, 'RAW8'), (ASI_IMG_RAW16, 'RAW16')):
+        frames = record(camera_name, image_type, n_frames, roi_h)
+        modes = [(None, None)]
+        # astropy compresses GZIP tiles with the slowest zlib level 9
+        for compression in ({'compression_type': 'RICE_1'}, {'compression_type': 'GZIP_1'}, {'compression_type': 'GZIP_2'},
+                            {'compression_type': 'HCOMPRESS_1'}):
+            modes += [(compression, None), (compression, pool)]
+
+        for compression, executor in modes:
+            file_name = os.path.join(directory, f'{name}.fits')
+            t = write(frames, file_name, compression, executor)
+            ratio = frames.nbytes / os.path.getsize(file_name)
+            with load_fits(file_name) as rec:
+                ok = rec.shape == frames.shape and np.array_equal(rec[:], frames)
+            label = 'none' if compression is None else compression['compression_type']
+            print(f'{name:>6} {label:>14} {"yes" if executor else "no":>6} {frames.nbytes / t * 1e-6:>8.0f} {ratio:>7.2f} {"ok" if ok else "differs":>10}')
+            os.remove(file_name)
+
+    pool.shutdown()
+    os.rmdir(directory)
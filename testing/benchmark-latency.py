@@ -0,0 +1,112 @@
+"""Command latency and idle CPU usage of a CameraSubprocess with the simulated camera (no camera or ZWO SDK required).
+
+1. Round trip time of a query (the exposure time, answered from the cached settings unless a command is still being
+   applied) while the camera is stopped, streams and records.
+2. CPU time used by the idle subprocess (Linux only).
+
+Usage: python testing/benchmark-latency.py [camera name] [number of commands]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+
+
+def receive(multiplexer):
+    """Data of all results in the order the multiplexer hands them out. """
+
+    while True:
+        for interface, data in multiplexer.receive():
+            yield data
+
+
+def wait_for(results, reader, cmd):
+    """Wait for a reply, releasing all frames which arrive in the meantime. """
+
+    while True:
+        data = next(results)
+        if data[0] == CMD_DISPLAY_IMAGE:
+            reader.release(data[1])
+        elif data[0] == cmd:
+            return data
+
+
+def measure_latency(com_queue, results, reader, n):
+    """Get the round trip times of n commands (in s). """
+
+    latency = np.empty(n)
+    for i in range(n):
+        t_s = time.perf_counter()
+        com_queue.put((CMD_CAMERA_GET_EXP, ))
+        wait_for(results, reader, CMD_CAMERA_GET_EXP)
+        latency[i] = time.perf_counter() - t_s
+        # Do not send the commands back to back
+        time.sleep(1e-3)
+
+    return latency
+
+
+def cpu_time(pid):
+    """CPU time used by a process (in s). Returns None if /proc is not available. """
+
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+
+    # utime and stime are the 12th and 13th field after the process name
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def print_latency(label, latency):
+    median, p99 = np.percentile(latency, (50, 99)) * 1e6
+    print(f'{label:>12} {median:>12.0f} {p99:>12.0f} {latency.max() * 1e6:>12.0f}')
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI120MM Mini'
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    interface = Interface(CAMERA_ID)
+    com_queue = interface.com_queue
+    results = receive(ResultMultiplexer(InterfaceManager(interface)))
+    subprocess = CameraSubprocess(CAMERA_ID, camera_name, com_queue, interface.res_queue, backend='sim')
+    subprocess.start()
+    reader = FrameRingReader()
+
+    # Wait until the camera is set up
+    wait_for(results, reader, CMD_CAMERA_GET_IMAGE_TYPE)
+    measure_latency(com_queue, results, reader, 10)
+
+    # CPU usage while idle
+    cpu_s = cpu_time(subprocess.pid)
+    time.sleep(2)
+    cpu_f = cpu_time(subprocess.pid)
+
+    print(f'Command round trip time of a simulated {camera_name} (us)')
+    print(f'{"mode":>12} {"median":>12} {"99%":>12} {"max":>12}')
+
+    print_latency('stopped', measure_latency(com_queue, results, reader, n))
+
+    com_queue.put((CMD_CAMERA_SET_EXP, 1e-3))
+    com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+    print_latency('streaming', measure_latency(com_queue, results, reader, n))
+    com_queue.put((CMD_CAMERA_REC_MODE, ))
+    print_latency('recording', measure_latency(com_queue, results, reader, n))
+    com_queue.put((CMD_CAMERA_MODE_STOP, ))
+
+    if cpu_s is not None:
+        print(f'Idle CPU usage: {(cpu_f - cpu_s) / 2 * 100:.2f}%')
+
+    com_queue.put((CMD_STOP_SUBPROCESS, ))
+    wait_for(results, reader, CMD_STOP_SUBPROCESS)
+    subprocess.join()
+    reader.close()
@@ -0,0 +1,103 @@
+"""Throughput of the capture pipeline with the simulated camera (no camera or ZWO SDK required).
+
+1. Capture rate of the simulated camera compared to its readout model for different ROI heights.
+2. Frames per second arriving in the main process when a CameraSubprocess streams through the frame ring.
+
+Usage: python testing/benchmark-pipeline.py [camera name] [seconds per run]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SimulatedCamera import SimulatedZwoCamera
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+
+
+def benchmark_camera(camera_name, duration):
+    print(f'Capture rate of the simulated {camera_name}')
+    print(f'{"ROI height":>10} {"highspeed":>10} {"model FPS":>10} {"FPS":>10} {"dropped":>8}')
+
+    camera = SimulatedZwoCamera(camera_name)
+    camera.exp_time = 1e-4
+    sensor_w = camera.get_camera_property()['MaxWidth']
+    sensor_h = camera.get_camera_property()['MaxHeight']
+
+    for highspeed in (False, True):
+        camera.highspeed = highspeed
+        for height in (sensor_h - sensor_h % 2, 512, 128, 32):
+            camera.set_roi(0, 0, sensor_w - sensor_w % 8, height)
+            buffer = np.empty(camera.frame_shape, dtype=camera.frame_dtype)
+
+            camera.start_video_capture()
+            n = 0
+            t_s = time.perf_counter()
+            while time.perf_counter() - t_s < duration:
+                camera.capture_video_frame_into(buffer)
+                n += 1
+            t_f = time.perf_counter()
+            camera.stop_video_capture()
+
+            print(f'{height:>10} {str(highspeed):>10} {1 / camera.frame_time():>10.1f} {n / (t_f - t_s):>10.1f} {camera.get_dropped_frames():>8}')
+
+
+def receive(multiplexer):
+    """Data of all results in the order the multiplexer hands them out. """
+
+    while True:
+        for interface, data in multiplexer.receive():
+            yield data
+
+
+def benchmark_subprocess(camera_name, duration):
+    print(f'Frames arriving in the main process from a simulated {camera_name}')
+
+    interface = Interface(CAMERA_ID)
+    com_queue = interface.com_queue
+    results = receive(ResultMultiplexer(InterfaceManager(interface)))
+    subprocess = CameraSubprocess(CAMERA_ID, camera_name, com_queue, interface.res_queue, backend='sim')
+    subprocess.start()
+    reader = FrameRingReader()
+
+    com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+
+    n = 0
+    t_s = time.perf_counter()
+    while time.perf_counter() - t_s < duration:
+        data = next(results)
+        if data[0] == CMD_DISPLAY_IMAGE:
+            frame = reader.get(data[1])
+            if frame is not None:
+                n += 1
+                del frame
+            reader.release(data[1])
+        elif data[0] == CMD_STOP_SUBPROCESS:
+            break
+    t_f = time.perf_counter()
+
+    com_queue.put((CMD_CAMERA_MODE_STOP, ))
+    com_queue.put((CMD_STOP_SUBPROCESS, ))
+    # Drain the result channel until the subprocess has stopped
+    while True:
+        data = next(results)
+        if data[0] == CMD_DISPLAY_IMAGE:
+            reader.release(data[1])
+        elif data[0] == CMD_STOP_SUBPROCESS:
+            break
+    subprocess.join()
+    reader.close()
+
+    print(f'{n / (t_f - t_s):.1f} FPS')
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI120MM Mini'
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    benchmark_camera(camera_name, duration)
+    benchmark_subprocess(camera_name, duration)
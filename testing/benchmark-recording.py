@@ -0,0 +1,97 @@
+"""Throughput of recordings from a simulated camera through the image processing pool (no camera or ZWO SDK
+required).
+
+The camera subprocess records into its shared memory recording ring, this script forwards the references to the
+ImageSubprocess like the CameraInterface does, and reports the recordings written, the throughput, the frames dropped
+due to backpressure and whether the FITS files read back correctly.
+
+Usage: python testing/benchmark-recording.py [camera name] [seconds] [workers] [ROI height]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+from ImageData import load_fits
+from SimulatedCamera import CAMERA_MODELS
+from SubprocessImageProcessing import ImageSubprocess
+
+
+def benchmark(camera_name, duration, n_workers, roi_h):
+    model = CAMERA_MODELS[camera_name]
+    directory = tempfile.mkdtemp(prefix='recordings_')
+
+    camera_interface = Interface(CAMERA_ID)
+    image_interface = Interface(IMG_PROCESS_ID)
+    camera_queue = camera_interface.com_queue
+    image_queue = image_interface.com_queue
+    multiplexer = ResultMultiplexer(InterfaceManager(camera_interface, image_interface))
+    camera = CameraSubprocess(CAMERA_ID, camera_name, camera_queue, camera_interface.res_queue, backend='sim')
+    image = ImageSubprocess(IMG_PROCESS_ID, image_queue, image_interface.res_queue, directory, n_workers)
+    image.start()
+    camera.start()
+    reader = FrameRingReader()
+
+    camera_queue.put((CMD_CAMERA_APPLY_CONFIG, {'exp_time': 1e-4, 'roi': (0, model['MaxWidth'], 0, roi_h)}))
+    camera_queue.put((CMD_CAMERA_REC_MODE, ))
+
+    received, results, progress, stats = 0, [], None, None
+    stopped = False
+    t_start = time.perf_counter()
+    while not stopped or stats is None or len(results) < received:
+        if not stopped and time.perf_counter() - t_start > duration:
+            # The camera sends the timing report once it stopped, after the last recording
+            camera_queue.put((CMD_CAMERA_MODE_STOP, ))
+            stopped = True
+        for interface, data in multiplexer.receive(0.1):
+            if data[0] == CMD_DISPLAY_IMAGE:
+                reader.get(data[1])
+                reader.release(data[1])
+            elif data[0] == CMD_RETURN_REC:
+                # Forward the recording like the CameraInterface
+                received += 1
+                image_queue.put((CMD_RETURN_REC, interface.uid) + tuple(data[1:]))
+            elif data[0] == CMD_IMG_PROGRESS:
+                progress = data[1]
+                results.append(progress['result'])
+            elif data[0] == CMD_CAMERA_GET_TIMING:
+                camera_queue.put((CMD_GET_STATS, ))
+            elif data[0] == CMD_GET_STATS:
+                stats = data[1]
+    elapsed = time.perf_counter() - t_start
+
+    camera_queue.put((CMD_STOP_SUBPROCESS, ))
+    image_queue.put((CMD_STOP_SUBPROCESS, ))
+    camera.join()
+    image.join()
+    reader.close()
+
+    n_bytes = sum(result['bytes'] for result in results)
+    dropped = stats['rate'].get('rec_dropped', {'count': 0})['count']
+    worker_time = np.mean([result['seconds'] for result in results]) if results else float('nan')
+    print(f'{camera_name}, {model["MaxWidth"]}x{roi_h}, {n_workers or os.cpu_count()} workers: '
+          f'{len(results)} recordings ({progress["failed"] if progress else 0} failed), {n_bytes / elapsed / 2**20:.0f} MiB/s, '
+          f'{worker_time:.2f} s per recording, {dropped} frames dropped due to backpressure')
+
+    # Read back the last recording
+    if results:
+        with load_fits(results[-1]['file_name']) as rec:
+            meta = rec.metadata
+            ok = len(rec) == results[-1]['frames'] and np.all(np.diff(meta['SEQ']) > 0)
+            print(f'{results[-1]["file_name"]}: {rec.shape} {rec.dtype}, metadata {"ok" if ok else "broken"}')
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI120MM Mini'
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    roi_h = int(sys.argv[4]) if len(sys.argv) > 4 else 128
+
+    benchmark(camera_name, duration, n_workers, roi_h)
@@ -0,0 +1,98 @@
+"""Gap in the frame stream caused by changing the ROI of a streaming CameraSubprocess with the simulated camera (no
+camera or ZWO SDK required).
+
+1. Moving the ROI (same size, only the start position changes) while the camera keeps streaming.
+2. Resizing the ROI, which requires restarting the video capture.
+
+The gap is the time between the last frame before and the first frame after the change, as measured by the
+subprocess (see CameraSubprocess.start_gap_measurement).
+
+Usage: python testing/benchmark-roi.py [camera name] [number of changes]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+
+
+def receive(multiplexer):
+    """Data of all results in the order the multiplexer hands them out. """
+
+    while True:
+        for interface, data in multiplexer.receive():
+            yield data
+
+
+def wait_for(results, reader, cmd):
+    """Wait for a reply, releasing all frames which arrive in the meantime. """
+
+    while True:
+        data = next(results)
+        if data[0] == CMD_DISPLAY_IMAGE:
+            reader.get(data[1])
+            reader.release(data[1])
+        elif data[0] == cmd:
+            return data
+
+
+def print_gap(label, stats, frame_time):
+    if stats is None or not stats['count']:
+        print(f'{label:>8} no frames')
+        return
+    print(f'{label:>8} {stats["count"]:>8} {stats["mean"] * 1e3:>10.1f} {stats["max"] * 1e3:>10.1f} {stats["mean"] / frame_time:>14.1f}')
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI120MM Mini'
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    interface = Interface(CAMERA_ID)
+    com_queue = interface.com_queue
+    results = receive(ResultMultiplexer(InterfaceManager(interface)))
+    subprocess = CameraSubprocess(CAMERA_ID, camera_name, com_queue, interface.res_queue, backend='sim')
+    subprocess.start()
+    reader = FrameRingReader()
+
+    # Stream a ROI of half the sensor size
+    com_queue.put((CMD_CAMERA_GET_CONFIG, ))
+    config = wait_for(results, reader, CMD_CAMERA_GET_CONFIG)[1]
+    width = config['sensor_w'] // 2 // 8 * 8
+    height = config['sensor_h'] // 2 // 2 * 2
+    com_queue.put((CMD_CAMERA_APPLY_CONFIG, {'exp_time': 1e-3, 'roi': (0, width, 0, height)}))
+    wait_for(results, reader, CMD_CAMERA_GET_CONFIG)
+    com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+    time.sleep(1)
+
+    for i in range(n):
+        # Move the ROI back and forth
+        offset = 16 if i % 2 == 0 else -16
+        com_queue.put((CMD_CAMERA_APPLY_CONFIG, {'roi': (offset, width, offset, height)}))
+        wait_for(results, reader, CMD_CAMERA_GET_CONFIG)
+        time.sleep(0.2)
+
+    for i in range(n):
+        # Change the size of the ROI
+        new_width = width if i % 2 else width - 64
+        com_queue.put((CMD_CAMERA_APPLY_CONFIG, {'roi': (0, new_width, 0, height)}))
+        wait_for(results, reader, CMD_CAMERA_GET_CONFIG)
+        time.sleep(0.2)
+
+    com_queue.put((CMD_GET_STATS, ))
+    stats = wait_for(results, reader, CMD_GET_STATS)[1]
+    frame_time = 1 / stats['timing']['sustained_rate'] if stats['timing'].get('sustained_rate') else float('nan')
+
+    print(f'Frame gap when changing the ROI of a simulated {camera_name} ({width}x{height}, {frame_time * 1e3:.1f} ms per frame)')
+    print(f'{"path":>8} {"changes":>8} {"mean (ms)":>10} {"max (ms)":>10} {"frame times":>14}')
+    print_gap('move', stats['latency'].get('roi_move_gap'), frame_time)
+    print_gap('restart', stats['latency'].get('roi_restart_gap'), frame_time)
+
+    com_queue.put((CMD_STOP_SUBPROCESS, ))
+    wait_for(results, reader, CMD_STOP_SUBPROCESS)
+    subprocess.join()
+    reader.close()
@@ -0,0 +1,131 @@
+"""Command latency of one camera while other cameras keep the main process busy with previews (no camera or ZWO SDK
+required).
+
+Several simulated cameras stream previews while the round trip time of commands to an idle simulated camera is
+measured. Handling a preview in the main process takes a fixed time (e.g., converting it for Qt), so the receiving
+thread is saturated. The results of all subprocesses are received through their result channels, once in order of
+arrival (every ready pipe in turn, like a single shared queue) and once with a ResultMultiplexer, which takes control
+replies first.
+
+Usage: python testing/benchmark-routing.py [streaming cameras] [commands] [handling time in ms]
+"""
+import os
+import sys
+import time
+import threading
+import numpy as np
+from multiprocessing.connection import wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+
+
+# Simulated camera model and maximum preview rate of every camera
+CAMERA_NAME = 'ZWO ASI120MM Mini'
+PREVIEW_RATE = 30
+
+
+class SimulatedCameraInterface(Interface):
+    """Interface to a simulated camera which releases the previews after handling_time and records the replies. """
+
+    def __init__(self, uid, camera_name, reader, preview_rate, handling_time):
+        super().__init__(uid)
+        self.camera_name = camera_name
+        self.reader = reader
+        self.preview_rate = preview_rate
+        self.handling_time = handling_time
+        self.reply = threading.Event()
+        self.previews = 0
+
+    def init_subprocess(self):
+        return CameraSubprocess(self.uid, self.camera_name, self.com_queue, self.res_queue, backend='sim', preview_rate=self.preview_rate)
+
+    def handle_data(self, data):
+        if data[0] == CMD_DISPLAY_IMAGE:
+            self.reader.get(data[1])
+            time.sleep(self.handling_time)
+            self.reader.release(data[1])
+            self.previews += 1
+        elif data[0] == CMD_CAMERA_GET_EXP:
+            self.reply.set()
+
+
+def receive_in_order(manager, timeout):
+    """Receive one result from every ready pipe of the result channels, regardless of whether it is a control reply. """
+
+    pipes = {}
+    for interface in manager:
+        pipes[interface.res_queue.control] = pipes[interface.res_queue.bulk] = interface
+
+    return [(pipes[pipe], pipes[pipe].res_queue.receive(pipe)[1]) for pipe in wait(list(pipes), timeout)]
+
+
+def measure(in_order, n_cameras, n, handling_time):
+    """Round trip times of n commands to the idle camera while n_cameras stream (in s) and the number of previews
+    handled.
+    """
+
+    reader = FrameRingReader()
+    idle = SimulatedCameraInterface(CAMERA_ID, CAMERA_NAME, reader, PREVIEW_RATE, handling_time)
+    streaming = [SimulatedCameraInterface(CAMERA_ID + 0x10 + i, CAMERA_NAME, reader, PREVIEW_RATE, handling_time) for i in range(n_cameras)]
+    manager = InterfaceManager(idle, *streaming)
+    multiplexer = ResultMultiplexer(manager)
+
+    running = True
+
+    def receive():
+        while running:
+            if in_order:
+                results = receive_in_order(manager, 0.1)
+            else:
+                results = multiplexer.receive(0.1)
+            for interface, data in results:
+                interface.handle_data(data)
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    for interface in manager:
+        interface.start_subprocess()
+
+    for interface in streaming:
+        interface.com_queue.put((CMD_CAMERA_SET_EXP, 1e-3))
+        interface.com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+    # Let the streams settle
+    time.sleep(2)
+
+    latency = np.empty(n)
+    for i in range(n):
+        idle.reply.clear()
+        t_s = time.perf_counter()
+        idle.com_queue.put((CMD_CAMERA_GET_EXP, ))
+        idle.reply.wait()
+        latency[i] = time.perf_counter() - t_s
+        time.sleep(0.05)
+
+    for interface in streaming:
+        interface.com_queue.put((CMD_CAMERA_MODE_STOP, ))
+    for interface in manager:
+        interface.stop_subprocess()
+    running = False
+    thread.join()
+    reader.close()
+
+    return latency, sum(interface.previews for interface in streaming)
+
+
+if __name__ == '__main__':
+    n_cameras = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    handling_time = float(sys.argv[3]) * 1e-3 if len(sys.argv) > 3 else 10e-3
+
+    print(f'Command round trip time of an idle camera while {n_cameras} cameras stream previews '
+          f'({handling_time * 1e3:.0f} ms each) (ms)')
+    print(f'{"results":>10} {"median":>8} {"99%":>8} {"max":>8} {"previews":>9}')
+    for in_order in (True, False):
+        latency, previews = measure(in_order, n_cameras, n, handling_time)
+        median, p99 = np.percentile(latency, (50, 99)) * 1e3
+        print(f'{"in order" if in_order else "priority":>10} {median:>8.1f} {p99:>8.1f} {latency.max() * 1e3:>8.1f} {previews:>9}')
@@ -0,0 +1,86 @@
+"""Accuracy and cost of the lucky-imaging frame selection (no camera or ZWO SDK required).
+
+Bursts of a star under simulated seeing (varying FWHM and image motion) are scored with every selection metric. The
+selected frames are compared to the frames with the smallest true FWHM, and the shift-and-add stack of the selection
+to the plain mean of the burst. Finally the burst is written by process_recording from a recording ring, once
+completely and once reduced to its selection, to compare the file sizes.
+
+Usage: python testing/benchmark-selection.py [frames] [size] [keep]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from FrameBuffer import FrameRingBuffer
+from FrameSelection import FrameSelector, SELECTION_METRICS
+from SubprocessImageProcessing import process_recording
+from ImageData import load_fits
+
+
+def burst(n, size, seed=1):
+    """Frames of a star with a random FWHM and position per frame on a noisy background.
+
+    # Returns
+    * frames::np.ndarray - Burst (n, size, size) of uint16.
+    * fwhm::np.ndarray - True FWHM of every frame (in pixels).
+    """
+
+    rng = np.random.default_rng(seed)
+    fwhm = rng.gamma(8, 0.5, n) + 1.5
+    positions = size / 2 + rng.normal(0, size / 20, (n, 2))
+    y, x = np.mgrid[:size, :size]
+
+    frames = np.empty((n, size, size), dtype=np.uint16)
+    for i in range(n):
+        sigma = fwhm[i] / 2.3548
+        r2 = (x - positions[i, 0])**2 + (y - positions[i, 1])**2
+        star = 40000 / (2 * np.pi * sigma**2) * np.exp(-r2 / (2 * sigma**2))
+        frames[i] = np.clip(np.rint(star + rng.normal(200, 5, (size, size))), 0, 65535)
+
+    return frames, fwhm
+
+
+if __name__ == '__main__':
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+    keep = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+
+    frames, fwhm = burst(n_frames, size)
+    n_keep = int(round(keep * n_frames))
+    best = set(np.argsort(fwhm)[:n_keep])
+    mean_peak = frames.mean(axis=0).max()
+
+    print(f'Burst of {n_frames}x{size}x{size} frames, keeping {keep:.0%}')
+    for metric in SELECTION_METRICS:
+        selector = FrameSelector(metric, keep)
+        t = time.perf_counter()
+        scores, centers = selector.measure(frames)
+        t = time.perf_counter() - t
+        index = selector.select(scores)
+        stack = selector.shift_and_add(frames, index, centers)
+        overlap = len(best.intersection(index))
+        print(f'{metric:>9}: {t * 1e3:.0f} ms ({frames.nbytes / t / 2**20:.0f} MiB/s), {overlap} of the {n_keep} '
+              f'sharpest frames selected, stack peak {stack.max():.0f} (mean of the burst {mean_peak:.0f})')
+
+    # Writing the burst from a recording ring as the ImageSubprocess does
+    directory = tempfile.mkdtemp(prefix='selection_')
+    ring = FrameRingBuffer(0, frames.shape, frames.dtype, n_slots=1, prefix='rec')
+    meta = {'SEQ': np.arange(n_frames), 'T_NS': np.arange(n_frames) * 10**6, 'DROPPED': np.zeros(n_frames, dtype=np.int32)}
+    header = {'exp_time': 1e-3, 'bit_depth': 16}
+    for uid, selection in ((1, None), (2, {'metric': 'fwhm', 'keep': keep, 'stack': True})):
+        ref = ring.write(frames)
+        result = process_recording(uid, ref, header, meta, directory, selection=selection)
+        with load_fits(result['file_name']) as rec:
+            line = (f"{'all frames' if selection is None else 'selection':>10}: {result['frames']} of {result['recorded']} "
+                    f"frames, {result['file_bytes'] / 2**20:.1f} MiB in {result['seconds']:.2f} s, header {rec.header.get('SELECT')}")
+        if result['stack_file'] is not None:
+            with load_fits(result['stack_file']) as rec:
+                line += f", stack of {rec.header['NCOMBINE']} of {rec.header['NBURST']} frames"
+        print(line)
+    ring.close()
+
+    print(f'Files in {directory}')
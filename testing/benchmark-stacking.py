@@ -0,0 +1,83 @@
+"""Capture rate of a simulated camera in continuous mode with and without live stacking (no camera or ZWO SDK
+required).
+
+For every stacking method the camera subprocess streams full frames for a few seconds, the capture rate and the cost
+of the stacking stages are reported, and the stack is saved and read back.
+
+Usage: python testing/benchmark-stacking.py [camera name] [seconds] [window]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from FrameBuffer import FrameRingReader
+from ImageData import load_fits
+
+
+def stream(camera_name, duration, options, file_name):
+    """Stream with the given stacking options and return the telemetry snapshot and the file of the saved stack. """
+
+    camera_interface = Interface(CAMERA_ID)
+    com_queue = camera_interface.com_queue
+    multiplexer = ResultMultiplexer(InterfaceManager(camera_interface))
+    camera = CameraSubprocess(CAMERA_ID, camera_name, com_queue, camera_interface.res_queue, backend='sim')
+    camera.start()
+    reader = FrameRingReader()
+
+    com_queue.put((CMD_CAMERA_SET_STACKING, options))
+    com_queue.put((CMD_CAMERA_CONTINOUS_MODE, ))
+
+    stats, stack_file, saved = None, None, False
+    stopped = False
+    t_start = time.perf_counter()
+    while stats is None or (options is not None and not saved):
+        if not stopped and time.perf_counter() - t_start > duration:
+            com_queue.put((CMD_CAMERA_MODE_STOP, ))
+            if options is not None:
+                com_queue.put((CMD_CAMERA_SAVE_STACK, file_name))
+            com_queue.put((CMD_CAMERA_GET_TIMING, ))
+            stopped = True
+        for interface, data in multiplexer.receive(0.1):
+            if data[0] == CMD_DISPLAY_IMAGE:
+                reader.get(data[1])
+                reader.release(data[1])
+            elif data[0] == CMD_CAMERA_SAVE_STACK:
+                stack_file, saved = data[1], True
+            elif data[0] == CMD_CAMERA_GET_TIMING and stopped:
+                com_queue.put((CMD_GET_STATS, ))
+            elif data[0] == CMD_GET_STATS:
+                stats = data[1]
+
+    com_queue.put((CMD_STOP_SUBPROCESS, ))
+    camera.join()
+    reader.close()
+
+    return stats, stack_file
+
+
+if __name__ == '__main__':
+    camera_name = sys.argv[1] if len(sys.argv) > 1 else 'ZWO ASI120MM Mini'
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    window = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+
+    directory = tempfile.mkdtemp(prefix='stacking_')
+    for options in (None, {'method': 'mean'}, {'method': 'ema', 'alpha': 0.1}, {'method': 'clipped', 'window': window}):
+        name = 'none' if options is None else options['method']
+        file_name = os.path.join(directory, f'{name}.fits')
+        stats, stack_file = stream(camera_name, duration, options, file_name)
+
+        fps = stats['timing']['fps'] if 'timing' in stats and 'fps' in stats['timing'] else stats['rate']['capture']['rate']
+        stages = stats['stage']
+        costs = ', '.join(f"{stage} {stages[stage]['cpu_per_call'] * 1e3:.2f} ms" for stage in ('capture', 'stack', 'stack_render') if stage in stages)
+        line = f'{name:>8}: {fps:6.1f} FPS, {costs}'
+        if stack_file is not None:
+            with load_fits(stack_file) as rec:
+                line += f", saved {rec.shape} {rec.dtype} of {rec.header['NCOMBINE']} frames"
+        print(line)
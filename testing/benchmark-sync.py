@@ -0,0 +1,122 @@
+"""Synchronized recording with two simulated cameras and matching of their frames (no camera or ZWO SDK required).
+
+A simulated ASI120MM Mini (short exposures) and ASI174MM-Cool (longer exposures) record a session started by
+SyncCapture, the ImageSubprocess writes the recordings, and the frames are matched into a joint recording index. The
+start skew of the cameras, the jitter of the raw timestamps and the time differences of the matched frames are
+reported.
+
+Usage: python testing/benchmark-sync.py [seconds] [Mini exposure in ms] [ASI174 exposure in ms]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Subprocess import Interface, InterfaceManager, ResultMultiplexer
+from SubprocessZwoMini import CameraSubprocess
+from SubprocessHeader import *
+from SubprocessImageProcessing import ImageInterface
+from FrameBuffer import FrameRingReader
+from SyncCapture import SyncCapture, find_session, build_sync_index, load_sync_index, frame_times
+
+
+# Height of the ROI of both cameras (short ROIs record at a high frame rate)
+ROI_HEIGHT = 64
+
+
+class SimulatedCameraInterface(Interface):
+    """Headless interface to a simulated camera which passes its recordings on to the image processing. """
+
+    def __init__(self, uid, camera_name, reader, image_interface):
+        super().__init__(uid)
+        self.camera_name = camera_name
+        self.reader = reader
+        self.image_interface = image_interface
+        self.exp_time = None
+
+    def init_subprocess(self):
+        return CameraSubprocess(self.uid, self.camera_name, self.com_queue, self.res_queue, backend='sim')
+
+    def set_sync_rec_mode(self, start_ns, sync_id):
+        self.com_queue.put((CMD_CAMERA_REC_MODE, start_ns, sync_id))
+
+    def stop_recording(self):
+        self.com_queue.put((CMD_CAMERA_MODE_STOP, ))
+
+    def handle_data(self, data):
+        if data[0] == CMD_CAMERA_GET_EXP:
+            self.exp_time = data[1]
+        elif data[0] == CMD_DISPLAY_IMAGE:
+            self.reader.release(data[1])
+        elif data[0] == CMD_RETURN_REC:
+            self.image_interface.process_recording(self.uid, *data[1:])
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 12
+    mini_exp = float(sys.argv[2]) * 1e-3 if len(sys.argv) > 2 else 2e-3
+    cool_exp = float(sys.argv[3]) * 1e-3 if len(sys.argv) > 3 else 5e-3
+
+    directory = tempfile.mkdtemp(prefix='sync_')
+    reader = FrameRingReader()
+    image_interface = ImageInterface(directory)
+    mini = SimulatedCameraInterface(CAMERA_ID, 'ZWO ASI120MM Mini', reader, image_interface)
+    cool = SimulatedCameraInterface(COOL_CAMERA_ID, 'ZWO ASI174MM-Cool', reader, image_interface)
+    manager = InterfaceManager(mini, cool, image_interface)
+    multiplexer = ResultMultiplexer(manager)
+
+    for interface in (image_interface, mini, cool):
+        interface.start_subprocess()
+    for interface, exp_time in ((mini, mini_exp), (cool, cool_exp)):
+        interface.com_queue.put((CMD_CAMERA_SET_ROI, (0, 640, 0, ROI_HEIGHT)))
+        interface.com_queue.put((CMD_CAMERA_SET_EXP, exp_time))
+        interface.com_queue.put((CMD_CAMERA_GET_EXP, ))
+    # Wait until both cameras are set up
+    while mini.exp_time is None or cool.exp_time is None:
+        for interface, data in multiplexer.receive(0.1):
+            interface.handle_data(data)
+
+    sync = SyncCapture(mini, cool)
+    # The simulated cameras render their frames with the first frame read out after the ROI changed, which takes longer
+    # than SYNC_START_DELAY
+    sync_id = sync.start(delay=2.0)
+    start_ns = sync.start_ns
+    t_end = time.perf_counter() + duration
+    while time.perf_counter() < t_end:
+        for interface, data in multiplexer.receive(0.1):
+            interface.handle_data(data)
+    sync.stop()
+
+    # Wait until all recordings were written
+    for interface in (mini, cool):
+        interface.stop_subprocess()
+    while image_interface.progress is None or image_interface.progress['pending']:
+        image_interface.get_progress()
+        for interface, data in multiplexer.receive(0.5):
+            interface.handle_data(data)
+    image_interface.stop_subprocess()
+    reader.close()
+
+    recordings = find_session(directory, sync_id)
+    for camera, files in recordings.items():
+        times = frame_times(files, regularize=False)
+        regular = frame_times(files)
+        jitter = (times['t_mid_ns'] - regular['t_mid_ns']).std()
+        print(f'{camera}: {len(times)} frames in {len(files)} recordings, first frame read out '
+              f'{(times["t_ns"][0] - start_ns) * 1e-6:.2f} ms after the start, raw timestamp jitter {jitter * 1e-3:.0f} us')
+
+    if len(recordings) < 2:
+        print('Not enough recordings to match (record longer).')
+    else:
+        out_file = os.path.join(directory, 'sync.fits')
+        t = time.perf_counter()
+        build_sync_index(recordings, out_file, sync_id=sync_id)
+        t = time.perf_counter() - t
+        cameras, files, matches = load_sync_index(out_file)
+        dt = np.abs(matches['DT1']) * 1e-6
+        print(f'Index of {cameras[0]} with {cameras[1]}: {len(matches)} matched frames in {t * 1e3:.0f} ms, '
+              f'|dt| median {np.median(dt):.3f} ms, max {dt.max():.3f} ms')
+    print(f'Files in {directory}')